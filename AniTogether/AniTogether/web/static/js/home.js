@@ -120,6 +120,13 @@ function onRoomReady() {
             document.getElementById("info-text").innerHTML = "Ваша версия приложения устарела\nТребуется обновление"
             overlay("info-overlay").show()
             checkUpdate()
+        } else if (response.code == 7) {
+            document.getElementById("info-text").innerHTML = "Сервер перезапускается\nПопробуйте через несколько секунд"
+            overlay("info-overlay").show()
+        } else if (response.code == 8) {
+            let retry_after = Math.ceil(response.retry_after || 5)
+            document.getElementById("info-text").innerHTML = `Сервер перегружен\nПопробуйте через ${retry_after} сек.`
+            overlay("info-overlay").show()
         }
         return
     }
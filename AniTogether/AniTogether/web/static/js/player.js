@@ -200,8 +200,35 @@ var hoster = false
 var time_correction = 0
 lastRequest = 0
 
+// Синхронизация часов с сервером (как в NTP): серия запросов, из которой
+// берётся ответ с наименьшей задержкой, так как его задержка меньше всего
+// искажена очередями сети. Серия повторяется, чтобы учитывать уход часов.
+const CLOCK_SYNC_SAMPLES = 8
+const CLOCK_SYNC_SPACING = 100
+const CLOCK_RESYNC_INTERVAL = 60000
+var _clock_samples = []
+var _clock_timer = null
+// Завершена ли хотя бы одна серия
+var _clock_synced = false
+
+// Монотонные часы клиента в секундах, не зависят от перевода системных часов
+function clientNow() {
+    return (performance.timeOrigin + performance.now()) / 1000
+}
 function getTime() {
-    return utcNow() - time_correction
+    return clientNow() - time_correction
+}
+function syncClock() {
+    _clock_samples = []
+    clearTimeout(_clock_timer)
+    requestServerTime()
+}
+function requestServerTime() {
+    // Пока соединения нет, серия не продолжается,
+    // новая начнётся после подключения
+    if (websocket.readyState != WebSocket.OPEN)
+        return
+    sendWsRequest({"command": "server_time_request", "time": clientNow()})
 }
 function setMuteNewMembers(value) {
     mute_new_members = value
@@ -269,11 +296,14 @@ function synchronize() {
 var _seeking = false
 var _seeking_start = 0
 var _last_requests = {"play": 0, "seek": 0, "pause": 0}
+// Сервер сам объединяет частые события воспроизведения,
+// поэтому задержка нужна только, чтобы не слать каждый кадр перемотки
+const PLAYING_STATUS_DEBOUNCE = 200
 async function sendPlayingStatus(command, data) {
     let now = Date.now()
-    if (now - _last_requests[command] < 2000) {
+    if (now - _last_requests[command] < PLAYING_STATUS_DEBOUNCE) {
         _last_requests[command] = now
-        await delay(2000);
+        await delay(PLAYING_STATUS_DEBOUNCE);
         if (now != _last_requests[command]) return
     }
 
@@ -285,7 +315,7 @@ async function sendPlayingStatus(command, data) {
 player.on("pause", function () {
     console.log("paused")
     if (hoster)
-      sendPlayingStatus("pause", {})
+      sendPlayingStatus("pause", {"time": getTime(), "playback_time": player.currentTime()})
 })
 player.on("playing", function(value) {
     _seeking = false
@@ -315,26 +345,46 @@ player.on("waiting", function(value) {
     if (_seeking) return
     console.log("waiting")
     if (hoster) {
-        sendPlayingStatus("pause", {})
+        sendPlayingStatus("pause", {"time": getTime(), "playback_time": player.currentTime()})
     } else {
         _seeking_start = Date.now()
     }
 })
 
 var websocket
+// Токен для возвращения на своё место в комнате после переподключения
+// и номер последнего полученного события комнаты
+var resume_token = null
+var last_seq = 0
+// Задержка (в мс) перед переподключением
+var reconnect_delay = 1000
 
 function connectWs() {
-    console.log("Connecting Ws. ", getWsHost(host))
-    websocket = new WebSocket(getWsHost(host))
+    // По комнате в адресе сервер сразу направляет соединение в процесс комнаты
+    let url = `${getWsHost(host)}/?room_id=${encodeURIComponent(room_id)}`
+    console.log("Connecting Ws. ", url)
+    websocket = new WebSocket(url)
     websocket.onmessage = WsMessageHandler
     websocket.onclose = onWsCloseHandler
     websocket.addEventListener("open", () => {
-        sendWsRequest({"command": "join", "room_id": room_id})
+        // batch - сервер может присылать несколько событий одним массивом
+        let request = {"command": "join", "room_id": room_id, "batch": true}
+        if (resume_token) {
+            request["token"] = resume_token
+            request["last_seq"] = last_seq
+        }
+        sendWsRequest(request)
+        // Запросы времени сервер обработает после join
+        syncClock()
     });
 }
 async function onWsCloseHandler(event) {
     console.log("Ws connection closed. ", event.reason)
-    await delay(1000)
+    // Иначе запросы времени переподключались бы раньше reconnect_delay
+    clearTimeout(_clock_timer)
+    _clock_samples = []
+    await delay(reconnect_delay)
+    reconnect_delay = 1000
     connectWs()
 }
 function sendWsRequest(data) {
@@ -347,8 +397,14 @@ function sendWsRequest(data) {
 }
 
 function WsMessageHandler({data}) {
-    const event = JSON.parse(data)
+    const message = JSON.parse(data)
+    for (const event of Array.isArray(message) ? message : [message])
+        handleEvent(event)
+}
+function handleEvent(event) {
     console.log(event)
+    if (event.type != "init" && event.seq)
+        last_seq = event.seq
     switch (event.type) {
         case "init":
           onInit(event)
@@ -357,7 +413,7 @@ function WsMessageHandler({data}) {
           onJoin(event)
           break
         case "pause":
-          onPause()
+          onPause(event)
           break
         case "play":
           onPlay(event)
@@ -389,6 +445,9 @@ function WsMessageHandler({data}) {
         case "server_time_request_answer":
           onServerTimeRequestAnswer(event)
           break
+        case "reconnect":
+          onReconnect(event)
+          break
         case "error":
           onError(event)
           break
@@ -397,13 +456,24 @@ function WsMessageHandler({data}) {
     }
 }
 function onInit(data) {
-    sendWsRequest({"command": "server_time_request", "time": utcNow()})
+    resume_token = data.token
+    if (data.resumed) {
+        // Место в комнате сохранилось, пропущенные события придут следом
+        if (!hoster && me == data.members[0])
+            onHosterPromotion()
+        return
+    }
+    last_seq = data.seq
 
+    // При повторном подключении без сохранённого места список строится заново
+    document.getElementById("members-list").innerHTML = ""
+    let previous_members = members
+    members = {}
     for (member of data.members) {
-        members[member] = mute_new_members
+        members[member] = previous_members[member] ?? mute_new_members
     }
     me = data.me
-    hoster = me == members[0]
+    hoster = me == data.members[0]
 
     document.getElementById("room-id").innerHTML = room_id
     for (member of Object.keys(members)) {
@@ -415,21 +485,31 @@ function onInit(data) {
         history.pushState({}, null, `/watch?title_id=${title.id}&episode=${episode}&room_id=${room_id}`)
         playlistButton.show()
         roomButton.show()
+        synchronizeButton.hide()
+        pauseRequestButton.hide()
+        rewindRequestButton.hide()
     } else {
         sendWsRequest({"command": "playback_time_request"})
+        playlistButton.hide()
+        roomButton.hide()
         synchronizeButton.show()
         pauseRequestButton.show()
         rewindRequestButton.show()
     }
 
-    document.getElementById("room-loading").remove()
+    loading = document.getElementById("room-loading")
+    if (loading)
+        loading.remove()
 }
 function onJoin(data) {
     members[data.user_id] = mute_new_members
     addMemberElement(data.user_id)
 }
-function onPause() {
+function onPause(data) {
     player.pause()
+    // В паузу могла объединиться перемотка хостера
+    if (data.playback_time != null)
+        player.currentTime(data.playback_time)
 }
 function onPlay(data) {
     cur_time = getTime()
@@ -470,6 +550,7 @@ function onPlaybackTimeRequestAnswer(data) {
 }
 function onLeaveRoom(data) {
     user_id = data.user_id
+    delete members[user_id]
     elem = document.querySelector(`.room-member[data-user-id='${user_id}']`)
     if (elem)
         elem.remove()
@@ -492,15 +573,39 @@ function onRewindRequest(data) {
         addRewindRequestCard(data.sender)
 }
 function onServerTimeRequestAnswer(data) {
-    client_time = data.client_time
-    client_now = utcNow()
-    requests_delay = (client_now - client_time) / 2
-    server_time = data.server_time + requests_delay
-    time_correction = (client_now - server_time).toFixed(2)
+    let client_now = clientNow()
+    let receive_time = data.receive_time ?? data.server_time
+    let transmit_time = data.transmit_time ?? data.server_time
+    // Время в сети без времени обработки на сервере
+    let round_trip = (client_now - data.client_time) - (transmit_time - receive_time)
+    let offset = ((receive_time - data.client_time) + (transmit_time - client_now)) / 2
+    _clock_samples.push({"round_trip": round_trip, "offset": offset})
+    let best = _clock_samples.reduce((a, b) => a.round_trip <= b.round_trip ? a : b)
+    if (_clock_samples.length < CLOCK_SYNC_SAMPLES) {
+        // До конца первой серии используется лучший из полученных ответов,
+        // иначе позиция при входе в комнату считалась бы без поправки
+        if (!_clock_synced)
+            time_correction = -best.offset
+        _clock_timer = setTimeout(requestServerTime, CLOCK_SYNC_SPACING)
+        return
+    }
+    time_correction = -best.offset
+    _clock_synced = true
+    _clock_samples = []
+    _clock_timer = setTimeout(syncClock, CLOCK_RESYNC_INTERVAL)
+}
+function onReconnect(data) {
+    // Сервер перезапускается, комнату примет следующий процесс
+    reconnect_delay = data.delay * 1000
+    websocket.close()
 }
 function onError(data) {
     if (data.code == 1)  // Room does not exist
         window.open('/','_self')
+    else if (data.code == 7)  // Server is restarting
+        reconnect_delay = 1000 + Math.random() * 4000
+    else if (data.code == 8)  // Server is overloaded
+        reconnect_delay = data.retry_after * 1000
 }
 
 function init() {
@@ -0,0 +1,64 @@
+"""
+
+Отказ в подключении к комнатам и создании комнат, когда сервер перегружен.
+
+"""
+
+from __future__ import annotations
+
+import os
+import random
+
+import metrics
+from exceptions import ServerIsOverloaded
+
+
+# Задержка цикла событий (в секундах), при которой новые участники
+# не принимаются. 0 - не учитывать
+ADMISSION_LOOP_LAG = float(os.environ.get("ADMISSION_LOOP_LAG", "0.1"))
+# Максимальное количество открытых соединений. 0 - без ограничения
+MAX_CONNECTIONS = int(os.environ.get("MAX_CONNECTIONS", "0"))
+# Количество сообщений в очередях отправки клиентов,
+# при котором новые участники не принимаются. 0 - не учитывать
+ADMISSION_SEND_QUEUE = int(os.environ.get("ADMISSION_SEND_QUEUE", "10000"))
+# Минимальное время (в секундах), через которое клиенту стоит повторить попытку.
+# Клиентам сообщается случайное время до двойного, чтобы они не вернулись разом
+RETRY_AFTER = float(os.environ.get("RETRY_AFTER", "5"))
+
+
+def overload_reason(new_connections: int = 1) -> str | None:
+    """
+    :param new_connections: Сколько соединений ещё добавит запрос.
+        Соединение участника, подключающегося к комнате, уже учтено.
+    :returns: Признак перегрузки сервера или None, если сервер не перегружен.
+    """
+    if 0 < ADMISSION_LOOP_LAG < metrics.LOOP_LAG_LAST.value:
+        return "loop_lag"
+    if 0 < MAX_CONNECTIONS < metrics.CONNECTIONS.value + new_connections:
+        return "connections"
+    if 0 < ADMISSION_SEND_QUEUE < metrics.SEND_QUEUE_DEPTH.value:
+        return "send_queue"
+    return None
+
+
+def shed(request: str, reason: str) -> ServerIsOverloaded:
+    """
+    Учитывает отказ в запросе.
+    :param request: Вид запроса для метрик: join или create_room.
+    :param reason: Признак перегрузки из overload_reason.
+    :returns: Ошибка для клиента.
+    """
+    metrics.REQUESTS_SHED[(request, reason)] += 1
+    return ServerIsOverloaded(round(random.uniform(RETRY_AFTER, 2 * RETRY_AFTER), 1))
+
+
+def admit(request: str) -> None:
+    """
+    Проверяет, может ли сервер принять нового участника комнаты.
+    :raises: ServerIsOverloaded
+    """
+    if reason := overload_reason(new_connections=0):
+        raise shed(request, reason)
+
+
+__all__ = ["overload_reason", "shed", "admit"]
@@ -0,0 +1,211 @@
+"""
+
+Шина событий комнат.
+
+Все рассылки участникам комнаты проходят через шину.
+InMemoryBus доставляет события только участникам текущего процесса,
+RedisBus дополнительно пересылает их через Redis pub/sub другим серверам,
+у которых есть участники этой комнаты.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import secrets
+import typing as ty
+from urllib.parse import urlparse
+
+from loguru import logger
+
+
+if ty.TYPE_CHECKING:
+    from uuid import UUID
+
+    from rooms import ROOM_ID
+
+    # Доставка события участникам комнаты в текущем процессе.
+    # Третий аргумент - идентификатор websocket, которому событие не отправляется.
+    DELIVER = ty.Callable[[ROOM_ID, dict, ty.Optional[UUID]], None]
+
+
+class RoomBus:
+    def __init__(self, deliver: DELIVER):
+        self.deliver = deliver
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    def subscribe(self, room_id: ROOM_ID) -> None:
+        """
+        Вызывается, когда к комнате подключается участник из этого процесса.
+        Повторные вызовы для той же комнаты ничего не делают.
+        """
+
+    def unsubscribe(self, room_id: ROOM_ID) -> None:
+        """
+        Вызывается, когда из комнаты ушёл последний участник из этого процесса.
+        """
+
+    def publish(self, room_id: ROOM_ID, event: dict, exclude: UUID | None) -> None:
+        raise NotImplementedError()
+
+
+class InMemoryBus(RoomBus):
+    def publish(self, room_id: ROOM_ID, event: dict, exclude: UUID | None) -> None:
+        self.deliver(room_id, event, exclude)
+
+
+class RedisBus(RoomBus):
+    """
+    Шина поверх Redis pub/sub.
+    Каждая комната - отдельный канал. Участникам текущего процесса событие
+    доставляется сразу, а свои же сообщения из Redis игнорируются.
+    """
+
+    def __init__(self, deliver: DELIVER, url: str):
+        super().__init__(deliver)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.prefix = parsed.path.strip("/") + ":" if parsed.path.strip("/") else ""
+        self.node_id = secrets.token_hex(8)
+        self.channels: set[bytes] = set()
+        self._publisher: asyncio.StreamWriter | None = None
+        self._subscriber: asyncio.StreamWriter | None = None
+        self._tasks: list[asyncio.Task] = []
+
+    def channel(self, room_id: ROOM_ID) -> bytes:
+        return f"{self.prefix}room:{room_id}".encode()
+
+    async def start(self) -> None:
+        await self._connect_publisher()
+        await self._connect_subscriber()
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for writer in (self._publisher, self._subscriber):
+            if writer:
+                writer.close()
+
+    async def _connect_publisher(self) -> None:
+        reader, self._publisher = await asyncio.open_connection(self.host, self.port)
+        self._tasks.append(asyncio.create_task(self._read_replies(reader)))
+
+    async def _connect_subscriber(self) -> None:
+        reader, self._subscriber = await asyncio.open_connection(self.host, self.port)
+        if self.channels:
+            self._subscriber.write(encode_command(b"SUBSCRIBE", *self.channels))
+        self._tasks.append(asyncio.create_task(self._read_messages(reader)))
+
+    async def _read_replies(self, reader: asyncio.StreamReader) -> None:
+        # Ответы на PUBLISH не нужны, но их нужно вычитывать
+        try:
+            while True:
+                reply = await read_reply(reader)
+                if isinstance(reply, RedisError):
+                    logger.error("Redis bus error: {}", reply)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.error("Redis bus publisher disconnected, reconnecting")
+            await self._reconnect(self._connect_publisher)
+
+    async def _read_messages(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                message = await read_reply(reader)
+                if not isinstance(message, list) or message[0] != b"message":
+                    continue
+                data = json.loads(message[2])
+                if data["node"] != self.node_id:
+                    room_id = message[1].decode()[len(self.prefix) + len("room:") :]
+                    self.deliver(room_id, data["event"], None)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.error("Redis bus subscriber disconnected, reconnecting")
+            await self._reconnect(self._connect_subscriber)
+
+    @staticmethod
+    async def _reconnect(connect: ty.Callable[[], ty.Awaitable[None]]) -> None:
+        while True:
+            await asyncio.sleep(1)
+            try:
+                return await connect()
+            except OSError:
+                pass
+
+    def subscribe(self, room_id: ROOM_ID) -> None:
+        if (channel := self.channel(room_id)) in self.channels:
+            return
+        self.channels.add(channel)
+        if self._subscriber:
+            self._subscriber.write(encode_command(b"SUBSCRIBE", channel))
+
+    def unsubscribe(self, room_id: ROOM_ID) -> None:
+        channel = self.channel(room_id)
+        self.channels.discard(channel)
+        if self._subscriber:
+            self._subscriber.write(encode_command(b"UNSUBSCRIBE", channel))
+
+    def publish(self, room_id: ROOM_ID, event: dict, exclude: UUID | None) -> None:
+        self.deliver(room_id, event, exclude)
+        if self._publisher:
+            payload = json.dumps(dict(node=self.node_id, event=event)).encode()
+            self._publisher.write(
+                encode_command(b"PUBLISH", self.channel(room_id), payload)
+            )
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*args: bytes) -> bytes:
+    """
+    Кодирует команду Redis в формате RESP.
+    """
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> ty.Any:
+    """
+    Читает ответ Redis в формате RESP.
+    """
+    line = await reader.readuntil(b"\r\n")
+    kind, value = line[:1], line[1:-2]
+    if kind == b"+":
+        return value
+    elif kind == b"-":
+        return RedisError(value.decode())
+    elif kind == b":":
+        return int(value)
+    elif kind == b"$":
+        if (length := int(value)) == -1:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    elif kind == b"*":
+        if (length := int(value)) == -1:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Unexpected RESP reply: {line!r}")
+
+
+def create_bus(deliver: DELIVER) -> RoomBus:
+    """
+    Создаёт шину, указанную в переменной окружения ROOM_BUS.
+    "memory" (по умолчанию) или "redis://host:port[/prefix]".
+    """
+    url = os.environ.get("ROOM_BUS", "memory")
+    if url.startswith("redis://"):
+        return RedisBus(deliver, url)
+    return InMemoryBus(deliver)
+
+
+__all__ = ["RoomBus", "InMemoryBus", "RedisBus", "create_bus"]
@@ -0,0 +1,29 @@
+"""
+
+Часы сервера.
+Клиенты синхронизируют с ними своё время (server_time_request),
+поэтому все метки времени в протоколе указаны в этой шкале.
+
+Время отсчитывается монотонными часами от момента запуска процесса,
+поэтому перевод системных часов (NTP, ручная настройка)
+не вызывает скачков времени в комнатах.
+Точка отсчёта берётся из системных часов, чтобы метки времени
+разных процессов и снимков комнат совпадали.
+
+"""
+
+import time
+
+
+_EPOCH = time.time()
+_MONOTONIC_EPOCH = time.monotonic()
+
+
+def now() -> float:
+    """
+    Возвращает текущее время сервера в секундах (Unix time).
+    """
+    return _EPOCH + (time.monotonic() - _MONOTONIC_EPOCH)
+
+
+__all__ = ["now"]
@@ -0,0 +1,157 @@
+"""
+
+Настройки websocket соединений с клиентами.
+
+Большинство клиентов - зрители, которые почти ничего не отправляют
+и получают редкие маленькие события, поэтому память сервера
+в основном уходит на буферы и контексты сжатия соединений.
+Профиль CONNECTION_PROFILE задаёт эти настройки:
+
+- library - значения по умолчанию библиотеки websockets
+  (сжатие каждого сообщения, кадры до 1 MiB);
+- lean - без сжатия, с небольшими лимитами кадров и очередей;
+- adaptive - как lean, но сообщения от COMPRESSION_MIN_SIZE байт сжимаются.
+  Контекст сжатия не хранится между сообщениями.
+
+Во всех профилях, кроме library, мёртвые соединения отключаются,
+если не отвечают на ping в течение PING_TIMEOUT.
+
+"""
+
+from __future__ import annotations
+
+import functools
+import os
+import typing as ty
+
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+    enable_server_permessage_deflate,
+)
+from websockets.frames import OP_BINARY, OP_TEXT
+from websockets.legacy.server import WebSocketServerProtocol
+
+
+if ty.TYPE_CHECKING:
+    from websockets.frames import Frame
+    from websockets.legacy.server import WebSocketServer
+
+
+# Профиль настроек соединений: library, lean или adaptive
+CONNECTION_PROFILE = os.environ.get("CONNECTION_PROFILE", "lean")
+# Максимальный размер входящего сообщения (в байтах)
+MAX_FRAME_SIZE = int(os.environ.get("MAX_FRAME_SIZE", "16384"))
+# Период (в секундах) проверки соединения ping и время ожидания ответа
+PING_INTERVAL = float(os.environ.get("PING_INTERVAL", "20"))
+PING_TIMEOUT = float(os.environ.get("PING_TIMEOUT", "20"))
+# Минимальный размер сообщения (в байтах), которое сжимается в профиле adaptive
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", "1024"))
+# Максимальное время (в секундах) открытия соединения, включая ответ на HTTP запрос
+OPEN_TIMEOUT = float(os.environ.get("OPEN_TIMEOUT", "10"))
+
+
+class AdaptivePerMessageDeflate(PerMessageDeflate):
+    """
+    permessage-deflate, который не сжимает маленькие сообщения.
+    RFC 7692 разрешает отправлять часть сообщений без сжатия.
+    """
+
+    def encode(self, frame: Frame) -> Frame:
+        if (
+            frame.opcode in (OP_TEXT, OP_BINARY)
+            and frame.fin
+            and len(frame.data) < COMPRESSION_MIN_SIZE
+        ):
+            return frame
+        return super().encode(frame)
+
+
+class AdaptiveDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(
+            params, accepted_extensions
+        )
+        return response_params, AdaptivePerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            self.compress_settings,
+        )
+
+
+def _lean() -> dict[str, ty.Any]:
+    return dict(
+        compression=None,
+        max_size=MAX_FRAME_SIZE,
+        max_queue=4,
+        read_limit=2**12,
+        ping_interval=PING_INTERVAL,
+        ping_timeout=PING_TIMEOUT,
+    )
+
+
+def _adaptive() -> dict[str, ty.Any]:
+    return dict(
+        _lean(),
+        extensions=[
+            AdaptiveDeflateFactory(
+                # Контексты сжатия создаются только на время обработки сообщения
+                server_no_context_takeover=True,
+                client_no_context_takeover=True,
+                server_max_window_bits=10,
+                client_max_window_bits=10,
+                compress_settings={"memLevel": 4},
+            )
+        ],
+    )
+
+
+PROFILES: dict[str, ty.Callable[[], dict[str, ty.Any]]] = {
+    "library": dict,
+    "lean": _lean,
+    "adaptive": _adaptive,
+}
+
+
+def serve_settings(profile: str = CONNECTION_PROFILE) -> dict[str, ty.Any]:
+    """
+    Возвращает аргументы websockets.serve для профиля соединений.
+    """
+    if profile not in PROFILES:
+        raise ValueError(
+            f"Unknown connection profile `{profile}`. it can be {list(PROFILES)}"
+        )
+    settings = PROFILES[profile]()
+    settings["open_timeout"] = OPEN_TIMEOUT
+    return settings
+
+
+def protocol_factory(
+    ws_handler: ty.Callable[[WebSocketServerProtocol], ty.Awaitable[None]],
+    ws_server: WebSocketServer,
+    create_protocol: type[WebSocketServerProtocol] = WebSocketServerProtocol,
+    compression: str | None = "deflate",
+    **kwargs: ty.Any,
+) -> ty.Callable[..., WebSocketServerProtocol]:
+    """
+    Возвращает фабрику протоколов, как у websockets.serve, для соединений,
+    принятых не сервером `ws_server` (loop.connect_accepted_socket).
+    :param kwargs: Аргументы websockets.serve, которые передаются в протокол:
+        serve_settings, process_request и т.п.
+    """
+    if compression == "deflate":
+        kwargs["extensions"] = enable_server_permessage_deflate(
+            kwargs.get("extensions")
+        )
+    return functools.partial(create_protocol, ws_handler, ws_server, **kwargs)
+
+
+__all__ = [
+    "CONNECTION_PROFILE",
+    "OPEN_TIMEOUT",
+    "PROFILES",
+    "serve_settings",
+    "protocol_factory",
+]
@@ -0,0 +1,78 @@
+"""
+
+Плавное завершение процесса по SIGTERM для перезапуска без простоя.
+
+Новый процесс занимает порт, как только старый перестанет его слушать.
+С REUSE_PORT=1 новый процесс можно запустить раньше, но ядро будет делить
+подключения между процессами, поэтому до передачи комнат новый процесс
+отклоняет подключения к комнатам, которых у него нет, и создание комнат.
+По умолчанию REUSE_PORT выключен, чтобы случайно запущенный второй
+экземпляр сервера завершался с ошибкой, а не делил подключения с первым.
+Старый процесс по SIGTERM:
+
+1. перестаёт принимать подключения и отклоняет новые join;
+2. записывает комнаты в файл снимка и освобождает его. Новый процесс
+   ждёт этого и только потом восстанавливает комнаты (snapshots.acquire);
+3. просит клиентов переподключиться со случайной задержкой,
+   чтобы они не пришли к новому процессу одновременно;
+4. ждёт, пока клиенты отключатся, но не дольше DRAIN_TIMEOUT.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import random
+import socket
+import typing as ty
+
+import metrics
+
+
+if ty.TYPE_CHECKING:
+    from websockets.legacy.server import WebSocketServer
+
+
+# Максимальное время (в секундах) ожидания отключения клиентов
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "30"))
+# Максимальная задержка (в секундах) переподключения клиентов
+RECONNECT_DELAY = float(os.environ.get("RECONNECT_DELAY", "10"))
+# Разрешить нескольким процессам слушать один порт
+REUSE_PORT = (
+    os.environ.get("REUSE_PORT", "0") == "1" and hasattr(socket, "SO_REUSEPORT")
+)
+
+DRAINING = False
+
+
+def start(server: WebSocketServer) -> None:
+    """
+    Закрывает слушающие сокеты, оставляя открытыми текущие соединения.
+    """
+    global DRAINING
+    DRAINING = True
+    server.server.close()
+
+
+def reconnect_delay() -> float:
+    return round(random.uniform(0, RECONNECT_DELAY), 2)
+
+
+async def wait_for_clients(timeout: float = DRAIN_TIMEOUT) -> None:
+    """
+    Ждёт, пока все клиенты отключатся.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while metrics.CONNECTIONS.value > 0 and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+
+
+__all__ = [
+    "DRAIN_TIMEOUT",
+    "REUSE_PORT",
+    "start",
+    "reconnect_delay",
+    "wait_for_clients",
+]
@@ -1,6 +1,8 @@
 class AniTogetherError(Exception):
     code: int
     message: str
+    # Через сколько секунд клиенту стоит повторить запрос
+    retry_after: float | None = None
 
     def __init__(self):
         super().__init__(f"[{self.code}] {self.message}")
@@ -39,3 +41,27 @@ class ParamNotPassed(AniTogetherError):
 class NotCompatibleVersion(AniTogetherError):
     code = 6
     message = "Your version is not supported"
+
+
+class ServerIsShuttingDown(AniTogetherError):
+    code = 7
+    message = "Server is restarting, try again later"
+
+
+class ServerIsOverloaded(AniTogetherError):
+    code = 8
+    message = "Server is overloaded, try again later"
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__()
+
+
+class InvalidParam(AniTogetherError):
+    code = 9
+    message = "{param_name} has invalid type"
+
+    def __init__(self, param_name: str):
+        self.param_name = param_name
+        self.message = self.message.format(param_name=param_name)
+        super().__init__()
@@ -1,17 +1,24 @@
 from __future__ import annotations
 
 import http
+import inspect
 import json
 import os
-import re
+import secrets
 import typing as ty
 from functools import wraps
+from urllib.parse import parse_qsl
 from loguru import logger
 
+import admission
+import drain
+import metrics
+import profiler
 import rooms
+import snapshots
 from exceptions import ParamNotPassed, RoomDoesNotExists, UnknownCommand, \
-    NotCompatibleVersion
-from version import Version
+    NotCompatibleVersion, ServerIsShuttingDown
+from version import Version, parse_version
 
 
 if ty.TYPE_CHECKING:
@@ -24,18 +31,82 @@ COMPATIBLE_VERSION = Version.from_str(os.environ["COMPATIBLE_VERSION"])
 
 
 async def http_handler(path: str, _request_headers):
-    if path == "/healthz":
+    route, _, query = path.partition("?")
+    if handler := ROUTES.get(route):
+        result = handler(parse_args(query))
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+    if _request_headers["Connection"] != "Upgrade":
+        return error(UnknownCommand())
+
+
+def healthz(_data: dict) -> ANSWER:
+    return (
+        http.HTTPStatus.OK,
+        {"Access-Control-Allow-Origin": "*"},
+        b"OK\n",
+    )
+
+
+def metrics_page(_data: dict) -> ANSWER:
+    return (
+        http.HTTPStatus.OK,
+        {"Content-Type": "text/plain; version=0.0.4"},
+        metrics.render().encode(),
+    )
+
+
+def profile(data: dict) -> ANSWER:
+    """
+    Запускает профилирование цикла событий в течение `seconds` секунд.
+    Результат возвращает profile_result.
+    Доступно только с токеном ADMIN_TOKEN.
+    """
+    if denied := check_admin_token(data):
+        return denied
+    try:
+        seconds = float(data.get("seconds", 10))
+    except ValueError:
+        return http.HTTPStatus.BAD_REQUEST, {}, b"Invalid seconds\n"
+    if not 0 < seconds <= profiler.PROFILE_MAX_SECONDS:
         return (
-            http.HTTPStatus.OK,
-            {"Access-Control-Allow-Origin": "*"},
-            b"OK\n",
+            http.HTTPStatus.BAD_REQUEST,
+            {},
+            f"seconds must be in (0, {profiler.PROFILE_MAX_SECONDS:g}]\n".encode(),
         )
-    elif check_command("create_room", path):
-        return create_room(parse_args(path))
-    elif check_command("get_room", path):
-        return get_room(parse_args(path))
-    if _request_headers["Connection"] != "Upgrade":
+
+    if not profiler.start(seconds):
+        return http.HTTPStatus.CONFLICT, {}, b"Profiling is already running\n"
+    logger.info("Profiling event loop for {}s", seconds)
+    return http.HTTPStatus.ACCEPTED, {}, b"Profiling started\n"
+
+
+def profile_result(data: dict) -> ANSWER:
+    """
+    Возвращает результат последнего профилирования.
+    Доступно только с токеном ADMIN_TOKEN.
+    """
+    if denied := check_admin_token(data):
+        return denied
+    if profiler.running():
+        return http.HTTPStatus.ACCEPTED, {}, b"Profiling is running\n"
+    if (stacks := profiler.result()) is None:
+        return http.HTTPStatus.NOT_FOUND, {}, b"No profile\n"
+    return http.HTTPStatus.OK, {"Content-Type": "text/plain"}, stacks.encode()
+
+
+def check_admin_token(data: dict) -> ANSWER | None:
+    """
+    :returns: Ответ, если отладочные маршруты выключены или токен неверный.
+    """
+    if not profiler.ADMIN_TOKEN:
         return error(UnknownCommand())
+    if not secrets.compare_digest(
+        str(data.get("token", "")).encode(), profiler.ADMIN_TOKEN.encode()
+    ):
+        return http.HTTPStatus.FORBIDDEN, {}, b"Forbidden\n"
+    return None
 
 
 def check_version(fn):
@@ -43,10 +114,10 @@ def check_version(fn):
     def _wrapper(data: dict) -> ANSWER:
         try:
             version = data.get("version")
-            if Version.from_str(version) < COMPATIBLE_VERSION:
+            if parse_version(version) < COMPATIBLE_VERSION:
                 raise ValueError("")
         except (ValueError, TypeError) as err:
-            logger.debug(f"Request from not compatible version: {version}")
+            logger.debug("Request from not compatible version: {}", version)
             return error(NotCompatibleVersion())
 
         return fn(data)
@@ -60,6 +131,10 @@ def create_room(data: dict) -> ANSWER:
         return error(ParamNotPassed("title_id"))
     elif (episode := data.get("episode")) is None:
         return error(ParamNotPassed("episode"))
+    elif drain.DRAINING or snapshots.handoff_pending():
+        return error(ServerIsShuttingDown())
+    elif reason := admission.overload_reason():
+        return error(admission.shed("create_room", reason))
 
     room_id = rooms.create_room(title_id, episode)
     return answer(room_id=room_id, title_id=title_id, episode=episode)
@@ -69,6 +144,8 @@ def create_room(data: dict) -> ANSWER:
 def get_room(data: dict) -> ANSWER:
     if (room_id := data.get("room_id")) is None:
         return error(ParamNotPassed("room_id"))
+    if room_id not in rooms.ROOMS and snapshots.handoff_pending():
+        return error(ServerIsShuttingDown())
 
     try:
         room = rooms.get_room(room_id)
@@ -77,27 +154,54 @@ def get_room(data: dict) -> ANSWER:
         return error(err)
 
 
-def answer(*, status: ty.Literal["ok", "fail"] = "ok", **data: ty.Any) -> ANSWER:
+def answer(
+    *,
+    status: ty.Literal["ok", "fail"] = "ok",
+    http_status: http.HTTPStatus = http.HTTPStatus.OK,
+    **data: ty.Any,
+) -> ANSWER:
     return (
-        http.HTTPStatus.OK,
+        http_status,
         {"Access-Control-Allow-Origin": "*"},
         json.dumps(dict(status=status, **data)).encode(),
     )
 
 
-def error(exc: AniTogetherError) -> ANSWER:
-    return answer(status="fail", code=exc.code, message=exc.message)
-
-
-def check_command(command: str, path: str) -> bool:
-    return bool(re.fullmatch(rf"/{command}\?.+", path))
+def error(
+    exc: AniTogetherError, http_status: http.HTTPStatus = http.HTTPStatus.OK
+) -> ANSWER:
+    metrics.ERRORS[exc.code] += 1
+    if exc.retry_after is not None:
+        return answer(
+            status="fail",
+            http_status=http_status,
+            code=exc.code,
+            message=exc.message,
+            retry_after=exc.retry_after,
+        )
+    return answer(
+        status="fail", http_status=http_status, code=exc.code, message=exc.message
+    )
 
 
-def parse_args(path: str) -> dict:
+def parse_args(query: str) -> dict:
+    """
+    Разбирает строку запроса. Числовые значения преобразуются в int.
+    """
     args = {}
-    for match in re.finditer(r"(.+?)=(.+?)(&|$)", path.split("?", maxsplit=1)[1]):
-        value = match.group(2)
-        if value.isdigit():
+    for key, value in parse_qsl(query):
+        if value.isascii() and value.isdigit():
             value = int(value)
-        args[match.group(1)] = value
+        args[key] = value
     return args
+
+
+# Обработчики HTTP запросов по пути
+ROUTES: dict[str, ty.Callable[[dict], ANSWER | ty.Awaitable[ANSWER]]] = {
+    "/healthz": healthz,
+    "/metrics": metrics_page,
+    "/debug/profile": profile,
+    "/debug/profile/result": profile_result,
+    "/create_room": create_room,
+    "/get_room": get_room,
+}
@@ -0,0 +1,146 @@
+"""
+
+Очередь команд комнаты.
+
+Команды участников комнаты выполняются по одной в порядке поступления
+отдельной задачей комнаты, поэтому обработчики одной комнаты
+не чередуются в точках await. Например, перемотка хостера всегда
+обрабатывается до его выхода из комнаты, если пришла раньше.
+
+Если команды комнаты сейчас не выполняются, команда выполняется сразу
+в задаче соединения, без переключения на задачу комнаты.
+Задача комнаты существует, только пока в очереди есть команды.
+Команды, накопившиеся в очереди, выполняются за один проход,
+после которого их события рассылаются участникам вместе (after_pass).
+Соединение, команда которого не помещается в очередь,
+ждёт и не читает следующие кадры.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import typing as ty
+from collections import deque
+from time import perf_counter
+
+import websockets
+from loguru import logger
+
+import metrics
+import tracing
+
+
+# Максимальное количество команд в очереди комнаты
+ROOM_INBOX_SIZE = int(os.environ.get("ROOM_INBOX_SIZE", "256"))
+
+
+class Inbox:
+    __slots__ = ("queue", "_running", "_task", "_space", "_after_pass")
+
+    def __init__(self):
+        self.queue: deque[
+            tuple[float, ty.Callable[..., ty.Awaitable[None]], tuple]
+        ] = deque()
+        # Выполняется ли сейчас команда вне задачи комнаты
+        self._running = False
+        self._task: asyncio.Task | None = None
+        # Ожидание свободного места в очереди
+        self._space: asyncio.Future | None = None
+        self._after_pass: list[tuple[ty.Callable[..., None], tuple]] = []
+
+    def __len__(self) -> int:
+        return len(self.queue)
+
+    @property
+    def busy(self) -> bool:
+        """
+        Выполняются ли сейчас команды комнаты.
+        """
+        return self._running or self._task is not None
+
+    def after_pass(self, callback: ty.Callable[..., None], *args: ty.Any) -> None:
+        """
+        Вызывает `callback(*args)` по окончании текущего прохода по очереди.
+        """
+        self._after_pass.append((callback, args))
+
+    async def submit(
+        self, handler: ty.Callable[..., ty.Awaitable[None]], *args: ty.Any
+    ) -> None:
+        """
+        Выполняет `handler(*args)` после команд, уже стоящих в очереди комнаты.
+        Ждёт, если очередь заполнена.
+        """
+        if self._task is None and not self._running:
+            self._running = True
+            try:
+                await self._call(perf_counter(), handler, args)
+            finally:
+                self._running = False
+                self._end_pass()
+                # Команды, пришедшие во время выполнения
+                if self.queue:
+                    self._task = tracing.create_task(self._run())
+            return
+
+        while len(self.queue) >= ROOM_INBOX_SIZE:
+            if self._space is None:
+                self._space = asyncio.get_running_loop().create_future()
+            # Отмена одного ожидающего не должна отменять ожидание остальных
+            await asyncio.shield(self._space)
+        self.queue.append((perf_counter(), handler, args))
+        metrics.ROOM_INBOX_DEPTH.inc()
+        if self._task is None and not self._running:
+            self._task = tracing.create_task(self._run())
+
+    async def _call(
+        self,
+        submitted: float,
+        handler: ty.Callable[..., ty.Awaitable[None]],
+        args: tuple,
+    ) -> None:
+        metrics.ROOM_INBOX_WAIT.observe(perf_counter() - submitted)
+        try:
+            await handler(*args)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception:
+            logger.exception("Room command {} failed", handler.__name__)
+
+    async def _run(self) -> None:
+        try:
+            while self.queue:
+                # Команды, пришедшие во время прохода, ждут следующего,
+                # чтобы события текущего прохода были разосланы
+                for _ in range(len(self.queue)):
+                    submitted, handler, args = self.queue.popleft()
+                    metrics.ROOM_INBOX_DEPTH.dec()
+                    if self._space is not None:
+                        self._space.set_result(None)
+                        self._space = None
+                    await self._call(submitted, handler, args)
+                self._end_pass()
+                if self.queue:
+                    await asyncio.sleep(0)
+        finally:
+            # Очередь не пуста, только если задача отменена при остановке сервера
+            metrics.ROOM_INBOX_DEPTH.dec(len(self.queue))
+            self.queue.clear()
+            if self._space is not None:
+                self._space.set_result(None)
+                self._space = None
+            self._task = None
+            self._end_pass()
+
+    def _end_pass(self) -> None:
+        callbacks, self._after_pass = self._after_pass, []
+        for callback, args in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Room inbox callback {} failed", callback.__name__)
+
+
+__all__ = ["Inbox", "ROOM_INBOX_SIZE"]
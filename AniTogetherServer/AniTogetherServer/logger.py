@@ -1,9 +1,18 @@
 import os
 
 import sys
+from collections import Counter
 from loguru import logger
 
 
+# Формат вывода: text или json (JSON lines для сборщиков логов)
+LOGGING_FORMAT = os.environ.get("LOGGING_FORMAT", "text")
+# Из частых событий (play, seek, pause) в лог пишется каждое LOGGING_SAMPLE-е
+LOGGING_SAMPLE = int(os.environ.get("LOGGING_SAMPLE", "1"))
+
+_serialize = LOGGING_FORMAT == "json"
+_sample_counters: Counter[str] = Counter()
+
 try:  # Удаление настроек логгера по умолчанию
     logger.remove(0)
 except ValueError:
@@ -19,16 +28,37 @@ def formatter(_) -> str:
     )
 
 
+# enqueue: запись выполняется в отдельном потоке и не блокирует цикл событий
 logger.add(
     sys.stdout,
-    colorize=True,
+    colorize=not _serialize,
+    serialize=_serialize,
     format=formatter,
     level=os.environ.get("LOGGING_LEVEL", "DEBUG"),
+    enqueue=True,
 )
 
 if loging_file := os.environ.get("LOGGING_FILE"):
-    logger.add(loging_file, colorize=False, format=formatter, level="DEBUG")
+    logger.add(
+        loging_file,
+        colorize=False,
+        serialize=_serialize,
+        format=formatter,
+        level="DEBUG",
+        enqueue=True,
+    )
 
 # Настройка цветов
 logger.level("INFO", color="<cyan><bold>")
 logger.level("TRACE", color="<lk>")
+
+
+def sampled(event: str) -> bool:
+    """
+    Нужно ли писать в лог очередное событие `event`.
+    Пишется первое и далее каждое LOGGING_SAMPLE-е.
+    """
+    if LOGGING_SAMPLE <= 1:
+        return True
+    _sample_counters[event] += 1
+    return _sample_counters[event] % LOGGING_SAMPLE == 1
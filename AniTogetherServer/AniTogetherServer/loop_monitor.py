@@ -0,0 +1,89 @@
+"""
+
+Измерение задержки цикла событий и выбор реализации цикла.
+
+Синхронизация воспроизведения зависит от того, насколько быстро сервер
+пересылает play/seek, поэтому задержки цикла сразу превращаются
+в рассинхронизацию у зрителей.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+from collections import deque
+
+from loguru import logger
+
+import metrics
+
+
+# Период измерения задержки (в секундах)
+LAG_SAMPLE_INTERVAL = float(os.environ.get("LAG_SAMPLE_INTERVAL", "0.5"))
+# Задержка (в секундах), при превышении которой пишется предупреждение
+LAG_WARNING_THRESHOLD = float(os.environ.get("LAG_WARNING_THRESHOLD", "0.1"))
+# Количество последних измерений, по которым считаются перцентили
+LAG_WINDOW = int(os.environ.get("LAG_WINDOW", "120"))
+# Реализация цикла событий: asyncio или uvloop
+EVENT_LOOP = os.environ.get("EVENT_LOOP", "asyncio")
+
+_samples: deque[float] = deque(maxlen=LAG_WINDOW)
+
+
+def install_event_loop() -> str:
+    """
+    Устанавливает реализацию цикла событий, выбранную в EVENT_LOOP.
+    Если uvloop не установлен, используется стандартный цикл.
+    :returns: Название используемой реализации.
+    """
+    if EVENT_LOOP == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("uvloop is not installed, using asyncio event loop")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return "uvloop"
+    return "asyncio"
+
+
+def percentile(q: float) -> float:
+    """
+    Возвращает перцентиль задержки по последним LAG_WINDOW измерениям.
+    """
+    if not _samples:
+        return 0.0
+    samples = sorted(_samples)
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+
+def observe(lag: float) -> None:
+    _samples.append(lag)
+    metrics.LOOP_LAG.observe(lag)
+    metrics.LOOP_LAG_LAST.set(lag)
+    metrics.LOOP_LAG_P50.set(percentile(0.5))
+    metrics.LOOP_LAG_P99.set(percentile(0.99))
+    if lag > metrics.LOOP_LAG_MAX.value:
+        metrics.LOOP_LAG_MAX.set(lag)
+    if lag > LAG_WARNING_THRESHOLD:
+        logger.warning(
+            "Event loop lag {:.1f}ms (p50={:.1f}ms, p99={:.1f}ms)",
+            lag * 1000,
+            metrics.LOOP_LAG_P50.value * 1000,
+            metrics.LOOP_LAG_P99.value * 1000,
+        )
+
+
+async def monitor(interval: float = LAG_SAMPLE_INTERVAL) -> None:
+    """
+    Измеряет, насколько позже срока срабатывает таймер цикла событий.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        observe(max(0.0, loop.time() - start - interval))
+
+
+__all__ = ["EVENT_LOOP", "install_event_loop", "percentile", "monitor"]
@@ -1,37 +1,117 @@
 import asyncio
 import os
 import signal
+from contextlib import suppress
 
 import websockets
 
+import connection
+import drain
+import loop_monitor
+import metrics
+import outbox
+import rooms
+import sharding
+import snapshots
+import tracing
 from logger import logger
-from ws_server import ws_handler
+from ws_server import BUS, SESSIONS, request_reconnect, ws_handler
 
 
 os.environ["COMPATIBLE_VERSION"] = '1.0.0-betta.4'
 
 
 from http_server import http_handler  # noqa
+import router  # noqa
 
 
 async def main():
     try:
         loop = asyncio.get_running_loop()
         stop = loop.create_future()
-        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        loop.add_signal_handler(signal.SIGTERM, request_stop, stop)
     except NotImplementedError:
         stop = asyncio.Future()
 
     port = int(os.environ.get("PORT", "8001"))
-    async with websockets.serve(ws_handler, "", port, process_request=http_handler):
-        logger.info("Server started")
+    if sharding.is_router():
+        async with router.serve(port):
+            logger.info(
+                "Router started with {} workers on {} event loop",
+                sharding.WORKERS,
+                loop_monitor.EVENT_LOOP,
+            )
+            await stop
+        return
+
+    # Если прежний процесс завершился, комнаты восстанавливаются до запуска
+    # сервера, иначе - когда он освободит файл снимка
+    await snapshots.try_acquire()
+    snapshotter = asyncio.create_task(snapshots.run())
+    reaper = asyncio.create_task(rooms.REAPER.run())
+    sessions = asyncio.create_task(SESSIONS.run())
+    lag_monitor = asyncio.create_task(loop_monitor.monitor())
+    await BUS.start()
+
+    # Обработчики шардов доступны только через маршрутизатор
+    host = "" if sharding.SHARD_ID is None else router.WORKER_HOST
+    settings = dict(
+        process_request=http_handler,
+        # Переполнение буфера отправки обрабатывает очередь клиента (outbox)
+        write_limit=outbox.SEND_BUFFER_LIMIT,
+        **connection.serve_settings(),
+    )
+    async with websockets.serve(
+        ws_handler,
+        host,
+        port,
+        # Следующий процесс запускается на том же порту до остановки текущего
+        reuse_port=drain.REUSE_PORT,
+        **settings,
+    ) as server:
+        # Соединения, которые маршрутизатор передаёт обработчику шарда
+        router.accept_handed_off(
+            connection.protocol_factory(
+                ws_handler,
+                server,
+                create_protocol=router.HandedOffProtocol,
+                **settings,
+            )
+        )
+        logger.info("Server started on {} event loop", loop_monitor.EVENT_LOOP)
         await stop  # Запуск бесконечного цикла
 
+        drain.start(server)
+        # Последний снимок освобождает файл для следующего процесса,
+        # поэтому комнаты больше не удаляются и не записываются
+        reaper.cancel()
+        sessions.cancel()
+        snapshotter.cancel()
+        with suppress(asyncio.CancelledError):
+            await snapshotter
+        if not snapshots.SNAPSHOT_FILE:
+            logger.warning("SNAPSHOT_FILE is not set, rooms will not be handed off")
+        request_reconnect()
+        logger.info("Draining {:g} connections", metrics.CONNECTIONS.value)
+        await drain.wait_for_clients()
+
+    await BUS.close()
+    lag_monitor.cancel()
+
+
+def request_stop(stop: asyncio.Future) -> None:
+    # SIGTERM может прийти повторно: от systemd всей группе процессов,
+    # а затем от маршрутизатора обработчику
+    if not stop.done():
+        stop.set_result(None)
+
 
 if __name__ == "__main__":
+    loop_monitor.EVENT_LOOP = loop_monitor.install_event_loop()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         pass
     finally:
+        tracing.close()
         logger.info("Server stopped")
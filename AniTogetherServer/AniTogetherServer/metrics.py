@@ -0,0 +1,293 @@
+"""
+
+Счётчики и гистограммы, которые обновляются на горячем пути сервера,
+и их вывод в текстовом формате Prometheus для /metrics.
+
+Значения обновляются в момент события, поэтому формирование ответа
+не обходит комнаты и не зависит от их количества.
+
+"""
+
+from __future__ import annotations
+
+import typing as ty
+from bisect import bisect_left
+from collections import Counter, defaultdict
+
+
+# Границы корзин гистограммы задержек (в секундах)
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1
+)
+# Границы корзин гистограммы количества участников комнаты
+ROOM_SIZE_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500, 1000, 5000)
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными границами корзин.
+    Наблюдение стоит одного бинарного поиска.
+    """
+
+    def __init__(self, buckets: ty.Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя - +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+# Количество выполненных команд по названию команды
+COMMANDS_RECEIVED: Counter[str] = Counter()
+# Время выполнения команд по названию команды
+COMMAND_LATENCY: defaultdict[str, Histogram] = defaultdict(Histogram)
+# Количество отправленных клиентам событий по типу события
+EVENTS_SENT: Counter[str] = Counter()
+# Время рассылки событий участникам комнаты
+BROADCAST_LATENCY = Histogram()
+# Количество событий, разосланных участникам комнаты вместе
+BROADCAST_EVENTS = Histogram((1, 2, 3, 5, 10, 20, 50))
+# Количество команд в очередях комнат
+ROOM_INBOX_DEPTH = Gauge()
+# Время ожидания команды в очереди комнаты
+ROOM_INBOX_WAIT = Histogram()
+# Количество ошибок по коду AniTogetherError
+ERRORS: Counter[int] = Counter()
+# Количество отброшенных из-за ограничения частоты кадров
+# по ограничению: connection или ip
+THROTTLED_FRAMES: Counter[str] = Counter()
+# Количество отклонённых из-за перегрузки запросов
+# по (запрос: join или create_room, причина)
+REQUESTS_SHED: Counter[tuple[str, str]] = Counter()
+# Количество сообщений в очередях отправки клиентов
+SEND_QUEUE_DEPTH = Gauge()
+# Количество вытесненных из очередей событий воспроизведения
+EVENTS_COALESCED = Gauge()
+# Количество клиентов, отключенных из-за переполнения очереди
+CLIENTS_DROPPED = Gauge()
+# Количество комнат
+ROOMS = Gauge()
+# Количество комнат по количеству участников
+ROOM_SIZES: Counter[int] = Counter()
+# Количество открытых websocket соединений
+CONNECTIONS = Gauge()
+# Задержка выполнения таймеров цикла событий
+LOOP_LAG = Histogram()
+LOOP_LAG_LAST = Gauge()
+LOOP_LAG_MAX = Gauge()
+# Перцентили задержки по последним измерениям
+LOOP_LAG_P50 = Gauge()
+LOOP_LAG_P99 = Gauge()
+
+
+def room_resized(old_size: int | None, new_size: int | None) -> None:
+    """
+    Учитывает изменение количества участников комнаты.
+    None означает, что комнаты нет (до создания или после удаления).
+    """
+    if old_size is not None:
+        ROOM_SIZES[old_size] -= 1
+        if not ROOM_SIZES[old_size]:
+            del ROOM_SIZES[old_size]
+    if new_size is not None:
+        ROOM_SIZES[new_size] += 1
+
+
+def _labels(**labels: ty.Any) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def _le(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+def _histogram(
+    lines: list[str], name: str, histogram: Histogram, **labels: ty.Any
+) -> None:
+    cumulative = 0
+    for bound, count in zip((*histogram.buckets, float("inf")), histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(**labels, le=_le(bound))} {cumulative}")
+    lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+
+
+def _header(lines: list[str], name: str, kind: str, description: str) -> None:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render() -> str:
+    """
+    Возвращает значения метрик в текстовом формате Prometheus.
+    """
+    lines: list[str] = []
+
+    _header(lines, "anitogether_rooms", "gauge", "Active rooms.")
+    lines.append(f"anitogether_rooms {ROOMS.value:g}")
+
+    _header(lines, "anitogether_connections", "gauge", "Open websocket connections.")
+    lines.append(f"anitogether_connections {CONNECTIONS.value:g}")
+
+    name = "anitogether_room_members"
+    _header(lines, name, "histogram", "Rooms by number of members.")
+    cumulative = 0
+    sizes = sorted(ROOM_SIZES.items())
+    i = 0
+    for bound in (*ROOM_SIZE_BUCKETS, float("inf")):
+        while i < len(sizes) and sizes[i][0] <= bound:
+            cumulative += sizes[i][1]
+            i += 1
+        lines.append(f"{name}_bucket{_labels(le=_le(bound))} {cumulative}")
+    lines.append(f"{name}_sum {sum(size * count for size, count in sizes)}")
+    lines.append(f"{name}_count {cumulative}")
+
+    name = "anitogether_commands_received_total"
+    _header(lines, name, "counter", "Room commands received by command.")
+    for command, count in sorted(COMMANDS_RECEIVED.items()):
+        lines.append(f"{name}{_labels(command=command)} {count}")
+
+    name = "anitogether_command_duration_seconds"
+    _header(lines, name, "histogram", "Room command handling time by command.")
+    for command, histogram in sorted(COMMAND_LATENCY.items()):
+        _histogram(lines, name, histogram, command=command)
+
+    name = "anitogether_events_sent_total"
+    _header(lines, name, "counter", "Events sent to clients by event type.")
+    for event_type, count in sorted(EVENTS_SENT.items()):
+        lines.append(f"{name}{_labels(type=event_type)} {count}")
+
+    name = "anitogether_broadcast_duration_seconds"
+    _header(lines, name, "histogram", "Time to encode and send events to a room.")
+    _histogram(lines, name, BROADCAST_LATENCY)
+    name = "anitogether_broadcast_events"
+    _header(lines, name, "histogram", "Events sent to a room in one broadcast.")
+    _histogram(lines, name, BROADCAST_EVENTS)
+
+    name = "anitogether_room_inbox_depth"
+    _header(lines, name, "gauge", "Commands waiting in room inboxes.")
+    lines.append(f"{name} {ROOM_INBOX_DEPTH.value:g}")
+    name = "anitogether_room_inbox_wait_seconds"
+    _header(lines, name, "histogram", "Time commands wait in a room inbox.")
+    _histogram(lines, name, ROOM_INBOX_WAIT)
+
+    name = "anitogether_throttled_frames_total"
+    _header(lines, name, "counter", "Incoming frames dropped by rate limits by scope.")
+    for scope, count in sorted(THROTTLED_FRAMES.items()):
+        lines.append(f"{name}{_labels(scope=scope)} {count}")
+
+    name = "anitogether_requests_shed_total"
+    _header(lines, name, "counter", "Joins and room creations rejected by overload.")
+    for (request, reason), count in sorted(REQUESTS_SHED.items()):
+        lines.append(f"{name}{_labels(request=request, reason=reason)} {count}")
+
+    name = "anitogether_send_queue_depth"
+    _header(lines, name, "gauge", "Messages waiting in client send queues.")
+    lines.append(f"{name} {SEND_QUEUE_DEPTH.value:g}")
+    name = "anitogether_events_coalesced_total"
+    _header(lines, name, "counter", "Queued playback events superseded by newer ones.")
+    lines.append(f"{name} {EVENTS_COALESCED.value:g}")
+    name = "anitogether_clients_dropped_total"
+    _header(lines, name, "counter", "Clients disconnected for overflowing send queue.")
+    lines.append(f"{name} {CLIENTS_DROPPED.value:g}")
+
+    name = "anitogether_errors_total"
+    _header(lines, name, "counter", "Errors sent to clients by error code.")
+    for code, count in sorted(ERRORS.items()):
+        lines.append(f"{name}{_labels(code=code)} {count}")
+
+    name = "anitogether_event_loop_lag_seconds"
+    _header(lines, name, "histogram", "Event loop timer lag.")
+    _histogram(lines, name, LOOP_LAG)
+    name = "anitogether_event_loop_lag_last_seconds"
+    _header(lines, name, "gauge", "Last measured event loop timer lag.")
+    lines.append(f"{name} {LOOP_LAG_LAST.value}")
+    name = "anitogether_event_loop_lag_max_seconds"
+    _header(lines, name, "gauge", "Maximum event loop timer lag since start.")
+    lines.append(f"{name} {LOOP_LAG_MAX.value}")
+    name = "anitogether_event_loop_lag_recent_seconds"
+    _header(lines, name, "gauge", "Recent event loop timer lag percentiles.")
+    lines.append(f'{name}{{quantile="0.5"}} {LOOP_LAG_P50.value}')
+    lines.append(f'{name}{{quantile="0.99"}} {LOOP_LAG_P99.value}')
+
+    return "\n".join(lines) + "\n"
+
+
+def merge(texts: ty.Iterable[tuple[str, str]], label: str) -> str:
+    """
+    Объединяет метрики нескольких процессов,
+    добавляя к каждому значению метку `label` с именем процесса.
+    :param texts: Пары (имя процесса, метрики в формате Prometheus).
+    """
+    headers: dict[str, list[str]] = {}
+    samples: defaultdict[str, list[str]] = defaultdict(list)
+    for process, text in texts:
+        family = ""
+        for line in text.splitlines():
+            if line.startswith("# TYPE ") or line.startswith("# HELP "):
+                family = line.split()[2]
+                if line not in headers.setdefault(family, []):
+                    headers[family].append(line)
+            elif line:
+                sample_name, _, value = line.rpartition(" ")
+                if "{" in sample_name:
+                    sample_name = sample_name.replace("{", f'{{{label}="{process}",', 1)
+                else:
+                    sample_name += f'{{{label}="{process}"}}'
+                samples[family].append(f"{sample_name} {value}")
+    lines = []
+    for family, family_headers in headers.items():
+        lines.extend(family_headers)
+        lines.extend(samples[family])
+    return "\n".join(lines) + "\n"
+
+
+__all__ = [
+    "Gauge",
+    "Histogram",
+    "LATENCY_BUCKETS",
+    "COMMANDS_RECEIVED",
+    "COMMAND_LATENCY",
+    "EVENTS_SENT",
+    "BROADCAST_LATENCY",
+    "BROADCAST_EVENTS",
+    "ROOM_INBOX_DEPTH",
+    "ROOM_INBOX_WAIT",
+    "ERRORS",
+    "THROTTLED_FRAMES",
+    "REQUESTS_SHED",
+    "SEND_QUEUE_DEPTH",
+    "EVENTS_COALESCED",
+    "CLIENTS_DROPPED",
+    "ROOMS",
+    "ROOM_SIZES",
+    "CONNECTIONS",
+    "LOOP_LAG",
+    "LOOP_LAG_LAST",
+    "LOOP_LAG_MAX",
+    "LOOP_LAG_P50",
+    "LOOP_LAG_P99",
+    "room_resized",
+    "render",
+    "merge",
+]
@@ -0,0 +1,180 @@
+"""
+
+Очередь исходящих сообщений клиента.
+
+Пока клиент успевает принимать сообщения, они пишутся в сокет сразу.
+Когда буфер отправки переполняется, сообщения копятся в очереди
+и отправляются отдельной задачей с учётом backpressure.
+События состояния воспроизведения (play/seek/pause) объединяются
+в очереди в одно событие с итоговым состоянием: воспроизводится ли видео
+и позиция, поэтому отставший клиент сразу переходит к актуальному
+состоянию. События после смены серии (set_episode) не объединяются
+с событиями до неё. Клиент, очередь которого превысила SEND_QUEUE_LIMIT, отключается.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import typing as ty
+from collections import deque
+
+import websockets
+
+import metrics
+import tracing
+
+
+if ty.TYPE_CHECKING:
+    from websockets import WebSocketServerProtocol as Ws
+
+    from protocol import Codec
+
+
+# Максимальный размер буфера отправки сокета (в байтах),
+# после которого сообщения начинают копиться в очереди
+SEND_BUFFER_LIMIT = int(os.environ.get("SEND_BUFFER_LIMIT", "16384"))
+# Максимальное количество сообщений в очереди клиента
+SEND_QUEUE_LIMIT = int(os.environ.get("SEND_QUEUE_LIMIT", "64"))
+# События, которые объединяются в очереди в одно
+PLAYBACK_EVENTS = frozenset(("play", "seek", "pause"))
+# События, после которых позиция воспроизведения из предыдущих событий
+# устаревает, поэтому события по разные стороны от них не объединяются
+PLAYBACK_RESET_EVENTS = frozenset(("set_episode", "init"))
+
+
+class Outbox:
+    __slots__ = (
+        "ws",
+        "codec",
+        "queue",
+        "size",
+        "closed",
+        "_playback",
+        "_playback_event",
+        "_task",
+    )
+
+    def __init__(self, ws: Ws, codec: Codec):
+        self.ws = ws
+        # Кодек, которым кодируется объединённое событие воспроизведения
+        self.codec = codec
+        # Элементы очереди - списки из одного кадра,
+        # вытесненный кадр заменяется на None
+        self.queue: deque[list[str | bytes | None]] = deque()
+        self.size = 0
+        self.closed = False
+        # Неотправленное событие воспроизведения и его элемент очереди
+        self._playback: list[str | bytes | None] | None = None
+        self._playback_event: dict | None = None
+        self._task: asyncio.Task | None = None
+
+    def ready(self) -> bool:
+        """
+        Можно ли писать в сокет сразу, минуя очередь.
+        """
+        return (
+            not self.queue
+            and not self.closed
+            and (transport := self.ws.transport) is not None
+            and transport.get_write_buffer_size() < SEND_BUFFER_LIMIT
+        )
+
+    def send(
+        self, frame: str | bytes, event_type: str, event: dict | None = None
+    ) -> None:
+        if self.ready():
+            websockets.broadcast((self.ws,), frame)
+        else:
+            self.put(frame, event_type, event)
+
+    def put(
+        self, frame: str | bytes, event_type: str, event: dict | None = None
+    ) -> None:
+        """
+        Добавляет сообщение в очередь.
+        :param event: Событие воспроизведения, закодированное в `frame`.
+            Объединяется с неотправленным событием воспроизведения.
+        """
+        if self.closed:
+            return
+
+        if event_type in PLAYBACK_EVENTS:
+            if self._playback is not None and self._playback[0] is not None:
+                self._playback[0] = None
+                self._dequeued()
+                metrics.EVENTS_COALESCED.inc()
+                if event is not None and self._playback_event is not None:
+                    merged = merge_playback(self._playback_event, event)
+                    if merged is not event:
+                        frame, event = self.codec.encode(merged), merged
+            entry = [frame]
+            self._playback, self._playback_event = entry, event
+        else:
+            entry = [frame]
+            if event_type in PLAYBACK_RESET_EVENTS:
+                self._playback = self._playback_event = None
+        self.queue.append(entry)
+        self.size += 1
+        metrics.SEND_QUEUE_DEPTH.inc()
+
+        if self.size > SEND_QUEUE_LIMIT:
+            return self.drop()
+        if self._task is None:
+            self._task = tracing.create_task(self._drain())
+
+    def drop(self) -> None:
+        """
+        Отключает клиента, который не успевает принимать сообщения.
+        """
+        self.clear()
+        self.closed = True
+        metrics.CLIENTS_DROPPED.inc()
+        self.ws.fail_connection(1013, "Client is too slow")
+
+    def clear(self) -> None:
+        metrics.SEND_QUEUE_DEPTH.dec(self.size)
+        self.queue.clear()
+        self.size = 0
+        self._playback = self._playback_event = None
+
+    def _dequeued(self) -> None:
+        self.size -= 1
+        metrics.SEND_QUEUE_DEPTH.dec()
+
+    async def _drain(self) -> None:
+        try:
+            while self.queue:
+                entry = self.queue.popleft()
+                if entry is self._playback:
+                    self._playback = self._playback_event = None
+                if (frame := entry[0]) is None:
+                    continue
+                self._dequeued()
+                await self.ws.send(frame)  # ждёт освобождения буфера отправки
+        except websockets.ConnectionClosed:
+            self.clear()
+        finally:
+            self._task = None
+
+
+def merge_playback(previous: dict, event: dict) -> dict:
+    """
+    Объединяет два события воспроизведения в одно с итоговым состоянием.
+    Тип события (воспроизводится ли видео) берётся из нового события,
+    позиция - тоже из него, а если её там нет (pause от старых клиентов) -
+    из предыдущего события, кроме play: позиция play к моменту паузы устарела.
+    """
+    if (
+        "playback_time" in event
+        or "playback_time" not in previous
+        or previous["type"] == "play"
+    ):
+        return event
+    return dict(
+        event, time=previous["time"], playback_time=previous["playback_time"]
+    )
+
+
+__all__ = ["Outbox", "SEND_BUFFER_LIMIT", "SEND_QUEUE_LIMIT", "merge_playback"]
@@ -0,0 +1,168 @@
+"""
+
+Профилирование работающего сервера (/debug/profile).
+
+Отдельный поток с периодом PROFILE_INTERVAL снимает стек потока
+цикла событий. Профилирование выполняется в фоне, а результат -
+свёрнутые стеки (collapsed stacks), которые принимают flamegraph.pl,
+speedscope и подобные инструменты, - забирается отдельным запросом:
+
+    curl "http://host/debug/profile?seconds=30&token=..."
+    sleep 30
+    curl "http://host/debug/profile/result?token=..." > profile.txt
+    flamegraph.pl profile.txt > profile.svg
+
+Первый элемент каждого стека - обработчик ws_server, в котором находился
+цикл событий: команда комнаты, другая функция ws_server,
+idle (ожидание событий) или other.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import sys
+import threading
+import typing as ty
+from collections import Counter
+
+
+if ty.TYPE_CHECKING:
+    from types import FrameType
+
+
+# Токен доступа к отладочным маршрутам. Пусто - маршруты выключены
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+# Период (в секундах) снятия стека
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+# Максимальная длительность профилирования (в секундах)
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "60"))
+
+# Функции, в которых цикл событий ожидает событий
+_IDLE_FUNCTIONS = frozenset(("select", "poll", "epoll", "kqueue", "_poll"))
+# Модуль обработчиков соединений. Не импортируется, чтобы профилировщик
+# был доступен и в маршрутизаторе
+_WS_SERVER = "ws_server.py"
+_lock = threading.Lock()
+# Фоновое профилирование и его результат
+_capture: asyncio.Task | None = None
+_result: str | None = None
+
+
+def _label(code) -> str:
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _handler(stack: list[FrameType]) -> str:
+    """
+    Определяет обработчик ws_server, который выполнялся в момент снятия стека.
+    Команды комнат (функции, вызванные из dispatch) отмечаются префиксом command:.
+    """
+    handler = None
+    caller = None
+    for frame in stack:
+        code = frame.f_code
+        if os.path.basename(code.co_filename) == _WS_SERVER:
+            if caller == "dispatch" and code.co_name != "dispatch":
+                return f"command:{code.co_name}"
+            handler = caller = code.co_name
+        else:
+            caller = None
+    if handler:
+        return handler
+    if stack and stack[-1].f_code.co_name in _IDLE_FUNCTIONS:
+        return "idle"
+    return "other"
+
+
+def _sample(
+    thread_id: int, stop: threading.Event, interval: float, stacks: Counter[str]
+) -> None:
+    while not stop.wait(interval):
+        if (frame := sys._current_frames().get(thread_id)) is None:
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(frame)
+            frame = frame.f_back
+        stack.reverse()
+        handler = _handler(stack)
+        stacks[";".join((handler, *(_label(frame.f_code) for frame in stack)))] += 1
+
+
+async def profile(seconds: float, interval: float = PROFILE_INTERVAL) -> str | None:
+    """
+    Профилирует цикл событий в течение `seconds` секунд.
+    :returns: Свёрнутые стеки, начиная с самых частых,
+        или None, если профилирование уже выполняется.
+    """
+    if not _lock.acquire(blocking=False):
+        return None
+    try:
+        stacks: Counter[str] = Counter()
+        stop = threading.Event()
+        sampler = threading.Thread(
+            target=_sample,
+            args=(threading.get_ident(), stop, interval, stacks),
+            name="profiler",
+            daemon=True,
+        )
+        # Поток профилировщика получает GIL не раньше, чем через switchinterval
+        # после запроса. Если интервал больше времени выполнения обработчиков,
+        # стек снимается, только когда цикл событий ждёт событий,
+        # и профиль показывает только idle
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(switch_interval, interval / 10))
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+            sys.setswitchinterval(switch_interval)
+    finally:
+        _lock.release()
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def start(seconds: float, interval: float = PROFILE_INTERVAL) -> bool:
+    """
+    Запускает профилирование в фоне. Результат предыдущего сбрасывается.
+    :returns: Запущено ли профилирование. False, если оно уже выполняется.
+    """
+    global _capture, _result
+    if running():
+        return False
+    _result = None
+    _capture = asyncio.create_task(_run(seconds, interval))
+    return True
+
+
+async def _run(seconds: float, interval: float) -> None:
+    global _result
+    if (stacks := await profile(seconds, interval)) is not None:
+        _result = stacks
+
+
+def running() -> bool:
+    return _lock.locked() or (_capture is not None and not _capture.done())
+
+
+def result() -> str | None:
+    """
+    :returns: Свёрнутые стеки последнего фонового профилирования
+        или None, если его не было или оно ещё выполняется.
+    """
+    return _result
+
+
+__all__ = [
+    "ADMIN_TOKEN",
+    "PROFILE_INTERVAL",
+    "PROFILE_MAX_SECONDS",
+    "profile",
+    "start",
+    "running",
+    "result",
+]
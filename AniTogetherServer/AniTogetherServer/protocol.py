@@ -0,0 +1,162 @@
+"""
+
+Кодеки сообщений протокола комнат.
+Клиент выбирает кодек в команде `join`, по умолчанию используется JSON.
+
+"""
+
+from __future__ import annotations
+
+import json
+import typing as ty
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Названия команд и событий протокола.
+# Бинарный кодек передаёт вместо названия его индекс в этом списке,
+# поэтому новые названия добавляются только в конец.
+NAMES = (
+    "join",
+    "init",
+    "error",
+    "pause",
+    "play",
+    "seek",
+    "set_episode",
+    "playback_time_request",
+    "playback_time_request_answer",
+    "pause_request",
+    "rewind_back_request",
+    "leave_room",
+    "hoster_promotion",
+    "server_time_request",
+    "server_time_request_answer",
+    "reconnect",
+)
+NAME_IDS = {name: i for i, name in enumerate(NAMES)}
+
+
+class Codec:
+    """
+    Преобразует события в кадры websocket и кадры в команды.
+    """
+
+    name: str
+
+    def encode(self, event: dict) -> str | bytes:
+        raise NotImplementedError()
+
+    def encode_batch(self, events: list[dict]) -> str | bytes:
+        """
+        Кодирует несколько событий в один кадр - массив событий.
+        """
+        raise NotImplementedError()
+
+    def decode(self, message: str | bytes) -> dict:
+        """
+        :raises: ValueError
+        """
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    """
+    Текстовые кадры JSON. Использует orjson, если он установлен.
+    """
+
+    name = "json"
+
+    if orjson:
+
+        def encode(self, event: dict) -> str:
+            # Текстовый кадр, чтобы клиенты могли сразу передать его в JSON.parse
+            return orjson.dumps(event).decode()
+
+        def encode_batch(self, events: list[dict]) -> str:
+            return orjson.dumps(events).decode()
+
+        def decode(self, message: str | bytes) -> dict:
+            return orjson.loads(message)
+
+    else:
+
+        def encode(self, event: dict) -> str:
+            return json.dumps(event, separators=(",", ":"))
+
+        def encode_batch(self, events: list[dict]) -> str:
+            return json.dumps(events, separators=(",", ":"))
+
+        def decode(self, message: str | bytes) -> dict:
+            return json.loads(message)
+
+
+class MessagePackCodec(Codec):
+    """
+    Бинарные кадры MessagePack.
+    Названия команд и событий заменяются их числовыми идентификаторами.
+    """
+
+    name = "msgpack"
+
+    def encode(self, event: dict) -> bytes:
+        return msgpack.packb({**event, "type": NAME_IDS[event["type"]]})
+
+    def encode_batch(self, events: list[dict]) -> bytes:
+        return msgpack.packb(
+            [{**event, "type": NAME_IDS[event["type"]]} for event in events]
+        )
+
+    def decode(self, message: str | bytes) -> dict:
+        if not isinstance(message, bytes):
+            raise ValueError("Expected binary frame")
+        try:
+            data = msgpack.unpackb(message)
+        except Exception as err:
+            raise ValueError(str(err)) from err
+        if type(data) is dict and type(command := data.get("command")) is int:
+            if not 0 <= command < len(NAMES):
+                raise ValueError(f"Unknown command id {command}")
+            data["command"] = NAMES[command]
+        return data
+
+
+DEFAULT_CODEC: Codec = JsonCodec()
+CODECS: dict[str, Codec] = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+if msgpack:
+    CODECS[MessagePackCodec.name] = MessagePackCodec()
+
+
+def codec_for_frame(message: str | bytes) -> Codec:
+    """
+    Возвращает кодек, которым можно разобрать первое сообщение клиента.
+    Бинарные кадры разбираются MessagePack, текстовые - JSON.
+    """
+    if isinstance(message, bytes) and (codec := CODECS.get(MessagePackCodec.name)):
+        return codec
+    return DEFAULT_CODEC
+
+
+def get_codec(name: ty.Any, default: Codec = DEFAULT_CODEC) -> Codec:
+    """
+    Возвращает кодек, выбранный клиентом.
+    Неизвестные названия заменяются кодеком по умолчанию.
+    """
+    return CODECS.get(name, default) if isinstance(name, str) else default
+
+
+__all__ = [
+    "Codec",
+    "CODECS",
+    "DEFAULT_CODEC",
+    "codec_for_frame",
+    "get_codec",
+]
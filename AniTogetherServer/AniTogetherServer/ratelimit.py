@@ -0,0 +1,117 @@
+"""
+
+Ограничение частоты входящих кадров websocket для соединений и IP адресов.
+
+"""
+
+from __future__ import annotations
+
+import os
+import typing as ty
+from time import monotonic
+
+import metrics
+
+
+if ty.TYPE_CHECKING:
+    from websockets import WebSocketServerProtocol as Ws
+
+
+# Допустимая частота кадров одного соединения (в секунду) и размер всплеска.
+# 0 - без ограничения
+RATE_LIMIT = float(os.environ.get("RATE_LIMIT", "20"))
+RATE_LIMIT_BURST = float(os.environ.get("RATE_LIMIT_BURST", "40"))
+# Допустимая частота кадров всех соединений с одного IP адреса
+IP_RATE_LIMIT = float(os.environ.get("IP_RATE_LIMIT", "100"))
+IP_RATE_LIMIT_BURST = float(os.environ.get("IP_RATE_LIMIT_BURST", "200"))
+# Адреса прокси, которым можно доверять заголовок X-Forwarded-For
+TRUSTED_PROXIES = frozenset(
+    os.environ.get("TRUSTED_PROXIES", "127.0.0.1,::1").split(",")
+)
+
+# Корзины IP адресов и количество соединений, которые их используют
+_ip_buckets: dict[str, tuple[TokenBucket, int]] = {}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self) -> bool:
+        """
+        Забирает токен, если он есть.
+        """
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Limiter:
+    """
+    Ограничение частоты кадров соединения.
+    Должно быть закрыто через `close`, когда соединение завершится.
+    """
+
+    __slots__ = ("ip", "bucket", "ip_bucket")
+
+    def __init__(self, ws: Ws):
+        self.ip = client_ip(ws)
+        self.bucket = (
+            TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST) if RATE_LIMIT > 0 else None
+        )
+        self.ip_bucket = None
+        if IP_RATE_LIMIT > 0:
+            bucket, connections = _ip_buckets.get(self.ip) or (
+                TokenBucket(IP_RATE_LIMIT, IP_RATE_LIMIT_BURST),
+                0,
+            )
+            _ip_buckets[self.ip] = (bucket, connections + 1)
+            self.ip_bucket = bucket
+
+    def allow(self) -> bool:
+        """
+        Проверяет, можно ли обработать очередной кадр.
+        """
+        if self.bucket is not None and not self.bucket.take():
+            metrics.THROTTLED_FRAMES["connection"] += 1
+            return False
+        if self.ip_bucket is not None and not self.ip_bucket.take():
+            metrics.THROTTLED_FRAMES["ip"] += 1
+            return False
+        return True
+
+    def close(self) -> None:
+        if self.ip_bucket is None:
+            return
+        bucket, connections = _ip_buckets[self.ip]
+        if connections == 1:
+            del _ip_buckets[self.ip]
+        else:
+            _ip_buckets[self.ip] = (bucket, connections - 1)
+        self.ip_bucket = None
+
+
+def client_ip(ws: Ws) -> str:
+    """
+    Возвращает IP адрес клиента.
+    За доверенным прокси используется адрес, который прокси добавил
+    последним в X-Forwarded-For.
+    """
+    ip = ws.remote_address[0] if ws.remote_address else ""
+    if ip in TRUSTED_PROXIES and (
+        forwarded := ws.request_headers.get("X-Forwarded-For")
+    ):
+        ip = forwarded.rsplit(",", 1)[-1].strip()
+    return ip
+
+
+__all__ = ["TokenBucket", "Limiter", "client_ip"]
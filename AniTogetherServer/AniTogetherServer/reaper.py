@@ -0,0 +1,82 @@
+"""
+
+Отложенное удаление пустых комнат.
+
+Вместо отдельной задачи asyncio на каждую комнату используется одна
+корутина и куча сроков удаления. Отмена срока не трогает кучу:
+устаревшие записи просто пропускаются при извлечении.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import heapq
+import time
+import typing as ty
+from contextlib import suppress
+
+from loguru import logger
+
+
+class Reaper:
+    def __init__(self, on_expire: ty.Callable[[ty.Hashable], None], ttl: float):
+        """
+        :param on_expire: Вызывается с ключом, срок которого истёк.
+        :param ttl: Срок по умолчанию (в секундах).
+        """
+        self.on_expire = on_expire
+        self.ttl = ttl
+        self._deadlines: dict[ty.Hashable, float] = {}
+        self._heap: list[tuple[float, ty.Hashable]] = []
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, key: ty.Hashable, ttl: float | None = None) -> None:
+        """
+        Назначает (или переназначает) срок для ключа.
+        """
+        deadline = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._deadlines[key] = deadline
+        if not self._heap or deadline < self._heap[0][0]:
+            self._wakeup.set()
+        heapq.heappush(self._heap, (deadline, key))
+        # Не даём устаревшим записям занимать больше половины кучи
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._deadlines):
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, key: ty.Hashable) -> None:
+        self._deadlines.pop(key, None)
+
+    def expire(self) -> float | None:
+        """
+        Вызывает on_expire для всех истёкших ключей.
+        :returns: Время (в секундах) до следующего срока или None.
+        """
+        while self._heap:
+            deadline, key = self._heap[0]
+            if self._deadlines.get(key) != deadline:
+                heapq.heappop(self._heap)  # срок отменён или переназначен
+                continue
+            if (timeout := deadline - time.monotonic()) > 0:
+                return timeout
+            heapq.heappop(self._heap)
+            del self._deadlines[key]
+            try:
+                self.on_expire(key)
+            except Exception:
+                logger.exception("Reaper callback failed for {}", key)
+        return None
+
+    async def run(self) -> None:
+        while True:
+            timeout = self.expire()
+            self._wakeup.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+
+__all__ = ["Reaper"]
@@ -1,50 +1,251 @@
 from __future__ import annotations
 
-import asyncio
+import math
+import os
 import secrets
 import typing as ty
-from dataclasses import dataclass
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
 from loguru import logger
 
-from exceptions import RoomDoesNotExists, UserNotAMemberOfRoom
+import clock
+import metrics
+import sharding
+from exceptions import InvalidParam, RoomDoesNotExists, UserNotAMemberOfRoom
+from inbox import Inbox
+from outbox import Outbox
+from reaper import Reaper
 
 
 if ty.TYPE_CHECKING:
+    import asyncio
+    from uuid import UUID
+
     from websockets import WebSocketServerProtocol as Ws
 
+    from protocol import Codec
+    from tracing import Span
+
     ROOM_ID = str
     USER_ID = int
 
 
+log = logger.opt(colors=True)
+
+# Время (в секундах), в течение которого сервер сам отвечает на
+# playback_time_request по последнему состоянию от хостера, пока видео
+# воспроизводится. Позиция на паузе не меняется и не устаревает
+PLAYBACK_STATE_TTL = float(os.environ.get("PLAYBACK_STATE_TTL", "30"))
+# Время (в секундах), в течение которого за отключившимся участником
+# сохраняется место в комнате. 0 - участник сразу покидает комнату
+RESUME_GRACE_PERIOD = float(os.environ.get("RESUME_GRACE_PERIOD", "15"))
+# Количество последних событий комнаты, которые хранятся
+# для повторной отправки переподключившимся участникам
+EVENT_BUFFER_SIZE = int(os.environ.get("EVENT_BUFFER_SIZE", "64"))
+
 ROOMS: dict[ROOM_ID, Room] = {}
+# Комнаты, состояние которых изменилось с момента последнего снимка
+CHANGED_ROOMS: set[ROOM_ID] = set()
 
 
 @dataclass
 class User:
     ws: Ws
     id: USER_ID
+    codec: Codec
+    # Подключен ли участник. Место отключившегося участника
+    # сохраняется на RESUME_GRACE_PERIOD
+    online: bool = field(default=True, repr=False)
+    # Принимает ли клиент несколько событий одним кадром (массивом)
+    batch: bool = field(default=False, repr=False)
+    outbox: Outbox = field(init=False, repr=False)
+    # Токен для возвращения в комнату после переподключения
+    token: str = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.outbox = Outbox(self.ws, self.codec)
+        self.new_token()
+
+    def new_token(self) -> None:
+        self.token = f"{self.id}.{secrets.token_urlsafe(16)}"
 
 
 @dataclass
 class Room:
     room_id: ROOM_ID
-    members: list[User]
     title_id: int
     episode: str
     playing: bool = False
+    # Последняя известная позиция воспроизведения,
+    # время сервера, которому она соответствует,
+    # и время сервера, когда она была получена
+    playback_time: float | None = field(default=None, repr=False)
+    playback_timestamp: float = field(default=0.0, repr=False)
+    playback_updated: float = field(default=0.0, repr=False)
+    # Таймер окна объединения событий воспроизведения
+    # и последнее событие (отправитель, тип, идентификатор команды),
+    # ожидающее рассылки по его окончании
+    playback_flush: asyncio.TimerHandle | None = field(default=None, repr=False)
+    pending_playback: tuple[Ws, str, int | None] | None = field(
+        default=None, repr=False
+    )
+    # Участники, ожидающие ответа хостера на запрос позиции воспроизведения,
+    # и таймер ожидания этого ответа
+    playback_waiters: set[USER_ID] = field(default_factory=set, repr=False)
+    playback_query: asyncio.TimerHandle | None = field(default=None, repr=False)
+    # Участник, у которого запрошена позиция: хостер или,
+    # пока хостер отключен, другой участник
+    playback_source: USER_ID | None = field(default=None, repr=False)
+    # Участники в порядке подключения, первый из них - хостер.
+    # OrderedDict позволяет за O(1) и удалить любого участника,
+    # и получить следующего хостера.
+    members: OrderedDict[USER_ID, User] = field(default_factory=OrderedDict)
+    _members_by_ws: dict[UUID, User] = field(default_factory=dict, repr=False)
+    _next_user_id: USER_ID = field(default=0, repr=False)
+    # Последние события комнаты: (номер, событие, id отправителя,
+    # id получателя, если событие адресовано одному участнику)
+    events: deque[tuple[int, dict, USER_ID | None, USER_ID | None]] = field(
+        default_factory=lambda: deque(maxlen=EVENT_BUFFER_SIZE), repr=False
+    )
+    last_seq: int = field(default=0, repr=False)
+    # Очередь команд участников и события, ожидающие рассылки
+    inbox: Inbox = field(default_factory=Inbox, repr=False)
+    outgoing: list[tuple[dict, UUID | None, Span | None]] = field(
+        default_factory=list, repr=False
+    )
+
+    @property
+    def hoster(self) -> User | None:
+        return self.members[next(iter(self.members))] if self.members else None
 
     def get_by_ws(self, ws: Ws) -> User | None:
-        for member in self.members:
-            if member.ws.id == ws.id:
-                return member
+        return self._members_by_ws.get(ws.id)
 
     def get_by_id(self, user_id: USER_ID) -> User | None:
-        for member in self.members:
-            if member.id == user_id:
-                return member
+        return self.members.get(user_id)
+
+    def get_by_token(self, token: str) -> User | None:
+        user_id, _, _ = token.partition(".")
+        if (
+            user_id.isdigit()
+            and (user := self.members.get(int(user_id)))
+            and secrets.compare_digest(user.token, token)
+        ):
+            return user
+        return None
 
     def is_hoster(self, ws: Ws) -> bool:
-        return self.members[0].ws.id == ws.id
+        return (hoster := self.hoster) is not None and hoster.ws.id == ws.id
+
+    def set_playback(self, playing: bool, playback_time: float, time: float) -> None:
+        """
+        Запоминает состояние воспроизведения, полученное от хостера.
+        Отрицательная позиция заменяется на 0, а время - на ближайшее
+        из последних PLAYBACK_STATE_TTL секунд, чтобы ошибка клиента
+        не испортила позицию, которую сервер сообщает остальным участникам.
+        :param time: Время сервера, которому соответствует `playback_time`.
+        :raises: InvalidParam
+        """
+        for name, value in (("playback_time", playback_time), ("time", time)):
+            if type(value) not in (int, float) or not math.isfinite(value):
+                raise InvalidParam(name)
+        now = clock.now()
+        self.playing = playing
+        self.playback_time = max(0.0, float(playback_time))
+        self.playback_timestamp = min(max(float(time), now - PLAYBACK_STATE_TTL), now)
+        self.playback_updated = now
+
+    def reset_playback(self) -> None:
+        self.playing = False
+        self.playback_time = None
+
+    def current_playback_time(self, now: float) -> float | None:
+        """
+        Вычисляет текущую позицию воспроизведения.
+        :returns: Позиция или None, если состояние неизвестно
+            или видео воспроизводится, а состояние устарело.
+        """
+        if self.playback_time is None:
+            return None
+        if not self.playing:
+            return self.playback_time
+        if now - self.playback_updated > PLAYBACK_STATE_TTL:
+            return None
+        return self.playback_time + (now - self.playback_timestamp)
+
+    def add_member(self, ws: Ws, codec: Codec) -> User:
+        user = User(ws=ws, id=self._next_user_id, codec=codec)
+        self._next_user_id += 1
+        self.members[user.id] = user
+        self._members_by_ws[ws.id] = user
+        return user
+
+    def rebind_member(self, user: User, ws: Ws, codec: Codec) -> Ws:
+        """
+        Переносит участника на новое соединение.
+        :returns: Прежнее соединение участника.
+        """
+        del self._members_by_ws[user.ws.id]
+        previous_ws, user.ws = user.ws, ws
+        user.codec = codec
+        user.outbox = Outbox(ws, codec)
+        user.online = True
+        # Прежний токен больше не действует
+        user.new_token()
+        self._members_by_ws[ws.id] = user
+        return previous_ws
+
+    def record_event(
+        self,
+        event: dict,
+        exclude: UUID | None = None,
+        recipient: USER_ID | None = None,
+    ) -> dict:
+        """
+        Нумерует событие и сохраняет его в буфер последних событий.
+        :param exclude: Соединение отправителя, которому событие не доставляется.
+        :param recipient: Участник, которому адресовано событие.
+            None - событие для всех участников.
+        :returns: Событие с номером.
+        """
+        self.last_seq += 1
+        event = dict(event, seq=self.last_seq)
+        sender = self._members_by_ws.get(exclude) if exclude else None
+        self.events.append(
+            (self.last_seq, event, sender.id if sender else None, recipient)
+        )
+        return event
+
+    def missed_events(self, user_id: USER_ID, last_seq: ty.Any) -> list[dict] | None:
+        """
+        Возвращает события, которые участник пропустил после события `last_seq`.
+        :returns: Список событий или None, если часть из них уже вытеснена из буфера.
+        """
+        if (
+            type(last_seq) is not int
+            or last_seq > self.last_seq
+            or last_seq < self.last_seq - len(self.events)
+        ):
+            return None
+        return [
+            event
+            for seq, event, sender, recipient in self.events
+            if seq > last_seq
+            and sender != user_id
+            and recipient in (None, user_id)
+        ]
+
+    def remove_member(self, ws: Ws) -> tuple[User, bool]:
+        """
+        Удаляет участника из комнаты.
+        :returns: Экземпляр удаленного участника, был ли он хостером.
+        :raises: UserNotAMemberOfRoom
+        """
+        if not (user := self._members_by_ws.pop(ws.id, None)):
+            raise UserNotAMemberOfRoom()
+        was_hoster = next(iter(self.members)) == user.id
+        del self.members[user.id]
+        return user, was_hoster
 
 
 def generate_room_id() -> ROOM_ID:
@@ -53,13 +254,15 @@ def generate_room_id() -> ROOM_ID:
     """
     token_len = 5
     errors = 0
-    room_id = secrets.token_urlsafe(token_len)
+    # Префикс указывает на шард, которому принадлежит комната
+    prefix = sharding.room_id_prefix()
+    room_id = prefix + secrets.token_urlsafe(token_len)
     while room_id in ROOMS:
         errors += 1
         if errors == 3:
             token_len += 1
             errors = 0
-        room_id = secrets.token_urlsafe(token_len)
+        room_id = prefix + secrets.token_urlsafe(token_len)
     return room_id
 
 
@@ -79,27 +282,67 @@ def create_room(title_id: int, episode: str) -> ROOM_ID:
     :return: Идентификатор комнаты.
     """
     room_id = generate_room_id()
-    ROOMS[room_id] = Room(room_id, [], title_id, episode)
-    logger.opt(colors=True).debug(f"New room <y>{room_id}</y>")
-    asyncio.create_task(delete_later(room_id))
+    ROOMS[room_id] = Room(room_id, title_id, episode)
+    CHANGED_ROOMS.add(room_id)
+    metrics.ROOMS.inc()
+    metrics.room_resized(None, 0)
+    log.debug("New room <y>{room_id}</y>", room_id=room_id)
+    REAPER.schedule(room_id)
     return room_id
 
 
-def join_to_room(ws: Ws, room_id: ROOM_ID) -> Room:
+def restore_room(room_id: ROOM_ID, title_id: int, episode: str, playing: bool):
+    """
+    Восстанавливает комнату из снимка состояния.
+    """
+    ROOMS[room_id] = Room(room_id, title_id, episode, playing)
+    REAPER.schedule(room_id)
+    metrics.ROOMS.inc()
+    metrics.room_resized(None, 0)
+
+
+def join_to_room(ws: Ws, room_id: ROOM_ID, codec: Codec) -> tuple[User, Room]:
     """
     Подключает клиента к комнате.
+    :returns: Экземпляр подключенного клиента, экземпляр комнаты.
     :raises: RoomDoesNotExists
     """
     if not (room := ROOMS.get(room_id)):
         raise RoomDoesNotExists()
 
-    user_id = 0 if not room.members else room.members[-1].id + 1
-    user = User(ws=ws, id=user_id)
-    room.members.append(user)
-    logger.opt(colors=True).debug(
-        f"Client <r>{ws.id}</r> joined to room <y>{room_id}</y>"
+    user = room.add_member(ws, codec)
+    REAPER.cancel(room_id)
+    metrics.room_resized(len(room.members) - 1, len(room.members))
+    log.debug(
+        "Client <r>{ws_id}</r> joined to room <y>{room_id}</y>",
+        ws_id=ws.id,
+        room_id=room_id,
     )
-    return room
+    return user, room
+
+
+def resume_session(
+    ws: Ws, room_id: ROOM_ID, token: str, codec: Codec
+) -> tuple[User, Room, Ws] | None:
+    """
+    Возвращает участнику его место в комнате по токену из init.
+    :returns: Экземпляр участника, экземпляр комнаты, прежнее соединение
+        участника или None, если токен недействителен.
+    :raises: RoomDoesNotExists
+    """
+    if not (room := ROOMS.get(room_id)):
+        raise RoomDoesNotExists()
+    if not (user := room.get_by_token(token)):
+        return None
+
+    previous_ws = room.rebind_member(user, ws, codec)
+    log.debug(
+        "Client <r>{ws_id}</r> resumed session of {user_id} in room <y>{room_id}</y>",
+        ws_id=ws.id,
+        user_id=user.id,
+        room_id=room_id,
+    )
+    return user, room, previous_ws
 
 
 def leave_room(ws: Ws, room_id: ROOM_ID) -> tuple[User, Room, bool]:
@@ -113,22 +356,14 @@ def leave_room(ws: Ws, room_id: ROOM_ID) -> tuple[User, Room, bool]:
     if not (room := ROOMS.get(room_id)):
         raise RoomDoesNotExists()
 
-    hoster_changed = False
-    for i, member in enumerate(room.members):
-        if member.ws.id == ws.id:
-            if i == 0:
-                hoster_changed = True
-            leaved_user = member
-            room.members.remove(member)
-            logger.opt(colors=True).debug(
-                f"Client <r>{ws.id}</r> left room <y>{room_id}</y>"
-            )
-            break
-    else:
-        raise UserNotAMemberOfRoom()
+    leaved_user, hoster_changed = room.remove_member(ws)
+    metrics.room_resized(len(room.members) + 1, len(room.members))
+    log.debug(
+        "Client <r>{ws_id}</r> left room <y>{room_id}</y>", ws_id=ws.id, room_id=room_id
+    )
 
     if len(room.members) == 0:
-        asyncio.create_task(delete_later(room_id))
+        REAPER.schedule(room_id)
         hoster_changed = False
 
     return leaved_user, room, hoster_changed
@@ -139,24 +374,42 @@ def delete_room(room_id: ROOM_ID):
     Удаляет комнату.
     :return: RoomDoesNotExists
     """
-    if not ROOMS.get(room_id):
+    if not (room := ROOMS.get(room_id)):
         raise RoomDoesNotExists()
-    logger.opt(colors=True).debug(f"Room <y>{room_id}</y> deleted")
+    log.debug("Room <y>{room_id}</y> deleted", room_id=room_id)
     del ROOMS[room_id]
+    if room.playback_flush is not None:
+        room.playback_flush.cancel()
+    if room.playback_query is not None:
+        room.playback_query.cancel()
+    metrics.ROOMS.dec()
+    metrics.room_resized(len(room.members), None)
+    CHANGED_ROOMS.add(room_id)
+
+
+def room_changed(room: Room) -> None:
+    """
+    Отмечает, что состояние комнаты нужно сохранить в следующем снимке.
+    """
+    CHANGED_ROOMS.add(room.room_id)
+
+
+def delete_if_empty(room_id: ROOM_ID) -> None:
+    if (room := ROOMS.get(room_id)) and not room.members:
+        delete_room(room_id)
 
 
-async def delete_later(room_id: ROOM_ID) -> None:
-    await asyncio.sleep(30)
-    if room := ROOMS.get(room_id):
-        if not room.members:
-            delete_room(room_id)
+# Удаляет комнаты, в которых никого нет дольше ROOM_TTL секунд
+REAPER = Reaper(delete_if_empty, float(os.environ.get("ROOM_TTL", "30")))
 
 
 __all__ = [
     "get_room",
     "create_room",
     "join_to_room",
+    "resume_session",
     "leave_room",
+    "room_changed",
     "Room",
     "User",
     "ROOM_ID",
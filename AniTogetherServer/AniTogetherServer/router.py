@@ -0,0 +1,455 @@
+"""
+
+Маршрутизатор запросов между процессами-обработчиками шардов.
+
+Запускает обработчиков на локальных портах и проксирует к ним HTTP запросы.
+Соединение websocket, в адресе которого указана комната (/?room_id=...),
+маршрутизатор передаёт обработчику шарда комнаты вместе с прочитанными
+заголовками запроса (SCM_RIGHTS), и дальше клиент обменивается кадрами
+с обработчиком напрямую. Соединения старых клиентов без комнаты в адресе
+направляются в шард комнаты из первой команды `join`, и их кадры
+маршрутизатор пересылает сам.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import http
+import itertools
+import os
+import re
+import socket
+import subprocess
+import sys
+import typing as ty
+from contextlib import asynccontextmanager, suppress
+from urllib.parse import parse_qsl
+
+import websockets
+from loguru import logger
+from websockets.legacy.server import WebSocketServerProtocol
+
+import connection
+import drain
+import metrics
+import profiler
+import ratelimit
+import sharding
+from exceptions import ServerIsShuttingDown, UnknownCommand
+from http_server import error
+from protocol import codec_for_frame
+
+
+if ty.TYPE_CHECKING:
+    from http_server import ANSWER
+
+
+WORKER_HOST = "127.0.0.1"
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# Передавать соединения обработчикам. В Windows передача сокетов не поддерживается
+HANDOFF = hasattr(socket, "send_fds") and hasattr(socket, "SOCK_SEQPACKET")
+# Максимальный размер заголовков запроса (в байтах), которые маршрутизатор
+# читает до выбора обработчика, и время (в секундах) их ожидания
+MAX_REQUEST_HEAD = 16384
+REQUEST_HEAD_TIMEOUT = 10
+# Время (в секундах) ожидания ответа обработчика на HTTP запрос
+PROXY_TIMEOUT = 10
+_UPGRADE_HEADER = re.compile(
+    rb"^upgrade:[ \t]*websocket[ \t]*\r?$", re.IGNORECASE | re.MULTILINE
+)
+
+WORKER_PORTS: list[int] = []
+# Сокеты, через которые соединения передаются обработчикам шардов
+CHANNELS: list[socket.socket | None] = []
+# Новые комнаты создаются в шардах по очереди
+_create_room_shards = itertools.cycle(range(sharding.WORKERS))
+# Соединения, которые обработчик шарда получил и ещё не принял
+_accepting: set[asyncio.Task] = set()
+
+
+def start_worker(port: int, shard_id: int) -> subprocess.Popen:
+    env = dict(os.environ, SHARD_ID=str(shard_id), PORT=str(port))
+    if not HANDOFF:
+        return subprocess.Popen([sys.executable, MAIN_SCRIPT], env=env)
+
+    channel, worker_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    channel.setblocking(False)
+    if (previous := CHANNELS[shard_id]) is not None:
+        previous.close()
+    CHANNELS[shard_id] = channel
+    env["HANDOFF_FD"] = str(worker_channel.fileno())
+    try:
+        return subprocess.Popen(
+            [sys.executable, MAIN_SCRIPT], env=env, pass_fds=(worker_channel.fileno(),)
+        )
+    finally:
+        worker_channel.close()
+
+
+async def watch_workers(processes: list[subprocess.Popen]) -> None:
+    """
+    Перезапускает завершившихся обработчиков.
+    Комнаты перезапущенного шарда при этом теряются.
+    """
+    while True:
+        await asyncio.sleep(1)
+        for shard_id, process in enumerate(processes):
+            if (code := process.poll()) is not None:
+                logger.error("Worker {} exited with code {}, restarting", shard_id, code)
+                processes[shard_id] = start_worker(WORKER_PORTS[shard_id], shard_id)
+
+
+async def wait_for_workers(timeout: float = 30) -> None:
+    """
+    Ждёт, пока все обработчики начнут принимать соединения.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    for port in WORKER_PORTS:
+        while True:
+            try:
+                _, writer = await asyncio.open_connection(WORKER_HOST, port)
+                writer.close()
+                break
+            except OSError:
+                if asyncio.get_running_loop().time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+
+@asynccontextmanager
+async def serve(port: int):
+    """
+    Запускает обработчиков шардов и маршрутизатор на порту `port`.
+    """
+    WORKER_PORTS[:] = [
+        sharding.worker_port(port, shard_id) for shard_id in range(sharding.WORKERS)
+    ]
+    CHANNELS[:] = [None] * sharding.WORKERS
+    processes = [
+        start_worker(worker_port, shard_id)
+        for shard_id, worker_port in enumerate(WORKER_PORTS)
+    ]
+    await wait_for_workers()
+    watcher = asyncio.create_task(watch_workers(processes))
+    try:
+        async with websockets.serve(
+            ws_handler,
+            "",
+            port,
+            create_protocol=RouterProtocol,
+            process_request=http_handler,
+            reuse_port=drain.REUSE_PORT,
+            **connection.serve_settings(),
+        ) as server:
+            try:
+                yield server
+            finally:
+                # Обработчики получают SIGTERM и сами просят клиентов
+                # переподключиться, а маршрутизатор пересылает сообщения
+                # старых клиентов, пока обработчики не завершатся
+                drain.start(server)
+                watcher.cancel()
+                for process in processes:
+                    process.terminate()
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        asyncio.gather(
+                            *(asyncio.to_thread(process.wait) for process in processes)
+                        ),
+                        drain.DRAIN_TIMEOUT + 5,
+                    )
+    finally:
+        watcher.cancel()
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+        for process in processes:
+            process.wait()
+        for channel in CHANNELS:
+            if channel is not None:
+                channel.close()
+
+
+async def http_handler(path: str, request_headers) -> ANSWER | None:
+    route, _, query = path.partition("?")
+    if route == "/healthz":
+        return (
+            http.HTTPStatus.OK,
+            {"Access-Control-Allow-Origin": "*"},
+            b"OK\n",
+        )
+    elif route == "/metrics":
+        answers = await asyncio.gather(
+            *(proxy_http(shard_id, path) for shard_id in range(sharding.WORKERS))
+        )
+        for status, headers, body in answers:
+            if status != http.HTTPStatus.OK:
+                return status, headers, body
+        texts = (
+            (str(shard_id), body.decode()) for shard_id, (*_, body) in enumerate(answers)
+        )
+        text = metrics.merge(texts, "shard")
+        return (
+            http.HTTPStatus.OK,
+            {"Content-Type": "text/plain; version=0.0.4"},
+            text.encode(),
+        )
+    elif route in ("/debug/profile", "/debug/profile/result") and profiler.ADMIN_TOKEN:
+        # Профилирование запускается во всех шардах,
+        # стеки в результате отмечаются номером шарда
+        answers = await asyncio.gather(
+            *(proxy_http(shard_id, path) for shard_id in range(sharding.WORKERS))
+        )
+        for status, headers, body in answers:
+            if status not in (http.HTTPStatus.OK, http.HTTPStatus.ACCEPTED):
+                return status, headers, body
+        for status, headers, body in answers:
+            if status == http.HTTPStatus.ACCEPTED:
+                return status, headers, body
+        text = "".join(
+            f"shard{shard_id};{line}\n"
+            for shard_id, (*_, body) in enumerate(answers)
+            for line in body.decode().splitlines()
+        )
+        return http.HTTPStatus.OK, {"Content-Type": "text/plain"}, text.encode()
+    elif route == "/create_room":
+        return await proxy_http(next(_create_room_shards), path)
+    elif route == "/get_room":
+        return await proxy_http(sharding.shard_of(room_id_from(query)), path)
+    if request_headers["Connection"] != "Upgrade":
+        return error(UnknownCommand())
+
+
+async def proxy_http(shard_id: int, path: str) -> ANSWER:
+    """
+    Выполняет HTTP запрос к обработчику шарда.
+    Если обработчик недоступен (например, перезапускается) или не ответил
+    за PROXY_TIMEOUT, возвращает ошибку ServerIsShuttingDown со статусом 503.
+    """
+    try:
+        response = await asyncio.wait_for(
+            _request_worker(shard_id, path), PROXY_TIMEOUT
+        )
+        head, _, body = response.partition(b"\r\n\r\n")
+        status = http.HTTPStatus(int(head.split(b" ", 2)[1]))
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError) as err:
+        logger.warning("Worker {} did not answer {}: {!r}", shard_id, path, err)
+        return error(ServerIsShuttingDown(), http.HTTPStatus.SERVICE_UNAVAILABLE)
+    return status, {"Access-Control-Allow-Origin": "*"}, body
+
+
+async def _request_worker(shard_id: int, path: str) -> bytes:
+    reader, writer = await asyncio.open_connection(
+        WORKER_HOST, WORKER_PORTS[shard_id]
+    )
+    try:
+        writer.write(
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {WORKER_HOST}\r\n"
+            "Connection: close\r\n\r\n".encode()
+        )
+        return await reader.read()
+    finally:
+        writer.close()
+
+
+def room_id_from(query: str) -> str:
+    """
+    Возвращает идентификатор комнаты из строки запроса.
+    Не использует parse_args, чтобы идентификатор из цифр не стал числом.
+    """
+    return dict(parse_qsl(query)).get("room_id", "")
+
+
+def handoff_shard(head: bytes) -> int | None:
+    """
+    :param head: Заголовки HTTP запроса.
+    :returns: Номер шарда комнаты из адреса запроса websocket или None,
+        если это не запрос websocket или комната в адресе не указана.
+    """
+    if not _UPGRADE_HEADER.search(head):
+        return None
+    try:
+        _, target, _ = head.split(b"\r\n", 1)[0].decode("latin-1").split(" ")
+    except ValueError:
+        return None
+    if not (room_id := room_id_from(target.partition("?")[2])):
+        return None
+    return sharding.shard_of(room_id)
+
+
+def hand_off(transport: asyncio.Transport, head: bytes) -> bool:
+    """
+    Передаёт соединение обработчику шарда вместе с прочитанными заголовками.
+    :returns: Передано ли соединение.
+    """
+    if (shard_id := handoff_shard(head)) is None:
+        return False
+    if (channel := CHANNELS[shard_id]) is None:
+        return False
+    try:
+        sock = transport.get_extra_info("socket")
+        socket.send_fds(channel, [head], [sock.fileno()])
+    except OSError:
+        # Обработчик перезапускается или не успевает принимать соединения.
+        # Соединение обслуживает маршрутизатор
+        return False
+    return True
+
+
+class RouterProtocol(WebSocketServerProtocol):
+    """
+    Протокол маршрутизатора. Пока не прочитаны заголовки запроса,
+    соединение не обрабатывается websockets, чтобы его можно было передать
+    обработчику шарда. Иначе соединение обслуживается как обычно:
+    HTTP запросы - http_handler, соединения websocket - ws_handler.
+    """
+
+    def __init__(self, *args: ty.Any, **kwargs: ty.Any):
+        super().__init__(*args, **kwargs)
+        self.head = bytearray()
+        # Обрабатывается ли соединение маршрутизатором
+        self.started = False
+        self.accepted_transport: asyncio.Transport | None = None
+        self.head_timeout: asyncio.TimerHandle | None = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.accepted_transport = ty.cast(asyncio.Transport, transport)
+        self.head_timeout = self.loop.call_later(
+            REQUEST_HEAD_TIMEOUT, transport.abort
+        )
+
+    def data_received(self, data: bytes) -> None:
+        if self.started:
+            return super().data_received(data)
+        self.head += data
+        if b"\r\n\r\n" not in self.head and len(self.head) < MAX_REQUEST_HEAD:
+            return
+        self.head_timeout.cancel()
+        head = bytes(self.head)
+        self.head.clear()
+        if hand_off(self.accepted_transport, head):
+            # Сокет остаётся открытым в обработчике
+            self.accepted_transport.abort()
+            return
+        self.started = True
+        super().connection_made(self.accepted_transport)
+        super().data_received(head)
+
+    def eof_received(self) -> bool | None:
+        if self.started:
+            return super().eof_received()
+        return None
+
+    def connection_lost(self, exc: Exception | None) -> None:
+        if self.started:
+            return super().connection_lost(exc)
+        self.head_timeout.cancel()
+
+
+class HandedOffProtocol(WebSocketServerProtocol):
+    """
+    Протокол соединения, переданного маршрутизатором обработчику шарда.
+    Заголовки запроса маршрутизатор уже прочитал из сокета.
+    """
+
+    def __init__(self, *args: ty.Any, head: bytes, **kwargs: ty.Any):
+        super().__init__(*args, **kwargs)
+        self.head = head
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        super().connection_made(transport)
+        super().data_received(self.head)
+
+
+def accept_handed_off(factory: ty.Callable[..., HandedOffProtocol]) -> None:
+    """
+    Начинает принимать соединения, которые передаёт маршрутизатор.
+    Вызывается в обработчике шарда.
+    :param factory: Фабрика протоколов HandedOffProtocol.
+    """
+    if not (fd := os.environ.get("HANDOFF_FD")):
+        return
+    channel = socket.socket(fileno=int(fd))
+    channel.setblocking(False)
+    asyncio.get_running_loop().add_reader(channel.fileno(), _receive, channel, factory)
+
+
+def _receive(
+    channel: socket.socket, factory: ty.Callable[..., HandedOffProtocol]
+) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            head, fds, _, _ = socket.recv_fds(channel, MAX_REQUEST_HEAD, 1)
+        except BlockingIOError:
+            return
+        except OSError:
+            fds = []
+        if not fds:
+            # Маршрутизатор завершился
+            loop.remove_reader(channel.fileno())
+            channel.close()
+            return
+        sock = socket.socket(fileno=fds[0])
+        task = asyncio.create_task(
+            _accept(sock, functools.partial(factory, head=head))
+        )
+        _accepting.add(task)
+        task.add_done_callback(_accepting.discard)
+
+
+async def _accept(
+    sock: socket.socket, factory: ty.Callable[[], HandedOffProtocol]
+) -> None:
+    try:
+        await asyncio.get_running_loop().connect_accepted_socket(factory, sock)
+    except OSError:
+        sock.close()
+
+
+async def ws_handler(websocket: WebSocketServerProtocol) -> None:
+    try:
+        message = await websocket.recv()
+    except websockets.ConnectionClosed:
+        return
+
+    # Некорректные сообщения отправляются в любой шард,
+    # чтобы клиент получил от него ошибку
+    shard_id = 0
+    try:
+        data = codec_for_frame(message).decode(message)
+        if type(data) is dict:
+            shard_id = sharding.shard_of(str(data.get("room_id") or ""))
+    except ValueError:
+        pass
+
+    async with websockets.connect(
+        f"ws://{WORKER_HOST}:{WORKER_PORTS[shard_id]}/",
+        compression=None,
+        ping_interval=None,
+        # Обработчик ограничивает частоту кадров по адресу клиента
+        extra_headers={"X-Forwarded-For": ratelimit.client_ip(websocket)},
+    ) as upstream:
+        await upstream.send(message)
+        relays = [
+            asyncio.create_task(relay(websocket, upstream)),
+            asyncio.create_task(relay(upstream, websocket)),
+        ]
+        _, pending = await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+    await websocket.close()
+
+
+async def relay(source, destination) -> None:
+    try:
+        async for message in source:
+            await destination.send(message)
+    except websockets.ConnectionClosed:
+        pass
+
+
+__all__ = ["serve", "HandedOffProtocol", "accept_handed_off"]
@@ -0,0 +1,68 @@
+"""
+
+Распределение комнат между процессами-обработчиками.
+
+При WORKERS > 1 главный процесс запускает WORKERS обработчиков,
+каждый из которых хранит только свою часть комнат (шард),
+и сам становится маршрутизатором запросов.
+Номер шарда закодирован в первом символе идентификатора комнаты.
+
+"""
+
+from __future__ import annotations
+
+import os
+import string
+import typing as ty
+
+
+if ty.TYPE_CHECKING:
+    from rooms import ROOM_ID
+
+
+# Алфавит secrets.token_urlsafe
+ALPHABET = string.ascii_letters + string.digits + "-_"
+
+WORKERS = int(os.environ.get("WORKERS", "1"))
+# Номер шарда текущего процесса. Не задан у маршрутизатора.
+SHARD_ID = int(shard_id) if (shard_id := os.environ.get("SHARD_ID")) else None
+
+if not 1 <= WORKERS <= len(ALPHABET):
+    raise ValueError(f"WORKERS must be in range 1..{len(ALPHABET)}")
+
+
+def is_router() -> bool:
+    return WORKERS > 1 and SHARD_ID is None
+
+
+def room_id_prefix() -> str:
+    """
+    Возвращает префикс идентификаторов комнат текущего шарда.
+    """
+    return ALPHABET[SHARD_ID] if WORKERS > 1 and SHARD_ID is not None else ""
+
+
+def shard_of(room_id: ROOM_ID) -> int:
+    """
+    Возвращает номер шарда, которому принадлежит комната.
+    """
+    if WORKERS == 1 or not room_id or (index := ALPHABET.find(room_id[0])) == -1:
+        return 0
+    return index % WORKERS
+
+
+def worker_port(port: int, shard_id: int) -> int:
+    """
+    Возвращает порт, который слушает обработчик шарда.
+    """
+    return int(os.environ.get("WORKERS_BASE_PORT", port + 1)) + shard_id
+
+
+__all__ = [
+    "WORKERS",
+    "SHARD_ID",
+    "is_router",
+    "room_id_prefix",
+    "shard_of",
+    "worker_port",
+]
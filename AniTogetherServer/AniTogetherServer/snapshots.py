@@ -0,0 +1,255 @@
+"""
+
+Сохранение состояния комнат в SQLite и восстановление после перезапуска.
+
+Обработчики команд только отмечают изменённые комнаты (rooms.room_changed),
+а сами изменения записываются пачкой раз в SNAPSHOT_INTERVAL секунд
+в отдельном потоке, поэтому запись не замедляет обработку команд.
+
+В файл пишет только один процесс - владелец. При каждой записи он
+обновляет время в таблице owner, а при завершении освобождает файл.
+Новый процесс, запущенный до завершения старого, ждёт, пока тот
+освободит файл (или перестанет его обновлять), и только потом
+восстанавливает комнаты. Иначе он удалил бы из файла комнаты,
+в которых у него никого нет, хотя их ещё обслуживает старый процесс.
+Если прежний владелец запускался на том же узле и его процесса уже нет
+(например, он упал), файл занимается сразу. Тогда комнаты восстанавливаются
+до того, как сервер начнёт принимать соединения.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import os
+import secrets
+import socket
+import sqlite3
+import time
+
+from loguru import logger
+
+import rooms
+import sharding
+
+
+SNAPSHOT_FILE = os.environ.get("SNAPSHOT_FILE")
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", "5"))
+
+if SNAPSHOT_FILE and sharding.SHARD_ID is not None:
+    # У каждого шарда свой файл
+    SNAPSHOT_FILE = f"{SNAPSHOT_FILE}.{sharding.SHARD_ID}"
+
+# Время (в секундах), после которого владелец, не обновлявший файл,
+# считается завершившимся
+OWNER_TIMEOUT = 3 * SNAPSHOT_INTERVAL
+# Период (в секундах) проверки, освободил ли прежний владелец файл
+HANDOFF_POLL_INTERVAL = 0.2
+# Идентификатор текущего процесса в таблице owner: узел, pid и случайная часть
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(8)}"
+
+_connection: sqlite3.Connection | None = None
+# Владеет ли текущий процесс файлом снимка
+_owned = False
+
+
+def connect() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        # Соединение используется из потоков asyncio.to_thread,
+        # но запись никогда не выполняется параллельно
+        _connection = sqlite3.connect(SNAPSHOT_FILE, check_same_thread=False)
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.execute("PRAGMA synchronous=NORMAL")
+        # У episode и title_id нет типа, чтобы значения восстанавливались как есть
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS rooms ("
+            "room_id TEXT PRIMARY KEY, title_id, episode, playing INTEGER"
+            ")"
+        )
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS owner ("
+            "id INTEGER PRIMARY KEY CHECK (id = 0), token TEXT, heartbeat REAL"
+            ")"
+        )
+    return _connection
+
+
+def handoff_pending() -> bool:
+    """
+    Ждёт ли текущий процесс, пока прежний владелец освободит файл снимка.
+    Комнат прежнего владельца в памяти текущего процесса ещё нет.
+    """
+    return bool(SNAPSHOT_FILE) and not _owned
+
+
+def previous_owner() -> str | None:
+    """
+    :returns: Идентификатор другого процесса, который владеет файлом
+        и недавно обновлял его, или None.
+    """
+    row = connect().execute("SELECT token, heartbeat FROM owner").fetchone()
+    if (
+        row is None
+        or row[0] in (None, OWNER)
+        or time.time() - row[1] > OWNER_TIMEOUT
+        or not is_alive(row[0])
+    ):
+        return None
+    return row[0]
+
+
+def is_alive(owner: str) -> bool:
+    """
+    Проверяет, работает ли процесс-владелец.
+    Проверить можно только процесс с того же узла,
+    про остальные считается, что они работают.
+    """
+    host, _, pid = owner.rpartition(":")[0].rpartition(":")
+    if os.name != "posix" or host != socket.gethostname() or not pid.isdigit():
+        return True
+    if int(pid) == os.getpid():
+        # pid достался текущему процессу, значит, прежнего процесса уже нет
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def take_ownership() -> None:
+    connection = connect()
+    with connection:
+        connection.execute(
+            "INSERT OR REPLACE INTO owner VALUES (0, ?, ?)", (OWNER, time.time())
+        )
+
+
+async def try_acquire() -> bool:
+    """
+    Становится владельцем файла снимка и восстанавливает комнаты,
+    если файл свободен.
+    :returns: Стал ли процесс владельцем.
+    """
+    if not SNAPSHOT_FILE:
+        return False
+    if await asyncio.to_thread(previous_owner):
+        return False
+    await acquire()
+    return True
+
+
+async def acquire() -> None:
+    """
+    Дожидается, пока прежний владелец освободит файл снимка,
+    становится владельцем и восстанавливает комнаты.
+    """
+    global _owned
+    if owner := await asyncio.to_thread(previous_owner):
+        logger.info("Waiting for process {} to hand off rooms", owner)
+        while await asyncio.to_thread(previous_owner):
+            await asyncio.sleep(HANDOFF_POLL_INTERVAL)
+    await asyncio.to_thread(take_ownership)
+    _owned = True
+    restore()
+
+
+def restore() -> None:
+    """
+    Восстанавливает комнаты из файла снимка.
+    Если в течение времени жизни пустой комнаты в неё никто не вернётся,
+    она будет удалена.
+    """
+    rows = connect().execute(
+        "SELECT room_id, title_id, episode, playing FROM rooms"
+    ).fetchall()
+    for room_id, title_id, episode, playing in rows:
+        if room_id not in rooms.ROOMS:
+            rooms.restore_room(room_id, title_id, episode, bool(playing))
+    logger.info("Restored {} rooms from {}", len(rows), SNAPSHOT_FILE)
+
+
+def write(upserted: list[tuple], deleted: list[tuple], release: bool) -> bool:
+    """
+    :param release: Освободить файл для следующего процесса.
+    :returns: Владеет ли процесс файлом. Если нет, ничего не записывается.
+    """
+    connection = connect()
+    with connection:
+        if release:
+            cursor = connection.execute(
+                "UPDATE owner SET token = NULL WHERE token = ?", (OWNER,)
+            )
+        else:
+            cursor = connection.execute(
+                "UPDATE owner SET heartbeat = ? WHERE token = ?", (time.time(), OWNER)
+            )
+        if cursor.rowcount == 0:
+            return False
+        connection.executemany(
+            "INSERT OR REPLACE INTO rooms VALUES (?, ?, ?, ?)", upserted
+        )
+        connection.executemany("DELETE FROM rooms WHERE room_id = ?", deleted)
+    return True
+
+
+async def flush(release: bool = False) -> None:
+    """
+    Записывает в файл снимка изменённые комнаты
+    и отмечает, что текущий процесс всё ещё владеет файлом.
+    :param release: Освободить файл для следующего процесса.
+    """
+    global _owned
+    if not SNAPSHOT_FILE or not _owned:
+        return
+
+    upserted, deleted = [], []
+    for room_id in rooms.CHANGED_ROOMS:
+        if room := rooms.ROOMS.get(room_id):
+            upserted.append((room_id, room.title_id, room.episode, room.playing))
+        else:
+            deleted.append((room_id,))
+    rooms.CHANGED_ROOMS.clear()
+
+    try:
+        owned = await asyncio.to_thread(write, upserted, deleted, release)
+    except sqlite3.Error as err:
+        logger.error("Can`t write rooms snapshot: {}", err)
+        # Повторим запись при следующем снимке
+        rooms.CHANGED_ROOMS.update(row[0] for row in upserted + deleted)
+        return
+    if not owned and not release:
+        # Процесс не обновлял файл дольше OWNER_TIMEOUT, и его занял другой
+        logger.error("Snapshot file was taken over by another process")
+    _owned = owned and not release
+
+
+async def run() -> None:
+    """
+    Становится владельцем файла снимка и периодически сохраняет изменения комнат.
+    При завершении освобождает файл.
+    """
+    if not SNAPSHOT_FILE:
+        return
+
+    if not _owned:
+        await acquire()
+    try:
+        while _owned:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            await flush()
+    finally:
+        await flush(release=True)
+
+
+__all__ = [
+    "handoff_pending",
+    "try_acquire",
+    "acquire",
+    "restore",
+    "flush",
+    "run",
+]
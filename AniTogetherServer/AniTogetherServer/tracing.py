@@ -0,0 +1,189 @@
+"""
+
+Трассировка команд комнат.
+
+Для доли команд TRACE_SAMPLE записывается время каждого этапа обработки:
+получение и декодирование кадра, ожидание в очереди комнаты,
+выполнение обработчика (изменение состояния комнаты),
+кодирование и запись событий в сокеты участников.
+По трассировке видно, на что ушло время конкретной команды:
+на ожидание цикла событий, кодирование или отправку.
+
+Каждый спан - одна строка JSON в TRACE_FILE. Поля названы как в OTLP
+(traceId, spanId, startTimeUnixNano, events, ...), но атрибуты
+записываются обычным объектом. Файл пишется отдельным потоком.
+
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+import os
+import random
+import secrets
+import threading
+import time
+import typing as ty
+from contextlib import contextmanager
+from queue import SimpleQueue
+
+
+# Доля трассируемых команд от 0 до 1. 0 - трассировка выключена
+TRACE_SAMPLE = float(os.environ.get("TRACE_SAMPLE", "0"))
+# Файл, в который пишутся спаны (JSON lines)
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+
+# Спан команды, которая сейчас выполняется
+CURRENT: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    "span", default=None
+)
+
+_queue: SimpleQueue[Span | None] = SimpleQueue()
+_writer: threading.Thread | None = None
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "start_ns",
+        "start",
+        "events",
+        "attributes",
+        "pending",
+        "handled",
+        "exported",
+    )
+
+    def __init__(self, name: str, **attributes: ty.Any):
+        self.name = name
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter_ns()
+        self.events: list[tuple[str, int]] = [("received", self.start)]
+        self.attributes = attributes
+        # Количество событий команды, которые ещё не разосланы
+        self.pending = 0
+        self.handled = False
+        self.exported = False
+
+    def event(self, name: str) -> None:
+        """
+        Отмечает окончание этапа обработки.
+        """
+        self.events.append((name, time.perf_counter_ns()))
+
+    def to_dict(self) -> dict:
+        trace_id = secrets.token_hex(16)
+        return dict(
+            traceId=trace_id,
+            spanId=trace_id[:16],
+            name=self.name,
+            startTimeUnixNano=self.start_ns,
+            endTimeUnixNano=self.start_ns + self.events[-1][1] - self.start,
+            attributes=self.attributes,
+            events=[
+                dict(name=name, timeUnixNano=self.start_ns + timestamp - self.start)
+                for name, timestamp in self.events
+            ],
+        )
+
+
+def start(name: str, **attributes: ty.Any) -> Span | None:
+    """
+    Начинает спан, если команда попала в выборку.
+    """
+    if TRACE_SAMPLE > 0 and random.random() < TRACE_SAMPLE:
+        return Span(name, **attributes)
+    return None
+
+
+@contextmanager
+def activate(span: Span) -> ty.Iterator[Span]:
+    """
+    Делает спан текущим на время выполнения обработчика команды.
+    Спан записывается, когда разосланы все события команды.
+    """
+    span.event("dispatched")
+    token = CURRENT.set(span)
+    try:
+        yield span
+    finally:
+        CURRENT.reset(token)
+        span.event("handled")
+        span.handled = True
+        if not span.pending:
+            export(span)
+
+
+def detached() -> contextvars.Context:
+    """
+    Копия текущего контекста без спана. В ней выполняются отложенные вызовы
+    и задачи, созданные во время выполнения команды. Иначе они унаследовали бы
+    спан команды и отметили бы в нём события, разосланные после её завершения.
+    """
+    context = contextvars.copy_context()
+    context.run(CURRENT.set, None)
+    return context
+
+
+def create_task(coro: ty.Coroutine[ty.Any, ty.Any, ty.Any]) -> asyncio.Task:
+    """
+    asyncio.create_task, но задача не наследует текущий спан.
+    """
+    return detached().run(asyncio.create_task, coro)
+
+
+def flushed(span: Span, count: int, **attributes: ty.Any) -> None:
+    """
+    Отмечает рассылку `count` событий команды.
+    :param attributes: Сведения о рассылке.
+    """
+    span.event("flushed")
+    span.attributes.update(attributes)
+    span.pending -= count
+    if span.handled and not span.pending:
+        export(span)
+
+
+def export(span: Span) -> None:
+    global _writer
+    if span.exported:
+        return
+    span.exported = True
+    if _writer is None:
+        _writer = threading.Thread(target=_write, name="tracing", daemon=True)
+        _writer.start()
+    _queue.put(span)
+
+
+def close() -> None:
+    """
+    Дописывает оставшиеся спаны в файл.
+    """
+    if _writer is not None:
+        _queue.put(None)
+        _writer.join(timeout=5)
+
+
+def _write() -> None:
+    with open(TRACE_FILE, "a", encoding="utf-8") as file:
+        while (span := _queue.get()) is not None:
+            file.write(json.dumps(span.to_dict()) + "\n")
+            if _queue.empty():
+                file.flush()
+
+
+__all__ = [
+    "TRACE_SAMPLE",
+    "TRACE_FILE",
+    "CURRENT",
+    "Span",
+    "start",
+    "activate",
+    "detached",
+    "create_task",
+    "flushed",
+    "export",
+    "close",
+]
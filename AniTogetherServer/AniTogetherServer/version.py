@@ -1,8 +1,13 @@
 from __future__ import annotations
 
 import re
+from functools import lru_cache, total_ordering
 
 
+VERSION_PATTERN = re.compile(r"(\d+)\.(\d+)\.(\d+)(-(\S+)\.(\d+))?")
+
+
+@total_ordering
 class Version:
     revisions = [None, "rc", "betta", "alpha"]
 
@@ -23,19 +28,24 @@ class Version:
             raise ValueError(
                 f"Unknown revision `{revision}`. it can be {self.revisions}"
             )
+        # Ключ сравнения. Релиз новее rc, rc новее betta и т.д.
+        self.key = (
+            major,
+            minor,
+            patch,
+            -self.revisions.index(revision),
+            revision_number or 0,
+        )
 
     @classmethod
     def from_str(cls, string_version: str) -> Version:
-        if match := re.fullmatch(
-            r"(\d+).(\d+).(\d+)(-(\S+).(\d+))?",
-            string_version,
-        ):
+        if match := VERSION_PATTERN.fullmatch(string_version):
             return Version(
                 int(match.group(1)),
                 int(match.group(2)),
                 int(match.group(3)),
                 match.group(5),
-                int(match.group(6)),
+                int(match.group(6)) if match.group(6) else None,
             )
         raise ValueError(f"Can`t parse version from string: {string_version}")
 
@@ -46,18 +56,33 @@ class Version:
         return version
 
     def __eq__(self, other: Version):
-        return str(self) == str(other)
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key == other.key
 
     def __gt__(self, other: Version):
-        if self.to_str(False) != other.to_str(False):
-            return self.to_str(False) > other.to_str(False)
-        self_revision_index = Version.revisions.index(self.revision)
-        other_revision_index = Version.revisions.index(other.revision)
-        if self_revision_index != other_revision_index:
-            return self_revision_index < other_revision_index
-        return self.revision_number > other.revision_number
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key > other.key
+
+    def __lt__(self, other: Version):
+        if not isinstance(other, Version):
+            return NotImplemented
+        return self.key < other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __repr__(self):
         return self.to_str()
 
     __str__ = __repr__
+
+
+@lru_cache(maxsize=256)
+def parse_version(string_version: str) -> Version:
+    """
+    Version.from_str с кэшем: клиенты присылают всего несколько разных версий.
+    Возвращаемый экземпляр общий, его нельзя изменять.
+    """
+    return Version.from_str(string_version)
@@ -1,257 +1,701 @@
 from __future__ import annotations
 
-from datetime import datetime
-import json
+import asyncio
+import os
+from dataclasses import dataclass
 import typing as ty
+from collections import Counter
+from time import perf_counter
 
 import websockets
 from loguru import logger
 
+import admission
+import clock
+import drain
+import metrics
+import ratelimit
 import rooms
+import snapshots
+import tracing
+from bus import create_bus
 from exceptions import (
     AniTogetherError,
     UserNotAMemberOfRoom,
     UnknownCommand,
     IncorrectMessage,
+    InvalidParam,
     ParamNotPassed,
+    ServerIsShuttingDown,
 )
+from logger import sampled
+from protocol import DEFAULT_CODEC, codec_for_frame, get_codec
+from reaper import Reaper
 
 
 if ty.TYPE_CHECKING:
+    from uuid import UUID
+
     from websockets import WebSocketServerProtocol
-    from rooms import Room, ROOM_ID
+    from protocol import Codec
+    from rooms import Room, User, ROOM_ID, USER_ID
+
+
+# Окно (в секундах), в течение которого из событий воспроизведения хостера
+# рассылается только последнее. 0 - рассылать каждое событие
+PLAYBACK_COALESCE_WINDOW = float(os.environ.get("PLAYBACK_COALESCE_WINDOW", "0.25"))
+# Время (в секундах) ожидания ответа хостера на запрос позиции воспроизведения.
+# Запросы участников в течение этого времени объединяются в один
+PLAYBACK_QUERY_TIMEOUT = float(os.environ.get("PLAYBACK_QUERY_TIMEOUT", "5"))
+# Коды закрытия соединения клиентом: 1000 - обычное закрытие,
+# 1001 - клиент уходит (закрытие или перезагрузка страницы)
+CLEAN_CLOSE_CODES = frozenset((1000, 1001))
+
+# Сообщения форматируются, только если уровень лога включен
+log = logger.opt(colors=True)
 
 
 async def ws_handler(websocket: WebSocketServerProtocol):
-    logger.opt(colors=True).debug(f"New client: <r>{websocket.id}</r>")
+    log.debug("New client: <r>{ws_id}</r>", ws_id=websocket.id)
+    metrics.CONNECTIONS.inc()
+    codec = DEFAULT_CODEC
+    limiter = ratelimit.Limiter(websocket)
     try:
         message = await websocket.recv()
-        data: dict = json.loads(message)
+        if not limiter.allow():
+            return
+        codec = codec_for_frame(message)
+        data: dict = codec.decode(message)
         assert type(data) is dict
         assert "command" in data
+        assert type(data["command"]) is str
 
         if data.get("command") == "join":
-            await join_to_room(websocket, data)
+            await join_to_room(websocket, data, codec, limiter)
         else:
-            await error(websocket, UnknownCommand())
+            await error(websocket, UnknownCommand(), codec)
 
-    except (json.JSONDecodeError, AssertionError):
-        await error(websocket, IncorrectMessage())
-    except websockets.ConnectionClosedOK:
+    except (ValueError, AssertionError):
+        await error(websocket, IncorrectMessage(), codec)
+    except websockets.ConnectionClosed:
+        # Обрыв соединения - обычная ситуация, место участника сохраняется
         pass
     finally:
-        logger.opt(colors=True).debug(f"Client <r>{websocket.id}</r> disconnected")
+        limiter.close()
+        metrics.CONNECTIONS.dec()
+        log.debug("Client <r>{ws_id}</r> disconnected", ws_id=websocket.id)
 
 
-async def join_to_room(websocket: WebSocketServerProtocol, data: dict) -> None:
+async def join_to_room(
+    websocket: WebSocketServerProtocol,
+    data: dict,
+    codec: Codec,
+    limiter: ratelimit.Limiter,
+) -> None:
     if not (room_id := data.get("room_id")):
-        return await error(websocket, ParamNotPassed("room_id"))
-
+        return await error(websocket, ParamNotPassed("room_id"), codec)
+    if type(room_id) is not str:
+        return await error(websocket, InvalidParam("room_id"), codec)
+
+    codec = get_codec(data.get("codec"), codec)
+    if drain.DRAINING:
+        return await error(websocket, ServerIsShuttingDown(), codec)
+    if room_id not in rooms.ROOMS and snapshots.handoff_pending():
+        # Комнату ещё обслуживает прежний процесс, клиент переподключится
+        return await error(websocket, ServerIsShuttingDown(), codec)
+
+    resumed = None
     try:
-        room = rooms.join_to_room(websocket, room_id)
+        if token := data.get("token"):
+            resumed = rooms.resume_session(websocket, room_id, str(token), codec)
+        if resumed:
+            user, room, previous_ws = resumed
+        else:
+            admission.admit("join")
+            user, room = rooms.join_to_room(websocket, room_id, codec)
     except AniTogetherError as err:
-        return await error(websocket, err)
+        return await error(websocket, err, codec)
+    user.batch = data.get("batch") is True
 
-    user = room.members[-1]
+    missed = None
+    if resumed:
+        SESSIONS.cancel((room_id, user.id))
+        # Прежнее соединение могло ещё не закрыться
+        previous_ws.fail_connection(1000, "Session resumed")
+        missed = room.missed_events(user.id, data.get("last_seq"))
+    BUS.subscribe(room_id)
 
     try:
         await send(
-            websocket,
+            user,
             "init",
             room_id=room_id,
             me=user.id,
-            members=[member.id for member in room.members],
+            members=list(room.members),
             title_id=room.title_id,
             episode=room.episode,
+            codec=codec.name,
+            token=user.token,
+            seq=room.last_seq,
+            # Клиенту не нужна полная синхронизация,
+            # если он получит все пропущенные события
+            resumed=missed is not None,
         )
-        await broadcast(websocket, room, "join", user_id=user.id)
-        await room_handler(websocket, room_id)
+        if missed is not None:
+            for event in missed:
+                metrics.EVENTS_SENT[event["type"]] += 1
+                user.outbox.send(user.codec.encode(event), event["type"], event)
+        elif not resumed:
+            await broadcast(websocket, room, "join", user_id=user.id)
+        await room_handler(user, room, limiter)
     finally:
-        await leave_room(websocket, room_id)
+        # После команд, которые участник успел отправить
+        await room.inbox.submit(disconnect, websocket, user, room)
 
 
-async def room_handler(websocket: WebSocketServerProtocol, room_id: ROOM_ID) -> None:
-    room = rooms.get_room(room_id)
-
-    async for message in websocket:
+async def room_handler(user: User, room: Room, limiter: ratelimit.Limiter) -> None:
+    async for message in user.ws:
+        # Лишние кадры отбрасываются до декодирования
+        if not limiter.allow():
+            continue
+        receive_time = clock.now()
+        span = tracing.start("command", room_id=room.room_id, user_id=user.id)
         try:
-            data: dict = json.loads(message)
+            data: dict = user.codec.decode(message)
             assert type(data) is dict
             assert "command" in data
-        except (json.JSONDecodeError, AssertionError):
-            await error(websocket, IncorrectMessage())
+            assert type(data["command"]) is str
+        except (ValueError, AssertionError):
+            member_error(user, IncorrectMessage())
             continue
 
-        if data.get("command") == "pause":
-            await pause(websocket, room)
-        elif data.get("command") == "play":
-            await play(websocket, room, data)
-        elif data.get("command") == "seek":
-            await seek(websocket, room, data)
-        elif data.get("command") == "set_episode":
-            await set_episode(websocket, room, data)
-        elif data.get("command") == "playback_time_request":
-            await playback_time_request(websocket, room)
-        elif data.get("command") == "playback_time_request_answer":
-            await playback_time_request_answer(websocket, room, data)
-        elif data.get("command") == "pause_request":
-            await pause_request(websocket, room)
-        elif data.get("command") == "rewind_back_request":
-            await rewind_back_request(websocket, room)
-        elif data.get("command") == "leave_room":
-            await leave_room(websocket, room_id)
-        elif data.get("command") == "server_time_request":
-            await server_time_request(websocket, data)
+        if span is not None:
+            span.event("decoded")
+            span.attributes.update(
+                command=str(data["command"]),
+                size=len(message),
+                # Задержка цикла событий при последнем измерении
+                loop_lag_ms=round(metrics.LOOP_LAG_LAST.value * 1000, 3),
+            )
+        if (cmd := COMMANDS.get(data["command"])) and cmd.direct:
+            await dispatch(user, room, data, span, receive_time)
         else:
-            await error(websocket, UnknownCommand())
+            await room.inbox.submit(dispatch, user, room, data, span)
+
+
+@dataclass
+class Command:
+    handler: ty.Callable[..., ty.Awaitable[None]]
+    params: tuple[str, ...] = ()
+    optional: tuple[str, ...] = ()
+    hoster_only: bool = False
+    direct: bool = False
+
+
+COMMANDS: dict[str, Command] = {}
+# Допустимые типы параметров команд. bool не считается числом
+PARAM_TYPES: dict[str, tuple[type, ...]] = {
+    "time": (int, float),
+    "playback_time": (int, float),
+    "user_id": (int,),
+    "episode": (str, int),
+    "request_id": (int,),
+}
+
+
+def command(
+    name: str,
+    *params: str,
+    optional: tuple[str, ...] = (),
+    hoster_only: bool = False,
+    direct: bool = False,
+):
+    """
+    Регистрирует обработчик команды комнаты.
+    :param name: Название команды.
+    :param params: Обязательные параметры команды.
+        Передаются в обработчик именованными аргументами.
+    :param optional: Необязательные параметры команды.
+        Передаются в обработчик, только если указаны в сообщении.
+    :param hoster_only: Команду может выполнять только хостер.
+        Команды от остальных участников игнорируются.
+    :param direct: Команда выполняется сразу при получении, без очереди комнаты.
+        Обработчик получает receive_time - время получения сообщения.
+        Такая команда не должна изменять комнату.
+    """
 
+    def decorator(fn):
+        COMMANDS[name] = Command(fn, params, optional, hoster_only, direct)
+        return fn
 
-async def pause(websocket: WebSocketServerProtocol, room: Room) -> None:
-    if not room.is_hoster(websocket):
+    return decorator
+
+
+def validate(
+    data: dict, params: tuple[str, ...], optional: tuple[str, ...] = ()
+) -> dict:
+    """
+    Извлекает из сообщения параметры команды и проверяет их типы.
+    :raises: ParamNotPassed, InvalidParam
+    """
+    values = {}
+    for param in params:
+        if (value := data.get(param)) is None:
+            raise ParamNotPassed(param)
+        values[param] = value
+    for param in optional:
+        if (value := data.get(param)) is not None:
+            values[param] = value
+    for param, value in values.items():
+        if (types := PARAM_TYPES.get(param)) and type(value) not in types:
+            raise InvalidParam(param)
+    return values
+
+
+async def dispatch(
+    user: User,
+    room: Room,
+    data: dict,
+    span: tracing.Span | None = None,
+    receive_time: float | None = None,
+) -> None:
+    if span is not None:
+        with tracing.activate(span):
+            span.attributes["inbox_depth"] = len(room.inbox)
+            return await dispatch(user, room, data, receive_time=receive_time)
+
+    name = data["command"]
+    if not (cmd := COMMANDS.get(name)):
+        return member_error(user, UnknownCommand())
+    if room.get_by_id(user.id) is not user:
+        # Участник покинул комнату, но соединение ещё открыто
+        return member_error(user, UserNotAMemberOfRoom())
+    if cmd.hoster_only and not room.is_hoster(user.ws):
         return
 
-    room.playing = False
-    await broadcast(websocket, room, "pause")
-    logger.opt(colors=True).debug(f"<y>{room.room_id}</y>: paused")
+    try:
+        params = validate(data, cmd.params, cmd.optional)
+    except (ParamNotPassed, InvalidParam) as err:
+        return member_error(user, err)
+    if cmd.direct:
+        params["receive_time"] = receive_time
+
+    start_time = perf_counter()
+    try:
+        await cmd.handler(user, room, **params)
+    except AniTogetherError as err:
+        member_error(user, err)
+    finally:
+        metrics.COMMANDS_RECEIVED[name] += 1
+        metrics.COMMAND_LATENCY[name].observe(perf_counter() - start_time)
 
 
-async def play(websocket: WebSocketServerProtocol, room: Room, data: dict) -> None:
-    if not room.is_hoster(websocket):
-        return
+@command(
+    "pause", optional=("time", "playback_time", "request_id"), hoster_only=True
+)
+async def pause(
+    user: User,
+    room: Room,
+    time: float | None = None,
+    playback_time: float | None = None,
+    request_id: int | None = None,
+) -> None:
+    if time is None or playback_time is None:
+        # Старые клиенты не передают позицию паузы
+        time = clock.now()
+        playback_time = room.current_playback_time(time)
+    if playback_time is not None:
+        room.set_playback(False, playback_time, time)
+    else:
+        # Позиция неизвестна, pause рассылается без неё
+        room.reset_playback()
+    rooms.room_changed(room)
+    broadcast_playback(user, room, "pause", request_id)
+    if sampled("pause"):
+        log.debug("<y>{room_id}</y>: paused", room_id=room.room_id)
+
+
+@command(
+    "play", "time", "playback_time", optional=("request_id",), hoster_only=True
+)
+async def play(
+    user: User,
+    room: Room,
+    time: float,
+    playback_time: float,
+    request_id: int | None = None,
+) -> None:
+    room.set_playback(True, playback_time, time)
+    rooms.room_changed(room)
+    broadcast_playback(user, room, "play", request_id)
+    if sampled("play"):
+        log.debug(
+            "<y>{room_id}</y>: playing playback_time={playback_time} time={time}",
+            room_id=room.room_id,
+            playback_time=playback_time,
+            time=time,
+        )
 
-    if (send_time := data.get("time")) is None:
-        return await error(websocket, ParamNotPassed("time"))
-    elif (playback_time := data.get("playback_time")) is None:
-        return await error(websocket, ParamNotPassed("playback_time"))
 
-    room.playing = True
-    await broadcast(
-        websocket, room, "play", time=send_time, playback_time=playback_time
-    )
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: playing playback_time={playback_time} time={send_time}"
+@command(
+    "seek", "time", "playback_time", optional=("request_id",), hoster_only=True
+)
+async def seek(
+    user: User,
+    room: Room,
+    time: float,
+    playback_time: float,
+    request_id: int | None = None,
+) -> None:
+    room.set_playback(False, playback_time, time)
+    rooms.room_changed(room)
+    broadcast_playback(user, room, "seek", request_id)
+    if sampled("seek"):
+        log.debug(
+            "<y>{room_id}</y>: seeking playback_time={playback_time} time={time}",
+            room_id=room.room_id,
+            playback_time=playback_time,
+            time=time,
+        )
+
+
+@command("set_episode", "episode", hoster_only=True)
+async def set_episode(user: User, room: Room, episode: str) -> None:
+    room.episode = episode
+    room.reset_playback()
+    room.pending_playback = None
+    rooms.room_changed(room)
+    await broadcast(user.ws, room, "set_episode", episode=episode)
+    log.debug(
+        "<y>{room_id}</y>: setting episode to {episode}",
+        room_id=room.room_id,
+        episode=episode,
     )
 
 
-async def seek(websocket: WebSocketServerProtocol, room: Room, data: dict) -> None:
-    if not room.is_hoster(websocket):
+@command("playback_time_request")
+async def playback_time_request(user: User, room: Room) -> None:
+    now = clock.now()
+    if (playback_time := room.current_playback_time(now)) is not None:
+        # Сервер знает актуальное состояние и отвечает сам, не спрашивая хостера
+        await send(
+            user,
+            "playback_time_request_answer",
+            time=now,
+            playback_time=playback_time,
+            playing=room.playing,
+        )
+        log.debug(
+            "<y>{room_id}</y>: playback request from {user_id}({ws_id}) "
+            "answered by server playback_time={playback_time}",
+            room_id=room.room_id,
+            user_id=user.id,
+            ws_id=user.ws.id,
+            playback_time=playback_time,
+        )
         return
 
-    if (send_time := data.get("time")) is None:
-        return await error(websocket, ParamNotPassed("time"))
-    elif (playback_time := data.get("playback_time")) is None:
-        return await error(websocket, ParamNotPassed("playback_time"))
-
-    room.playing = False
-    await broadcast(
-        websocket, room, "seek", time=send_time, playback_time=playback_time
-    )
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: seeking playback_time={playback_time} time={send_time}"
+    room.playback_waiters.add(user.id)
+    if room.playback_query is not None:
+        # Хостер уже получил запрос, его ответ придёт всем ожидающим
+        log.debug(
+            "<y>{room_id}</y>: playback request from {user_id}({ws_id}) "
+            "joined pending query",
+            room_id=room.room_id,
+            user_id=user.id,
+            ws_id=user.ws.id,
+        )
+        return
+    await query_playback_time(room, user.id)
+    log.debug(
+        "<y>{room_id}</y>: playback request from {user_id}({ws_id})",
+        room_id=room.room_id,
+        user_id=user.id,
+        ws_id=user.ws.id,
     )
 
 
-async def set_episode(
-    websocket: WebSocketServerProtocol, room: Room, data: dict
-) -> None:
-    if not room.is_hoster(websocket):
+async def query_playback_time(room: Room, user_id: USER_ID) -> None:
+    """
+    Запрашивает у хостера позицию воспроизведения для всех ожидающих её участников.
+    Пока хостер отключен, позиция запрашивается у другого подключенного участника.
+    Ответ ожидается не дольше PLAYBACK_QUERY_TIMEOUT.
+    """
+    if (source := playback_source(room)) is None:
+        room.playback_query = None
+        room.playback_waiters.clear()
         return
+    room.playback_source = source.id
+    room.playback_query = asyncio.get_running_loop().call_later(
+        PLAYBACK_QUERY_TIMEOUT,
+        expire_playback_query,
+        room,
+        context=tracing.detached(),
+    )
+    await notify(room, source, "playback_time_request", user_id=user_id)
 
-    if (episode := data.get("episode")) is None:
-        return await error(websocket, ParamNotPassed("episode"))
 
-    room.episode = episode
-    await broadcast(websocket, room, "set_episode", episode=episode)
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: setting episode to {episode}"
-    )
+async def requery_playback_time(room: Room) -> None:
+    """
+    Повторяет запрос позиции воспроизведения,
+    если участник, у которого она запрошена, уже не ответит.
+    """
+    room.playback_query.cancel()
+    room.playback_query = None
+    if room.playback_waiters:
+        await query_playback_time(room, next(iter(room.playback_waiters)))
 
 
-async def playback_time_request(websocket: WebSocketServerProtocol, room: Room) -> None:
-    user = room.get_by_ws(websocket)
-    await send(room.members[0].ws, "playback_time_request", user_id=user.id)
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: playback request from {user.id}({user.ws.id})"
+def playback_source(room: Room) -> User | None:
+    """
+    Возвращает участника, у которого запрашивается позиция воспроизведения:
+    хостера, а если он отключен - первого подключенного участника,
+    который сам не ждёт позицию. Если таких нет, запрос получит хостер
+    после возвращения.
+    """
+    if (hoster := room.hoster) is None or hoster.online:
+        return hoster
+    for member in room.members.values():
+        if member.online and member.id not in room.playback_waiters:
+            return member
+    return hoster
+
+
+def expire_playback_query(room: Room) -> None:
+    # Участник, у которого запрошена позиция, не ответил.
+    # Ожидающие могут повторить запрос
+    log.debug(
+        "<y>{room_id}</y>: playback query timed out, {count} waiting",
+        room_id=room.room_id,
+        count=len(room.playback_waiters),
     )
+    room.playback_query = None
+    room.playback_waiters.clear()
 
 
+@command("playback_time_request_answer", "time", "playback_time", "user_id")
 async def playback_time_request_answer(
-    websocket: WebSocketServerProtocol, room: Room, data: dict
+    member: User, room: Room, time: float, playback_time: float, user_id: int
 ) -> None:
-    if not room.is_hoster(websocket):
+    if member is room.hoster:
+        room.set_playback(room.playing, playback_time, time)
+    elif member.id != room.playback_source or room.playback_query is None:
+        # Отвечать может хостер или участник, которого спросили вместо него
         return
-
-    if (send_time := data.get("time")) is None:
-        return await error(websocket, ParamNotPassed("time"))
-    elif (playback_time := data.get("playback_time")) is None:
-        return await error(websocket, ParamNotPassed("playback_time"))
-    elif (user_id := data.get("user_id")) is None:
-        return await error(websocket, ParamNotPassed("user_id"))
-    if not (user := room.get_by_id(user_id)):
-        return await error(websocket, UserNotAMemberOfRoom())
-
-    await send(
-        user.ws,
-        "playback_time_request_answer",
-        time=send_time,
+    if room.playback_query is not None:
+        room.playback_query.cancel()
+        room.playback_query = None
+    waiters = room.playback_waiters
+    waiters.add(user_id)
+    room.playback_waiters = set()
+
+    # Позиция пересчитывается на время отправки, как в ответе сервера
+    now = clock.now()
+    if (current_playback_time := room.current_playback_time(now)) is not None:
+        time, playback_time = now, current_playback_time
+    for waiter_id in waiters:
+        if not (user := room.get_by_id(waiter_id)):
+            if waiter_id == user_id:
+                member_error(member, UserNotAMemberOfRoom())
+            continue
+        await notify(
+            room,
+            user,
+            "playback_time_request_answer",
+            time=time,
+            playback_time=playback_time,
+            playing=room.playing,
+        )
+    log.debug(
+        "<y>{room_id}</y>: playback request answer to {count} members "
+        "playback_time={playback_time} time={time}",
+        room_id=room.room_id,
+        count=len(waiters),
         playback_time=playback_time,
-        playing=room.playing,
-    )
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: playback request answer to {user.id}({user.ws.id}) "
-        f"playback_time={playback_time} time={send_time}"
+        time=time,
     )
 
 
-async def pause_request(websocket: WebSocketServerProtocol, room: Room) -> None:
-    user = room.get_by_ws(websocket)
-    await send(room.members[0].ws, "pause_request", sender=user.id)
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: pause request from {user.id}({user.ws.id})"
+@command("pause_request")
+async def pause_request(user: User, room: Room) -> None:
+    if (hoster := room.hoster) is None:
+        return
+    await notify(room, hoster, "pause_request", sender=user.id)
+    log.debug(
+        "<y>{room_id}</y>: pause request from {user_id}({ws_id})",
+        room_id=room.room_id,
+        user_id=user.id,
+        ws_id=user.ws.id,
     )
 
 
-async def rewind_back_request(websocket: WebSocketServerProtocol, room: Room) -> None:
-    user = room.get_by_ws(websocket)
-    await send(room.members[0].ws, "rewind_back_request", sender=user.id)
-    logger.opt(colors=True).debug(
-        f"<y>{room.room_id}</y>: rewind back request from {user.id}({user.ws.id})"
+@command("rewind_back_request")
+async def rewind_back_request(user: User, room: Room) -> None:
+    if (hoster := room.hoster) is None:
+        return
+    await notify(room, hoster, "rewind_back_request", sender=user.id)
+    log.debug(
+        "<y>{room_id}</y>: rewind back request from {user_id}({ws_id})",
+        room_id=room.room_id,
+        user_id=user.id,
+        ws_id=user.ws.id,
     )
 
 
+@command("leave_room")
+async def leave_room_command(user: User, room: Room) -> None:
+    await leave_room(user.ws, room.room_id)
+
+
+async def disconnect(
+    websocket: WebSocketServerProtocol, user: User, room: Room
+) -> None:
+    """
+    Обрабатывает закрытие соединения участника.
+    При обрыве соединения место участника сохраняется на RESUME_GRACE_PERIOD.
+    Клиент, закрывший соединение сам (например, при перезагрузке страницы),
+    не сможет вернуться по токену, поэтому сразу покидает комнату.
+    При завершении процесса участник переходит к следующему процессу,
+    поэтому остальным о его выходе не сообщается и хостер не меняется.
+    """
+    if user.ws is not websocket or room.get_by_id(user.id) is not user:
+        # Участник уже вернулся через другое соединение или покинул комнату
+        return
+    if drain.DRAINING:
+        rooms.leave_room(websocket, room.room_id)
+        return
+    if (
+        rooms.RESUME_GRACE_PERIOD > 0
+        and websocket.close_code not in CLEAN_CLOSE_CODES
+    ):
+        user.online = False
+        SESSIONS.schedule((room.room_id, user.id))
+        if (
+            room.playback_query is not None
+            and room.playback_source == user.id
+            and playback_source(room) is not user
+        ):
+            # Позицию может сообщить другой подключенный участник
+            await requery_playback_time(room)
+    else:
+        await leave_room(websocket, room.room_id)
+
+
+def expire_session(key: tuple[ROOM_ID, int]) -> None:
+    room_id, user_id = key
+    if (
+        (room := rooms.ROOMS.get(room_id))
+        and (user := room.get_by_id(user_id))
+        and not user.online
+    ):
+        asyncio.create_task(room.inbox.submit(expire_member, user, room))
+
+
+async def expire_member(user: User, room: Room) -> None:
+    # Участник мог вернуться, пока команда ждала в очереди
+    if not user.online and room.get_by_id(user.id) is user:
+        await leave_room(user.ws, room.room_id)
+
+
+# Исключает из комнат участников, не вернувшихся за RESUME_GRACE_PERIOD секунд
+SESSIONS = Reaper(expire_session, rooms.RESUME_GRACE_PERIOD)
+
+
 async def leave_room(websocket: WebSocketServerProtocol, room_id: ROOM_ID) -> None:
     leaved_user, room, hoster_changed = rooms.leave_room(websocket, room_id)
+    if not room.members:
+        BUS.unsubscribe(room_id)
     await broadcast(websocket, room, "leave_room", user_id=leaved_user.id)
     if hoster_changed:
-        await send(room.members[0].ws, "hoster_promotion")
-        logger.opt(colors=True).debug(
-            f"<y>{room.room_id}</y>: {room.members[0].id}({room.members[0].ws.id}) "
-            "is new hoster"
+        # Новый хостер получает leave_room раньше hoster_promotion
+        await notify(room, room.hoster, "hoster_promotion")
+        # Позицию новый хостер знает сам
+        room.playback_waiters.discard(room.hoster.id)
+        log.debug(
+            "<y>{room_id}</y>: {user_id}({ws_id}) is new hoster",
+            room_id=room.room_id,
+            user_id=room.hoster.id,
+            ws_id=room.hoster.ws.id,
         )
+    if room.playback_query is not None and room.playback_source == leaved_user.id:
+        await requery_playback_time(room)
 
 
-async def server_time_request(websocket: WebSocketServerProtocol, data: dict) -> None:
-    if (client_time := data.get("time")) is None:
-        return await error(websocket, ParamNotPassed("time"))
+def request_reconnect() -> None:
+    """
+    Просит всех участников переподключиться к следующему процессу сервера.
+    Хостеры переподключаются сразу, чтобы снова стать хостерами,
+    остальные - со случайной задержкой.
+    """
+    for room in rooms.ROOMS.values():
+        hoster = room.hoster
+        for member in room.members.values():
+            if member.online:
+                delay = 0 if member is hoster else drain.reconnect_delay()
+                event = dict(type="reconnect", delay=delay)
+                metrics.EVENTS_SENT["reconnect"] += 1
+                member.outbox.send(member.codec.encode(event), "reconnect")
+
+
+@command("server_time_request", "time", direct=True)
+async def server_time_request(
+    user: User, _room: Room, time: float, receive_time: float
+) -> None:
+    """
+    Отвечает на запрос синхронизации времени, как сервер NTP:
+    время отправки запроса клиентом, время получения запроса
+    и время отправки ответа сервером.
+    По ним клиент вычисляет задержку сети и смещение своих часов.
+    Запрос не ждёт в очереди комнаты, иначе ожидание попало бы
+    в задержку сети и исказило бы смещение часов.
+    """
+    transmit_time = clock.now()
     await send(
-        websocket,
+        user,
         "server_time_request_answer",
-        client_time=client_time,
-        server_time=datetime.utcnow().timestamp(),
+        client_time=time,
+        receive_time=receive_time,
+        transmit_time=transmit_time,
+        # Для клиентов, которые не знают receive_time и transmit_time
+        server_time=transmit_time,
     )
 
 
 async def error(
     websocket: WebSocketServerProtocol,
     exc: AniTogetherError,
+    codec: Codec = DEFAULT_CODEC,
 ) -> None:
     """
     Send an error message.
     """
-    await send(websocket, "error", code=exc.code, message=exc.message)
-    logger.opt(colors=True).debug(
-        f"<r>{websocket.id}</r> raises error: <bold>{type(exc).__name__}: {exc}</bold>"
+    await websocket.send(codec.encode(error_event(websocket, exc)))
+
+
+def member_error(user: User, exc: AniTogetherError) -> None:
+    """
+    Отправляет ошибку участнику комнаты через его очередь сообщений,
+    чтобы клиент, который не читает сообщения, не задерживал комнату.
+    """
+    user.outbox.send(user.codec.encode(error_event(user.ws, exc)), "error")
+
+
+def error_event(websocket: WebSocketServerProtocol, exc: AniTogetherError) -> dict:
+    event = dict(type="error", code=exc.code, message=exc.message)
+    if exc.retry_after is not None:
+        event["retry_after"] = exc.retry_after
+    metrics.ERRORS[exc.code] += 1
+    metrics.EVENTS_SENT["error"] += 1
+    if (span := tracing.CURRENT.get()) is not None:
+        span.event("sent error")
+    log.debug(
+        "<r>{ws_id}</r> raises error: <bold>{error}: [{code}] {message}</bold>",
+        ws_id=websocket.id,
+        error=type(exc).__name__,
+        code=exc.code,
+        message=exc.message,
     )
+    return event
 
 
 async def broadcast(
@@ -261,22 +705,208 @@ async def broadcast(
     exclude_sender: bool = True,
     **data: ty.Any,
 ) -> None:
+    """
+    Отправляет событие участникам комнаты через шину событий.
+    """
     event = dict(type=event_type, **data)
-    try:
-        websockets.broadcast(
-            (
-                member.ws
-                for member in room.members
-                if member.ws.id != websocket.id or not exclude_sender
-            ),
-            json.dumps(event),
+    BUS.publish(room.room_id, event, websocket.id if exclude_sender else None)
+
+
+def broadcast_playback(
+    user: User, room: Room, event_type: str, request_id: int | None = None
+) -> None:
+    """
+    Рассылает состояние воспроизведения комнаты после команды хостера.
+    Первое событие рассылается сразу, из последующих в течение
+    PLAYBACK_COALESCE_WINDOW - только последнее, по окончании окна.
+    :param request_id: Идентификатор команды, который передаётся в событии,
+        чтобы клиент мог сопоставить событие с командой.
+    """
+    if room.playback_flush is not None:
+        room.pending_playback = (user.ws, event_type, request_id)
+        if (span := tracing.CURRENT.get()) is not None:
+            # Событие будет разослано по окончании окна
+            span.event("coalesced")
+        return
+    publish_playback(room, user.ws, event_type, request_id)
+    if PLAYBACK_COALESCE_WINDOW > 0:
+        room.playback_flush = asyncio.get_running_loop().call_later(
+            PLAYBACK_COALESCE_WINDOW, flush_playback, room, context=tracing.detached()
         )
-    except ConnectionResetError:
-        pass
 
 
-async def send(
-    websocket: WebSocketServerProtocol, event_type: str, **data: ty.Any
+def flush_playback(room: Room) -> None:
+    room.playback_flush = None
+    if room.pending_playback is not None:
+        websocket, event_type, request_id = room.pending_playback
+        room.pending_playback = None
+        # Новое окно, чтобы непрерывная перемотка рассылалась не чаще раза в окно
+        room.playback_flush = asyncio.get_running_loop().call_later(
+            PLAYBACK_COALESCE_WINDOW, flush_playback, room, context=tracing.detached()
+        )
+        publish_playback(room, websocket, event_type, request_id)
+
+
+def publish_playback(
+    room: Room,
+    websocket: WebSocketServerProtocol,
+    event_type: str,
+    request_id: int | None = None,
 ) -> None:
+    """
+    Публикует событие с текущим состоянием воспроизведения комнаты.
+    Позиция пересчитывается на текущее время сервера.
+    pause тоже содержит позицию, так как в неё могла объединиться перемотка.
+    """
+    event = dict(type=event_type)
+    if room.playback_time is not None:
+        now = clock.now()
+        if (playback_time := room.current_playback_time(now)) is None:
+            now, playback_time = room.playback_timestamp, room.playback_time
+        event.update(time=now, playback_time=playback_time)
+    elif event_type != "pause":
+        return
+    if request_id is not None:
+        event["request_id"] = request_id
+    BUS.publish(room.room_id, event, websocket.id)
+
+
+def deliver(room: Room, event: dict, exclude: UUID | None) -> None:
+    """
+    Передаёт событие участникам комнаты.
+    События команд, выполненных за один проход по очереди комнаты,
+    рассылаются вместе по окончании прохода, остальные - сразу.
+    """
+    if (span := tracing.CURRENT.get()) is not None:
+        span.pending += 1
+    if not room.inbox.busy:
+        room.outgoing.append((event, exclude, span))
+        return flush_events(room)
+    if not room.outgoing:
+        room.inbox.after_pass(flush_events, room)
+    room.outgoing.append((event, exclude, span))
+
+
+def flush_events(room: Room) -> None:
+    """
+    Рассылает накопленные события комнаты.
+    Клиенты, поддерживающие массивы событий, получают их одним кадром,
+    если успевают принимать сообщения. Кадр кодируется один раз для каждой группы участников
+    с одинаковым кодеком и набором событий.
+    """
+    outgoing, room.outgoing = room.outgoing, []
+    spans = Counter(span for _, _, span in outgoing if span is not None)
+    if not outgoing or rooms.ROOMS.get(room.room_id) is not room:
+        # Нечего рассылать или комната удалена
+        for span, count in spans.items():
+            tracing.flushed(span, count, fanout=0)
+        return
+    start_time = perf_counter()
+    # События нумеруются при рассылке, чтобы участник, вернувшийся
+    # в комнату до рассылки, не получил их дважды
+    events = [
+        (room.record_event(event, exclude), exclude) for event, exclude, _ in outgoing
+    ]
+    senders = {exclude for _, exclude in events if exclude is not None}
+
+    # (кодек, принимает массивы, номера исключённых событий) -> участники
+    groups: dict[tuple[Codec, bool, tuple[int, ...]], list[User]] = {}
+    for member in room.members.values():
+        if not member.online:
+            continue
+        skipped = ()
+        if member.ws.id in senders:
+            skipped = tuple(
+                i for i, (_, exclude) in enumerate(events) if exclude == member.ws.id
+            )
+        groups.setdefault((member.codec, member.batch, skipped), []).append(member)
+
+    fanout = queued = 0
+    encode_time = 0.0
+    for (codec, batch, skipped), members in groups.items():
+        group_events = [event for i, (event, _) in enumerate(events) if i not in skipped]
+        if not group_events:
+            continue
+        for event in group_events:
+            metrics.EVENTS_SENT[event["type"]] += len(members)
+        fanout += len(members)
+        # Клиентам, которые успевают принимать сообщения, кадры пишутся сразу,
+        # остальным - ставятся в очередь
+        ready, slow = [], []
+        for member in members:
+            (ready if member.outbox.ready() else slow).append(member)
+        batched = batch and len(group_events) > 1
+        encode_start = perf_counter()
+        frames = []
+        if slow or not batched:
+            frames = [
+                (codec.encode(event), event["type"], event) for event in group_events
+            ]
+        ready_frames = [frame for frame, _, _ in frames]
+        if ready and batched:
+            ready_frames = [codec.encode_batch(group_events)]
+        encode_time += perf_counter() - encode_start
+        if ready:
+            for frame in ready_frames:
+                try:
+                    websockets.broadcast([member.ws for member in ready], frame)
+                except ConnectionResetError:
+                    pass
+        # В очередь события ставятся по одному, а не массивом,
+        # чтобы события воспроизведения объединялись с уже ожидающими
+        for member in slow:
+            for frame, event_type, event in frames:
+                member.outbox.put(frame, event_type, event)
+                queued += 1
+    duration = perf_counter() - start_time
+    metrics.BROADCAST_EVENTS.observe(len(events))
+    metrics.BROADCAST_LATENCY.observe(duration)
+    for span, count in spans.items():
+        tracing.flushed(
+            span,
+            count,
+            events=len(events),
+            fanout=fanout,
+            queued=queued,
+            encode_ms=round(encode_time * 1000, 3),
+            write_ms=round((duration - encode_time) * 1000, 3),
+        )
+
+
+async def notify(room: Room, user: User, event_type: str, **data: ty.Any) -> None:
+    """
+    Отправляет событие одному участнику комнаты.
+    Событие нумеруется и сохраняется в буфер последних событий комнаты,
+    поэтому отключившийся участник получит его после возвращения.
+    """
+    if room.outgoing:
+        # Номера событий должны идти в порядке отправки
+        flush_events(room)
+    event = room.record_event(dict(type=event_type, **data), recipient=user.id)
+    if not user.online:
+        if (span := tracing.CURRENT.get()) is not None:
+            span.event(f"recorded {event_type}")
+        return
+    metrics.EVENTS_SENT[event_type] += 1
+    user.outbox.send(user.codec.encode(event), event_type)
+    if (span := tracing.CURRENT.get()) is not None:
+        span.event(f"sent {event_type}")
+
+
+def deliver_from_bus(room_id: ROOM_ID, event: dict, exclude: UUID | None) -> None:
+    """
+    Передаёт событие из шины участникам комнаты в текущем процессе.
+    """
+    if room := rooms.ROOMS.get(room_id):
+        deliver(room, event, exclude)
+
+
+BUS = create_bus(deliver_from_bus)
+
+
+async def send(user: User, event_type: str, **data: ty.Any) -> None:
     event = dict(type=event_type, **data)
-    await websocket.send(json.dumps(event))
+    metrics.EVENTS_SENT[event_type] += 1
+    user.outbox.send(user.codec.encode(event), event_type)
+    if (span := tracing.CURRENT.get()) is not None:
+        span.event(f"sent {event_type}")
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+
+# Модули сервера импортируют друг друга как модули верхнего уровня
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "AniTogetherServer")
+)
+os.environ.setdefault("COMPATIBLE_VERSION", "1.0.0-betta.4")
+
+
+@pytest.fixture(autouse=True)
+def clean_rooms():
+    import rooms
+
+    yield
+    rooms.ROOMS.clear()
+    rooms.CHANGED_ROOMS.clear()
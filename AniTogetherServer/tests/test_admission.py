@@ -0,0 +1,52 @@
+import json
+from collections import Counter
+
+import pytest
+
+import admission
+import http_server
+import metrics
+from exceptions import ServerIsOverloaded
+
+
+@pytest.fixture
+def overloaded(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_LOOP_LAG", 0.1)
+    monkeypatch.setattr(admission, "RETRY_AFTER", 5)
+    monkeypatch.setattr(metrics.LOOP_LAG_LAST, "value", 0.5)
+    monkeypatch.setattr(metrics, "REQUESTS_SHED", Counter())
+
+
+def test_admit_when_not_overloaded(monkeypatch):
+    monkeypatch.setattr(metrics.LOOP_LAG_LAST, "value", 0.0)
+    monkeypatch.setattr(metrics.CONNECTIONS, "value", 0.0)
+    monkeypatch.setattr(metrics.SEND_QUEUE_DEPTH, "value", 0.0)
+    assert admission.overload_reason() is None
+    admission.admit("join")
+
+
+def test_join_is_rejected_with_retry_after(overloaded):
+    with pytest.raises(ServerIsOverloaded) as err:
+        admission.admit("join")
+    assert 5 <= err.value.retry_after <= 10
+    assert metrics.REQUESTS_SHED[("join", "loop_lag")] == 1
+
+
+def test_connections_limit(monkeypatch):
+    monkeypatch.setattr(admission, "MAX_CONNECTIONS", 10)
+    monkeypatch.setattr(metrics.LOOP_LAG_LAST, "value", 0.0)
+    monkeypatch.setattr(metrics.CONNECTIONS, "value", 10.0)
+    # Соединение подключающегося участника уже учтено
+    assert admission.overload_reason(new_connections=0) is None
+    assert admission.overload_reason() == "connections"
+
+
+def test_create_room_is_rejected_with_retry_after(overloaded):
+    _, _, body = http_server.create_room(
+        {"title_id": 1, "episode": 1, "version": "1.0.0"}
+    )
+    answer = json.loads(body)
+    assert answer["status"] == "fail"
+    assert answer["code"] == ServerIsOverloaded.code
+    assert 5 <= answer["retry_after"] <= 10
+    assert metrics.REQUESTS_SHED[("create_room", "loop_lag")] == 1
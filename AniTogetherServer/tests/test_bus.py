@@ -0,0 +1,118 @@
+import asyncio
+import importlib.util
+import os
+import uuid
+
+import pytest
+
+import bus
+from bus import InMemoryBus, RedisBus, create_bus, encode_command, read_reply
+
+
+RESP_STUB = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "tools", "resp_stub.py"
+)
+
+
+@pytest.fixture
+def resp_stub():
+    spec = importlib.util.spec_from_file_location("resp_stub", RESP_STUB)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Recorder:
+    """
+    Запоминает события, которые шина передала участникам процесса.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def __call__(self, room_id, event, exclude):
+        self.events.append((room_id, event, exclude))
+
+
+async def wait_for(condition, timeout: float = 2) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline
+        await asyncio.sleep(0.01)
+
+
+def test_create_bus(monkeypatch):
+    monkeypatch.delenv("ROOM_BUS", raising=False)
+    assert type(create_bus(Recorder())) is InMemoryBus
+    monkeypatch.setenv("ROOM_BUS", "redis://127.0.0.1:6380/anitogether")
+    redis_bus = create_bus(Recorder())
+    assert type(redis_bus) is RedisBus
+    assert (redis_bus.host, redis_bus.port) == ("127.0.0.1", 6380)
+    assert redis_bus.channel("abc") == b"anitogether:room:abc"
+
+
+def test_in_memory_bus():
+    deliver = Recorder()
+    memory_bus = InMemoryBus(deliver)
+    exclude = uuid.uuid4()
+    memory_bus.subscribe("room")
+    memory_bus.publish("room", {"type": "play"}, exclude)
+    assert deliver.events == [("room", {"type": "play"}, exclude)]
+
+
+def test_resp_round_trip():
+    async def main():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encode_command(b"PUBLISH", b"room:a", b"{}"))
+        reader.feed_data(b"+OK\r\n-ERR wrong\r\n:3\r\n$-1\r\n")
+        reader.feed_eof()
+        return [await read_reply(reader) for _ in range(5)]
+
+    command, ok, err, count, null = asyncio.run(main())
+    assert command == [b"PUBLISH", b"room:a", b"{}"]
+    assert (ok, count, null) == (b"OK", 3, None)
+    assert isinstance(err, bus.RedisError) and str(err) == "ERR wrong"
+
+
+def test_redis_bus(resp_stub):
+    async def main():
+        server = await asyncio.start_server(resp_stub.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        first, second = Recorder(), Recorder()
+        first_bus = RedisBus(first, f"redis://127.0.0.1:{port}/test")
+        second_bus = RedisBus(second, f"redis://127.0.0.1:{port}/test")
+        async with server:
+            await first_bus.start()
+            await second_bus.start()
+            try:
+                for room_bus in (first_bus, second_bus):
+                    room_bus.subscribe("room")
+                channel = first_bus.channel("room")
+                await wait_for(lambda: len(resp_stub.SUBSCRIBERS[channel]) == 2)
+
+                exclude = uuid.uuid4()
+                first_bus.publish("room", {"type": "play"}, exclude)
+                # Участникам своего процесса событие доставляется сразу
+                assert first.events == [("room", {"type": "play"}, exclude)]
+                await wait_for(lambda: second.events)
+                assert second.events == [("room", {"type": "play"}, None)]
+
+                second_bus.unsubscribe("room")
+                await wait_for(lambda: len(resp_stub.SUBSCRIBERS[channel]) == 1)
+                first_bus.publish("room", {"type": "pause"}, exclude)
+                second_bus.publish("room", {"type": "seek"}, None)
+                await wait_for(lambda: len(first.events) == 3)
+                await asyncio.sleep(0.05)
+            finally:
+                await first_bus.close()
+                await second_bus.close()
+        return first.events, second.events
+
+    first_events, second_events = asyncio.run(main())
+    # Свои сообщения из Redis не доставляются повторно
+    assert [event["type"] for _, event, _ in first_events] == [
+        "play",
+        "pause",
+        "seek",
+    ]
+    assert [event["type"] for _, event, _ in second_events] == ["play", "seek"]
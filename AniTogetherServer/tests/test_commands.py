@@ -0,0 +1,52 @@
+import pytest
+
+from exceptions import InvalidParam, ParamNotPassed
+from ws_server import COMMANDS, validate
+
+
+def test_validate_returns_params():
+    data = {"command": "seek", "time": 10.5, "playback_time": 3, "extra": "x"}
+    assert validate(data, ("time", "playback_time")) == {
+        "time": 10.5,
+        "playback_time": 3,
+    }
+
+
+def test_validate_optional_params():
+    params = ("time", "playback_time")
+    optional = ("request_id",)
+    data = {"time": 1.0, "playback_time": 2.0}
+    assert "request_id" not in validate(data, params, optional)
+    assert validate(dict(data, request_id=7), params, optional)["request_id"] == 7
+
+
+def test_validate_missing_param():
+    with pytest.raises(ParamNotPassed) as err:
+        validate({"time": 1.0}, ("time", "playback_time"))
+    assert "playback_time" in err.value.message
+
+
+@pytest.mark.parametrize(
+    "param, value",
+    [
+        ("time", "10"),
+        ("playback_time", True),
+        ("user_id", 1.5),
+        ("episode", [1]),
+        ("request_id", "1"),
+    ],
+)
+def test_validate_wrong_type(param, value):
+    with pytest.raises(InvalidParam):
+        validate({param: value}, (param,))
+
+
+def test_validate_wrong_type_of_optional_param():
+    with pytest.raises(InvalidParam):
+        validate({"request_id": "1"}, (), ("request_id",))
+
+
+def test_hoster_commands():
+    hoster_only = {name for name, cmd in COMMANDS.items() if cmd.hoster_only}
+    assert hoster_only == {"pause", "play", "seek", "set_episode"}
+    assert COMMANDS["server_time_request"].direct
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+import rooms
+import ws_server
+from inbox import Inbox
+from protocol import get_codec
+
+
+class Transport:
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+
+class WebSocket:
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.transport = Transport()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """
+    Кадры, отправленные участникам: (участник, событие или массив событий).
+    """
+    frames = []
+
+    def broadcast(websockets, frame):
+        for websocket in websockets:
+            frames.append((websocket, json.loads(frame)))
+
+    monkeypatch.setattr(ws_server.websockets, "broadcast", broadcast)
+    return frames
+
+
+def test_commands_run_in_order_without_interleaving():
+    async def main():
+        inbox = Inbox()
+        log = []
+
+        async def handler(name):
+            log.append(f"{name} start")
+            await asyncio.sleep(0)
+            log.append(f"{name} end")
+
+        await asyncio.gather(*(inbox.submit(handler, name) for name in "abc"))
+        while inbox.busy:
+            await asyncio.sleep(0)
+        return log
+
+    assert asyncio.run(main()) == [
+        "a start",
+        "a end",
+        "b start",
+        "b end",
+        "c start",
+        "c end",
+    ]
+
+
+def test_after_pass_runs_once_per_pass():
+    async def main():
+        inbox = Inbox()
+        log = []
+
+        async def handler(name):
+            if not log or log[-1] == "flush":
+                inbox.after_pass(log.append, "flush")
+            log.append(name)
+            await asyncio.sleep(0)
+
+        await asyncio.gather(*(inbox.submit(handler, name) for name in "abc"))
+        while inbox.busy:
+            await asyncio.sleep(0)
+        return log
+
+    # Первая команда выполняется сразу, пришедшие за время её выполнения -
+    # следующим проходом
+    assert asyncio.run(main()) == ["a", "flush", "b", "c", "flush"]
+
+
+def join(room: rooms.Room, batch: bool) -> rooms.User:
+    user, _ = rooms.join_to_room(WebSocket(), room.room_id, get_codec("json"))
+    user.batch = batch
+    return user
+
+
+def test_events_of_one_pass_are_batched(sent):
+    room = rooms.get_room(rooms.create_room(1, "1"))
+    hoster, batching, plain = join(room, True), join(room, True), join(room, False)
+
+    async def command():
+        await ws_server.broadcast(hoster.ws, room, "seek", playback_time=1.0)
+        await ws_server.broadcast(hoster.ws, room, "pause")
+        # События рассылаются по окончании прохода
+        assert not sent
+
+    asyncio.run(room.inbox.submit(command))
+    received = {}
+    for websocket, frame in sent:
+        received.setdefault(websocket, []).append(frame)
+
+    assert hoster.ws not in received
+    # Клиент, принимающий массивы, получает события одним кадром
+    [batch] = received[batching.ws]
+    assert [event["type"] for event in batch] == ["seek", "pause"]
+    assert [event["type"] for event in received[plain.ws]] == ["seek", "pause"]
+    assert [event["seq"] for event in batch] == [
+        event["seq"] for event in received[plain.ws]
+    ]
+
+
+def test_event_outside_of_pass_is_sent_at_once(sent):
+    room = rooms.get_room(rooms.create_room(1, "1"))
+    hoster, viewer = join(room, True), join(room, True)
+
+    asyncio.run(ws_server.broadcast(hoster.ws, room, "pause"))
+    assert [(websocket, frame["type"]) for websocket, frame in sent] == [
+        (viewer.ws, "pause")
+    ]
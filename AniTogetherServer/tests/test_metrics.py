@@ -0,0 +1,24 @@
+from metrics import merge
+
+
+def test_merge():
+    shard0 = (
+        "# HELP anitogether_rooms Rooms\n"
+        "# TYPE anitogether_rooms gauge\n"
+        "anitogether_rooms 2\n"
+        "# TYPE anitogether_events_sent_total counter\n"
+        'anitogether_events_sent_total{type="seek"} 5\n'
+    )
+    shard1 = (
+        "# HELP anitogether_rooms Rooms\n"
+        "# TYPE anitogether_rooms gauge\n"
+        "anitogether_rooms 3\n"
+    )
+    assert merge([("0", shard0), ("1", shard1)], "shard") == (
+        "# HELP anitogether_rooms Rooms\n"
+        "# TYPE anitogether_rooms gauge\n"
+        'anitogether_rooms{shard="0"} 2\n'
+        'anitogether_rooms{shard="1"} 3\n'
+        "# TYPE anitogether_events_sent_total counter\n"
+        'anitogether_events_sent_total{shard="0",type="seek"} 5\n'
+    )
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+import outbox
+from outbox import Outbox, merge_playback
+from protocol import get_codec
+
+
+class Transport:
+    def __init__(self, size: int):
+        self.size = size
+
+    def get_write_buffer_size(self) -> int:
+        return self.size
+
+
+class SlowWebSocket:
+    """
+    Соединение, буфер отправки которого переполнен.
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.transport = Transport(outbox.SEND_BUFFER_LIMIT)
+        self.closed_with = None
+
+    async def send(self, frame):
+        await asyncio.Future()
+
+    def fail_connection(self, code: int, reason: str) -> None:
+        self.closed_with = code
+
+
+def test_merge_playback_takes_new_state():
+    previous = dict(type="seek", time=1.0, playback_time=10.0)
+    event = dict(type="play", time=2.0, playback_time=20.0)
+    assert merge_playback(previous, event) is event
+
+
+def test_merge_playback_keeps_position_for_pause_without_it():
+    previous = dict(type="seek", time=1.0, playback_time=10.0)
+    assert merge_playback(previous, dict(type="pause")) == dict(
+        type="pause", time=1.0, playback_time=10.0
+    )
+
+
+def test_merge_playback_ignores_stale_play_position():
+    previous = dict(type="play", time=1.0, playback_time=10.0)
+    event = dict(type="pause")
+    assert merge_playback(previous, event) is event
+
+
+def queued_events(box: Outbox) -> list[dict]:
+    return [json.loads(entry[0]) for entry in box.queue if entry[0] is not None]
+
+
+def test_queued_playback_events_are_merged():
+    async def scenario():
+        box = Outbox(SlowWebSocket(), get_codec("json"))
+        box.put('{"type":"join","user_id":1}', "join")
+        for i in range(10):
+            event = dict(type="seek", time=float(i), playback_time=float(i))
+            box.put(json.dumps(event), "seek", event)
+        box.put('{"type":"pause"}', "pause", dict(type="pause"))
+        # Очередь проверяется до того, как задача отправки начнёт её разбирать
+        assert box.size == 2
+        assert queued_events(box) == [
+            dict(type="join", user_id=1),
+            dict(type="pause", time=9.0, playback_time=9.0),
+        ]
+
+    asyncio.run(scenario())
+
+
+def test_slow_client_is_dropped(monkeypatch):
+    monkeypatch.setattr(outbox, "SEND_QUEUE_LIMIT", 3)
+
+    async def scenario():
+        box = Outbox(SlowWebSocket(), get_codec("json"))
+        for i in range(4):
+            box.put(f'{{"type":"join","user_id":{i}}}', "join")
+        return box
+
+    box = asyncio.run(scenario())
+    assert box.closed
+    assert box.ws.closed_with == 1013
+    assert box.size == 0
+
+
+@pytest.mark.parametrize("size, ready", [(0, True), (outbox.SEND_BUFFER_LIMIT, False)])
+def test_ready(size, ready):
+    ws = SlowWebSocket()
+    ws.transport.size = size
+    assert Outbox(ws, get_codec("json")).ready() is ready
+
+
+def test_playback_events_are_not_merged_across_episode_change():
+    async def scenario():
+        box = Outbox(SlowWebSocket(), get_codec("json"))
+        seek = dict(type="seek", time=1.0, playback_time=500.0)
+        box.put(json.dumps(seek), "seek", seek)
+        box.put('{"type":"set_episode","episode":"2"}', "set_episode")
+        box.put('{"type":"pause"}', "pause", dict(type="pause"))
+        assert queued_events(box) == [
+            seek,
+            dict(type="set_episode", episode="2"),
+            dict(type="pause"),
+        ]
+
+    asyncio.run(scenario())
@@ -0,0 +1,72 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+import clock
+import rooms
+import ws_server
+from protocol import get_codec
+
+
+class Transport:
+    def get_write_buffer_size(self) -> int:
+        return 0
+
+
+class WebSocket:
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.transport = Transport()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    events = []
+
+    def broadcast(websockets, frame):
+        for websocket in websockets:
+            events.append((websocket, json.loads(frame)))
+
+    monkeypatch.setattr(ws_server.websockets, "broadcast", broadcast)
+    return events
+
+
+def test_playback_events_are_coalesced_within_window(sent, monkeypatch):
+    monkeypatch.setattr(ws_server, "PLAYBACK_COALESCE_WINDOW", 0.05)
+    room = rooms.get_room(rooms.create_room(1, "1"))
+    codec = get_codec("json")
+    hoster, _ = rooms.join_to_room(WebSocket(), room.room_id, codec)
+    viewer, _ = rooms.join_to_room(WebSocket(), room.room_id, codec)
+
+    def viewer_events() -> list[tuple[str, float]]:
+        return [
+            (event["type"], event["playback_time"])
+            for websocket, event in sent
+            if websocket is viewer.ws
+        ]
+
+    async def main():
+        room.set_playback(False, 0.0, clock.now())
+        ws_server.broadcast_playback(hoster, room, "seek")
+        # Первое событие рассылается сразу
+        assert viewer_events() == [("seek", 0.0)]
+
+        for playback_time in range(1, 10):
+            room.set_playback(False, float(playback_time), clock.now())
+            ws_server.broadcast_playback(hoster, room, "seek")
+        room.set_playback(False, 9.5, clock.now())
+        ws_server.broadcast_playback(hoster, room, "pause", request_id=3)
+        assert len(viewer_events()) == 1
+
+        await asyncio.sleep(0.08)
+        # Из событий окна рассылается только последнее
+        assert viewer_events() == [("seek", 0.0), ("pause", 9.5)]
+        assert [event.get("request_id") for _, event in sent] == [None, 3]
+
+        await asyncio.sleep(0.08)
+        assert len(viewer_events()) == 2
+        assert room.playback_flush is None
+
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+import asyncio
+import http
+
+import pytest
+
+import http_server
+import profiler
+
+
+@pytest.fixture
+def admin_token(monkeypatch):
+    monkeypatch.setattr(profiler, "ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(profiler, "_capture", None)
+    monkeypatch.setattr(profiler, "_result", None)
+
+
+def status(answer) -> http.HTTPStatus:
+    return answer[0]
+
+
+def test_profile_runs_in_background(admin_token):
+    async def main():
+        assert status(http_server.profile_result({"token": "secret"})) == 404
+        started = http_server.profile({"seconds": 0.05, "token": "secret"})
+        assert status(started) == http.HTTPStatus.ACCEPTED
+        # Запрос отвечает сразу, не дожидаясь конца профилирования
+        assert profiler.running()
+        again = http_server.profile({"seconds": 0.05, "token": "secret"})
+        assert status(again) == http.HTTPStatus.CONFLICT
+        running = http_server.profile_result({"token": "secret"})
+        assert status(running) == http.HTTPStatus.ACCEPTED
+
+        await asyncio.sleep(0.05)
+        while profiler.running():
+            await asyncio.sleep(0.01)
+        result = http_server.profile_result({"token": "secret"})
+        assert status(result) == http.HTTPStatus.OK
+
+    asyncio.run(main())
+
+
+def test_profile_requires_token(admin_token):
+    assert status(http_server.profile({"token": "wrong"})) == 403
+    assert status(http_server.profile_result({})) == 403
@@ -0,0 +1,31 @@
+import pytest
+
+import ratelimit
+from ratelimit import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ratelimit, "monotonic", lambda: now[0])
+    return now
+
+
+def test_burst(clock):
+    bucket = TokenBucket(rate=1, burst=3)
+    assert [bucket.take() for _ in range(4)] == [True, True, True, False]
+
+
+def test_refill(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.take() and bucket.take()
+    assert not bucket.take()
+    clock[0] += 0.5
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_refill_is_capped_by_burst(clock):
+    bucket = TokenBucket(rate=10, burst=2)
+    clock[0] += 60
+    assert [bucket.take() for _ in range(3)] == [True, True, False]
@@ -0,0 +1,74 @@
+import pytest
+
+import reaper
+from reaper import Reaper
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(reaper.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_expire(clock):
+    expired = []
+    r = Reaper(expired.append, ttl=10)
+    r.schedule("a")
+    r.schedule("b", ttl=5)
+    assert r.expire() == 5
+    clock[0] += 5
+    assert r.expire() == 5
+    assert expired == ["b"]
+    clock[0] += 5
+    assert r.expire() is None
+    assert expired == ["b", "a"]
+    assert len(r) == 0
+
+
+def test_cancel(clock):
+    expired = []
+    r = Reaper(expired.append, ttl=10)
+    r.schedule("a")
+    r.cancel("a")
+    clock[0] += 10
+    assert r.expire() is None
+    assert expired == []
+
+
+def test_reschedule(clock):
+    expired = []
+    r = Reaper(expired.append, ttl=10)
+    r.schedule("a")
+    clock[0] += 5
+    r.schedule("a")
+    clock[0] += 5
+    assert r.expire() == 5
+    assert expired == []
+    clock[0] += 5
+    r.expire()
+    assert expired == ["a"]
+
+
+def test_failed_callback_does_not_stop_expiry(clock):
+    expired = []
+
+    def on_expire(key):
+        if key == "a":
+            raise RuntimeError()
+        expired.append(key)
+
+    r = Reaper(on_expire, ttl=10)
+    r.schedule("a")
+    r.schedule("b")
+    clock[0] += 10
+    r.expire()
+    assert expired == ["b"]
+
+
+def test_heap_is_compacted(clock):
+    r = Reaper(lambda key: None, ttl=10)
+    for _ in range(100):
+        r.schedule("a")
+    assert len(r) == 1
+    assert len(r._heap) <= 65
@@ -0,0 +1,81 @@
+import uuid
+
+import pytest
+
+import clock
+import rooms
+from protocol import get_codec
+
+
+class WebSocket:
+    def __init__(self):
+        self.id = uuid.uuid4()
+        self.transport = None
+
+
+@pytest.fixture
+def room():
+    return rooms.get_room(rooms.create_room(1, "1"))
+
+
+def join(room: rooms.Room) -> rooms.User:
+    user, _ = rooms.join_to_room(WebSocket(), room.room_id, get_codec("json"))
+    return user
+
+
+def test_hoster_changes_on_leave(room):
+    hoster, viewer = join(room), join(room)
+    assert room.is_hoster(hoster.ws)
+    _, _, hoster_changed = rooms.leave_room(hoster.ws, room.room_id)
+    assert hoster_changed
+    assert room.hoster is viewer
+
+
+def test_missed_events(room):
+    hoster, viewer = join(room), join(room)
+    last_seq = room.last_seq
+    room.record_event(dict(type="seek"), exclude=hoster.ws.id)
+    room.record_event(dict(type="pause_request"), recipient=hoster.id)
+    room.record_event(dict(type="hoster_promotion"), recipient=viewer.id)
+    assert [e["type"] for e in room.missed_events(hoster.id, last_seq)] == [
+        "pause_request"
+    ]
+    assert [e["type"] for e in room.missed_events(viewer.id, last_seq)] == [
+        "seek",
+        "hoster_promotion",
+    ]
+
+
+def test_missed_events_out_of_buffer(room):
+    user = join(room)
+    for _ in range(rooms.EVENT_BUFFER_SIZE + 1):
+        room.record_event(dict(type="seek"), None)
+    assert room.missed_events(user.id, 0) is None
+    assert room.missed_events(user.id, "1") is None
+
+
+def test_resume_rotates_token(room):
+    user = join(room)
+    token = user.token
+    assert room.get_by_token(token) is user
+    resumed, _, previous_ws = rooms.resume_session(
+        WebSocket(), room.room_id, token, get_codec("json")
+    )
+    assert resumed is user and previous_ws is not user.ws
+    assert room.get_by_token(token) is None
+    assert room.get_by_token(user.token) is user
+
+
+def test_paused_position_does_not_expire(room):
+    now = clock.now()
+    room.set_playback(False, 42.0, now)
+    later = now + rooms.PLAYBACK_STATE_TTL + 1
+    assert room.current_playback_time(later) == 42.0
+
+
+def test_playing_position_expires(room):
+    now = clock.now()
+    room.set_playback(True, 42.0, now)
+    assert room.current_playback_time(now + 1) == pytest.approx(43.0)
+    later = now + rooms.PLAYBACK_STATE_TTL + 1
+    assert room.current_playback_time(later) is None
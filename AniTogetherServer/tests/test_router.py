@@ -0,0 +1,98 @@
+import asyncio
+import http
+import json
+import socket
+
+import pytest
+
+import router
+import sharding
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind((router.WORKER_HOST, 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def worker_ports(monkeypatch):
+    ports = []
+    monkeypatch.setattr(router, "WORKER_PORTS", ports)
+    return ports
+
+
+def assert_unavailable(answer):
+    status, _, body = answer
+    assert status == http.HTTPStatus.SERVICE_UNAVAILABLE
+    assert json.loads(body)["status"] == "fail"
+
+
+def test_proxy_http_to_stopped_worker(worker_ports):
+    worker_ports.append(free_port())
+    assert_unavailable(asyncio.run(router.proxy_http(0, "/get_room?room_id=a")))
+
+
+def test_proxy_http_to_hung_worker(worker_ports, monkeypatch):
+    monkeypatch.setattr(router, "PROXY_TIMEOUT", 0.1)
+
+    async def main():
+        # Обработчик принимает соединение, но не отвечает
+        server = await asyncio.start_server(
+            lambda reader, writer: None, router.WORKER_HOST, 0
+        )
+        worker_ports.append(server.sockets[0].getsockname()[1])
+        async with server:
+            return await router.proxy_http(0, "/get_room?room_id=a")
+
+    assert_unavailable(asyncio.run(main()))
+
+
+def test_proxy_http(worker_ports):
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}")
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, router.WORKER_HOST, 0)
+        worker_ports.append(server.sockets[0].getsockname()[1])
+        async with server:
+            return await router.proxy_http(0, "/get_room?room_id=a")
+
+    assert asyncio.run(main())[::2] == (http.HTTPStatus.OK, b"{}")
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setattr(sharding, "WORKERS", 4)
+
+
+def test_shard_of(workers):
+    # Номер шарда закодирован в первом символе идентификатора комнаты
+    assert [sharding.shard_of(room_id) for room_id in ("abc", "bcd", "ezz")] == [
+        0,
+        1,
+        0,
+    ]
+    assert sharding.shard_of("") == 0
+    assert sharding.shard_of("!bad") == 0
+
+
+def test_room_id_from():
+    assert router.room_id_from("version=1.0.0&room_id=0123") == "0123"
+    assert router.room_id_from("version=1.0.0") == ""
+
+
+def test_handoff_shard(workers):
+    head = (
+        b"GET /?room_id=bcd HTTP/1.1\r\n"
+        b"Host: localhost\r\n"
+        b"Upgrade: websocket\r\n"
+        b"Connection: Upgrade\r\n\r\n"
+    )
+    assert router.handoff_shard(head) == 1
+    # Без комнаты в адресе соединение обслуживает маршрутизатор
+    assert router.handoff_shard(head.replace(b"?room_id=bcd", b"")) is None
+    # HTTP запросы не передаются обработчикам
+    assert router.handoff_shard(head.replace(b"Upgrade: websocket\r\n", b"")) is None
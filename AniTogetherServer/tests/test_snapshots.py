@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+import rooms
+import snapshots
+
+
+@pytest.fixture
+def snapshot_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, "SNAPSHOT_FILE", str(tmp_path / "rooms.db"))
+    monkeypatch.setattr(snapshots, "_connection", None)
+    monkeypatch.setattr(snapshots, "_owned", False)
+    yield
+    if snapshots._connection is not None:
+        snapshots._connection.close()
+
+
+def restart(monkeypatch):
+    """
+    Имитирует запуск нового процесса после завершения текущего.
+    """
+    snapshots._connection.close()
+    monkeypatch.setattr(snapshots, "_connection", None)
+    monkeypatch.setattr(snapshots, "_owned", False)
+    monkeypatch.setattr(snapshots, "OWNER", "other")
+    rooms.ROOMS.clear()
+    rooms.CHANGED_ROOMS.clear()
+
+
+def test_round_trip(snapshot_file, monkeypatch):
+    async def save():
+        assert await snapshots.try_acquire()
+        playing = rooms.get_room(rooms.create_room(10, "1"))
+        playing.playing = True
+        deleted = rooms.create_room(11, "2")
+        await snapshots.flush()
+        rooms.delete_room(deleted)
+        await snapshots.flush(release=True)
+        return playing.room_id, deleted
+
+    room_id, deleted = asyncio.run(save())
+    restart(monkeypatch)
+    assert asyncio.run(snapshots.try_acquire())
+    assert list(rooms.ROOMS) == [room_id]
+    room = rooms.ROOMS[room_id]
+    assert (room.title_id, room.episode, room.playing) == (10, "1", True)
+
+
+def test_live_owner_keeps_file(snapshot_file, monkeypatch):
+    assert asyncio.run(snapshots.try_acquire())
+    restart(monkeypatch)
+    # Прежний владелец - текущий процесс, и он не освободил файл
+    monkeypatch.setattr(snapshots, "is_alive", lambda owner: True)
+    assert not asyncio.run(snapshots.try_acquire())
+    assert snapshots.handoff_pending()
+
+
+def test_dead_owner_is_taken_over(snapshot_file, monkeypatch):
+    assert asyncio.run(snapshots.try_acquire())
+    restart(monkeypatch)
+    monkeypatch.setattr(snapshots, "is_alive", lambda owner: False)
+    assert asyncio.run(snapshots.try_acquire())
+    assert not snapshots.handoff_pending()
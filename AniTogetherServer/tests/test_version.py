@@ -0,0 +1,48 @@
+import pytest
+
+from version import Version, parse_version
+
+
+@pytest.mark.parametrize(
+    "older, newer",
+    [
+        ("1.0.0", "1.0.1"),
+        ("1.0.9", "1.1.0"),
+        ("1.9.9", "2.0.0"),
+        ("1.0.0-alpha.1", "1.0.0-betta.1"),
+        ("1.0.0-betta.4", "1.0.0-rc.1"),
+        ("1.0.0-rc.3", "1.0.0"),
+        ("1.0.0-betta.3", "1.0.0-betta.4"),
+    ],
+)
+def test_ordering(older, newer):
+    assert Version.from_str(older) < Version.from_str(newer)
+    assert Version.from_str(newer) > Version.from_str(older)
+    assert Version.from_str(older) != Version.from_str(newer)
+
+
+def test_equality_and_hash():
+    assert Version.from_str("1.2.3-rc.1") == Version(1, 2, 3, "rc", 1)
+    assert len({Version.from_str("1.2.3"), Version(1, 2, 3)}) == 1
+
+
+def test_to_str():
+    assert Version.from_str("1.0.0-betta.4").to_str() == "1.0.0-betta.4"
+    assert Version.from_str("1.0.0-betta.4").to_str(revision=False) == "1.0.0"
+
+
+@pytest.mark.parametrize("string", ["1.0", "1.0.0-beta.1", "v1.0.0", ""])
+def test_invalid(string):
+    with pytest.raises(ValueError):
+        Version.from_str(string)
+
+
+def test_comparison_with_other_types():
+    version = Version(1, 0, 0)
+    assert version != "1.0.0"
+    with pytest.raises(TypeError):
+        version < "1.0.0"
+
+
+def test_parse_version_is_cached():
+    assert parse_version("1.0.0-rc.2") is parse_version("1.0.0-rc.2")
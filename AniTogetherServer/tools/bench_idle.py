@@ -0,0 +1,94 @@
+"""
+
+Потребление памяти сервером на одно простаивающее соединение
+для каждого профиля настроек соединений (CONNECTION_PROFILE).
+
+Для каждого профиля запускает сервер, подключает к комнатам клиентов,
+которые, как браузеры, предлагают permessage-deflate, рассылает
+в каждую комнату одно событие и измеряет прирост RSS сервера:
+
+    python tools/bench_idle.py --connections 2000
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+
+import websockets
+
+from loadgen import create_room, process_stats, start_server
+
+
+PROFILES = ("library", "lean", "adaptive")
+
+
+async def join(url: str, room_id: str) -> websockets.WebSocketClientProtocol:
+    websocket = await websockets.connect(url, compression="deflate", max_size=None)
+    await websocket.send(json.dumps({"command": "join", "room_id": room_id}))
+    await websocket.recv()
+    return websocket
+
+
+async def measure(args: argparse.Namespace, pid: int) -> dict:
+    base_url = f"http://{args.host}:{args.port}"
+    url = f"ws://{args.host}:{args.port}/"
+    room_ids = [
+        create_room(base_url, args.version)
+        for _ in range(max(1, args.connections // args.room_size))
+    ]
+    await asyncio.sleep(0.5)
+    _, rss_before = process_stats([pid])
+
+    clients = []
+    for i in range(0, args.connections, 100):
+        clients += await asyncio.gather(
+            *(
+                join(url, room_ids[j // args.room_size])
+                for j in range(i, min(i + 100, args.connections))
+            )
+        )
+    # Хостер каждой комнаты - первый подключившийся клиент
+    for hoster in clients[:: args.room_size]:
+        await hoster.send(json.dumps({"command": "pause"}))
+    await asyncio.sleep(1)
+    _, rss_after = process_stats([pid])
+
+    await asyncio.gather(*(client.close() for client in clients))
+    return dict(
+        rss_before_mib=round(rss_before / 2**20, 1),
+        rss_after_mib=round(rss_after / 2**20, 1),
+        kib_per_connection=round((rss_after - rss_before) / args.connections / 1024, 2),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--room-size", type=int, default=20)
+    parser.add_argument("--profiles", nargs="+", choices=PROFILES, default=PROFILES)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8802)
+    parser.add_argument("--version", default="1.0.0-betta.4")
+    args = parser.parse_args()
+    args.workers = 1
+
+    results = {}
+    for profile in args.profiles:
+        os.environ["CONNECTION_PROFILE"] = profile
+        server = start_server(args)
+        try:
+            results[profile] = asyncio.run(measure(args, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{profile:<10} {results[profile]}")
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
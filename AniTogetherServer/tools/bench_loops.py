@@ -0,0 +1,39 @@
+"""
+
+Сравнение стандартного цикла событий asyncio и uvloop под одинаковой нагрузкой.
+
+Запускает tools/loadgen.py с EVENT_LOOP=asyncio и EVENT_LOOP=uvloop
+и выводит сравнение результатов. Аргументы передаются в loadgen как есть:
+
+    python tools/bench_loops.py --rooms 50 --clients 20 --duration 30
+
+"""
+
+from __future__ import annotations
+
+import os
+import re
+import subprocess
+import sys
+
+
+LOADGEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "loadgen.py")
+LOOPS = ("asyncio", "uvloop")
+
+
+def main() -> None:
+    results = []
+    for loop in LOOPS:
+        output = subprocess.run(
+            [sys.executable, LOADGEN, *sys.argv[1:], "--label", f"loop-{loop}"],
+            env=dict(os.environ, EVENT_LOOP=loop),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(re.search(r"Saved to (.+)", output).group(1).strip())
+    subprocess.run([sys.executable, LOADGEN, "--compare", *results], check=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+
+Сравнение удаления пустых комнат через Reaper и через задачу на комнату.
+
+Создаёт N комнат, которые никто не посещает, и выводит прирост памяти
+процесса, время создания и задержку таймеров цикла событий,
+пока комнаты ожидают удаления. Каждый режим запускается в отдельном процессе.
+
+    python tools/bench_reaper.py --rooms 1000000
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "AniTogetherServer")
+)
+
+
+def rss() -> int:
+    """
+    Возвращает размер резидентной памяти процесса в байтах (только Linux).
+    """
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+async def measure_timer_lag(duration: float, interval: float = 0.01) -> float:
+    """
+    Возвращает максимальное опоздание таймера за `duration` секунд.
+    """
+    max_lag = 0.0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.monotonic() - start - interval)
+    return max_lag
+
+
+async def run_mode(mode: str, count: int, ttl: float) -> dict:
+    from loguru import logger
+
+    logger.remove()  # логирование каждой комнаты исказит результат
+
+    import rooms
+
+    rooms.REAPER.ttl = ttl
+
+    async def delete_later(room_id):
+        await asyncio.sleep(ttl)
+        rooms.delete_if_empty(room_id)
+
+    reaper = asyncio.create_task(rooms.REAPER.run())
+    base_rss = rss()
+    start = time.perf_counter()
+    for _ in range(count):
+        if mode == "reaper":
+            rooms.create_room(1, "1")
+        else:
+            # Поведение до появления Reaper
+            room_id = rooms.generate_room_id()
+            rooms.ROOMS[room_id] = rooms.Room(room_id, 1, "1")
+            asyncio.create_task(delete_later(room_id))
+    create_time = time.perf_counter() - start
+    await asyncio.sleep(0)
+    memory = rss() - base_rss
+    timer_lag = await measure_timer_lag(min(2.0, ttl / 2))
+    start = time.perf_counter()
+    while rooms.ROOMS:
+        await asyncio.sleep(0.05)
+    reaper.cancel()
+    return dict(
+        mode=mode,
+        rooms=count,
+        create_seconds=round(create_time, 3),
+        rss_mib=round(memory / 2**20, 1),
+        bytes_per_room=round(memory / count, 1),
+        max_timer_lag_ms=round(timer_lag * 1000, 2),
+        drain_seconds=round(time.perf_counter() - start, 3),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=1_000_000)
+    parser.add_argument("--ttl", type=float, default=5.0)
+    parser.add_argument("--mode", choices=("reaper", "tasks"))
+    args = parser.parse_args()
+
+    if args.mode:
+        result = asyncio.run(run_mode(args.mode, args.rooms, args.ttl))
+        print(json.dumps(result))
+        return
+
+    for mode in ("tasks", "reaper"):
+        output = subprocess.run(
+            [sys.executable, __file__, "--mode", mode,
+             "--rooms", str(args.rooms), "--ttl", str(args.ttl)],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        print(json.loads(output.strip().splitlines()[-1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,398 @@
+"""
+
+Нагрузочный тест сервера по протоколу комнат.
+
+Запускает сервер локально (или подключается к уже запущенному),
+создаёт комнаты через /create_room и подключает к каждой комнате клиентов.
+Хостер каждой комнаты по кругу отправляет play, seek и pause,
+зрители при подключении запрашивают время сервера и позицию воспроизведения.
+
+В отчёт попадают перцентили задержки рассылки (от отправки команды
+хостером до получения события зрителем), количество сообщений в секунду,
+а также потребление CPU и памяти процессами сервера.
+Отчёт сохраняется в tools/results, чтобы запуски можно было сравнить:
+
+    python tools/loadgen.py --rooms 50 --clients 20 --duration 30 --label baseline
+    python tools/loadgen.py --compare tools/results/a.json tools/results/b.json
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+import websockets
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(TOOLS_DIR, "..", "AniTogetherServer")
+RESULTS_DIR = os.path.join(TOOLS_DIR, "results")
+
+sys.path.insert(0, SERVER_DIR)
+from protocol import NAME_IDS, NAMES  # noqa
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.received = 0
+        self.sent = 0
+        self.errors = 0
+
+
+class Codec:
+    def __init__(self, name: str):
+        self.name = name
+
+    def encode(self, data: dict) -> str | bytes:
+        if self.name == "msgpack":
+            return msgpack.packb({**data, "command": NAME_IDS[data["command"]]})
+        return json.dumps(data)
+
+    def decode(self, message: str | bytes) -> dict:
+        if isinstance(message, bytes):
+            event = msgpack.unpackb(message)
+            if isinstance(event, dict) and isinstance(event.get("type"), int):
+                event["type"] = NAMES[event["type"]]
+            return event
+        return json.loads(message)
+
+
+class LoadRoom:
+    """
+    Комната с хостером и зрителями.
+    Время отправки команд хостером хранится по request_id, который сервер
+    возвращает в событии, для вычисления задержки рассылки.
+    Из команд, объединённых сервером, задержка измеряется только для последней.
+    """
+
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        self.sent_at: dict[int, float] = {}
+
+
+def process_stats(pids: list[int]) -> tuple[float, int]:
+    """
+    Возвращает суммарное процессорное время (в секундах)
+    и резидентную память (в байтах) процессов (только Linux).
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    cpu, memory = 0.0, 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks
+            with open(f"/proc/{pid}/statm") as file:
+                memory += int(file.read().split()[1]) * page_size
+        except FileNotFoundError:
+            pass
+    return cpu, memory
+
+
+def server_pids(pid: int) -> list[int]:
+    """
+    Возвращает процесс сервера и его дочерние процессы (обработчики шардов).
+    """
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            return [pid, *map(int, file.read().split())]
+    except FileNotFoundError:
+        return [pid]
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def create_room(base_url: str, version: str) -> str:
+    url = f"{base_url}/create_room?title_id=1&episode=1&version={version}"
+    with urllib.request.urlopen(url) as response:
+        answer = json.loads(response.read())
+    if answer["status"] != "ok":
+        raise RuntimeError(f"Can`t create room: {answer}")
+    return answer["room_id"]
+
+
+async def connect(url: str, room: LoadRoom, codec: Codec, compression: bool):
+    # По комнате в адресе маршрутизатор передаёт соединение обработчику шарда
+    websocket = await websockets.connect(
+        f"{url}?room_id={room.room_id}",
+        compression="deflate" if compression else None,
+        max_size=None,
+    )
+    await websocket.send(
+        codec.encode(dict(command="join", room_id=room.room_id, codec=codec.name))
+    )
+    init = codec.decode(await websocket.recv())
+    assert init["type"] == "init", init
+    return websocket
+
+
+async def hoster(websocket, room: LoadRoom, codec: Codec, stats: Stats,
+                 rate: float, stop: asyncio.Event) -> None:
+    seq = itertools.count()
+    commands = itertools.cycle(("play", "seek", "pause"))
+    while not stop.is_set():
+        command = next(commands)
+        request_id = next(seq)
+        data = dict(
+            command=command,
+            time=time.time(),
+            playback_time=float(request_id),
+            request_id=request_id,
+        )
+        room.sent_at[request_id] = time.perf_counter()
+        await websocket.send(codec.encode(data))
+        stats.sent += 1
+        await asyncio.sleep(1 / rate)
+
+
+async def viewer(websocket, room: LoadRoom, codec: Codec, stats: Stats) -> None:
+    requests = {}
+    requests["server_time_request"] = time.perf_counter()
+    await websocket.send(codec.encode(dict(command="server_time_request", time=0)))
+    requests["playback_time_request"] = time.perf_counter()
+    await websocket.send(codec.encode(dict(command="playback_time_request")))
+    stats.sent += 2
+
+    async for message in websocket:
+        now = time.perf_counter()
+        event = codec.decode(message)
+        stats.received += 1
+        event_type = event["type"]
+        if event_type in ("play", "seek", "pause"):
+            if sent := room.sent_at.get(event.get("request_id")):
+                stats.latencies[event_type].append(now - sent)
+        elif event_type == "server_time_request_answer":
+            stats.latencies[event_type].append(
+                now - requests.pop("server_time_request")
+            )
+        elif event_type == "playback_time_request_answer":
+            if sent := requests.pop("playback_time_request", None):
+                stats.latencies[event_type].append(now - sent)
+        elif event_type == "error":
+            stats.errors += 1
+
+
+async def hoster_answers(websocket, codec: Codec, stats: Stats) -> None:
+    """
+    Отвечает на запросы позиции, которые сервер переслал хостеру.
+    """
+    async for message in websocket:
+        event = codec.decode(message)
+        stats.received += 1
+        if event["type"] == "playback_time_request":
+            await websocket.send(codec.encode(dict(
+                command="playback_time_request_answer",
+                time=time.time(),
+                playback_time=0.0,
+                user_id=event["user_id"],
+            )))
+            stats.sent += 1
+        elif event["type"] == "error":
+            stats.errors += 1
+
+
+async def run(args: argparse.Namespace, server_pid: int | None) -> dict:
+    base_url = f"http://{args.host}:{args.port}"
+    ws_url = f"ws://{args.host}:{args.port}/"
+    codec = Codec(args.codec)
+    stats = Stats()
+    stop = asyncio.Event()
+
+    load_rooms = [
+        LoadRoom(create_room(base_url, args.version)) for _ in range(args.rooms)
+    ]
+    tasks, sockets = [], []
+    for room in load_rooms:
+        websocket = await connect(ws_url, room, codec, args.compression)
+        sockets.append(websocket)
+        tasks.append(asyncio.create_task(hoster_answers(websocket, codec, stats)))
+        tasks.append(asyncio.create_task(
+            hoster(websocket, room, codec, stats, args.rate, stop)
+        ))
+        viewers = await asyncio.gather(*(
+            connect(ws_url, room, codec, args.compression)
+            for _ in range(args.clients - 1)
+        ))
+        sockets.extend(viewers)
+        for websocket in viewers:
+            tasks.append(asyncio.create_task(viewer(websocket, room, codec, stats)))
+
+    pids = server_pids(server_pid) if server_pid else []
+    cpu_start, _ = process_stats(pids)
+    received_start, sent_start = stats.received, stats.sent
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - start
+    cpu_end, memory = process_stats(pids)
+    received, sent = stats.received - received_start, stats.sent - sent_start
+
+    stop.set()
+    await asyncio.gather(*(websocket.close() for websocket in sockets))
+    for task in tasks:
+        task.cancel()
+
+    all_fanout = [
+        latency
+        for event_type in ("play", "seek", "pause")
+        for latency in stats.latencies[event_type]
+    ]
+    return dict(
+        label=args.label,
+        date=datetime.now().isoformat(timespec="seconds"),
+        config=dict(
+            rooms=args.rooms,
+            clients=args.clients,
+            rate=args.rate,
+            duration=args.duration,
+            codec=args.codec,
+            compression=args.compression,
+            workers=args.workers,
+        ),
+        fanout_latency_ms={
+            name: summarize(values)
+            for name, values in (
+                ("all", all_fanout),
+                *((key, stats.latencies[key]) for key in sorted(stats.latencies)),
+            )
+        },
+        messages_per_second=dict(
+            received=round(received / elapsed, 1),
+            sent=round(sent / elapsed, 1),
+        ),
+        server=dict(
+            cpu_percent=round((cpu_end - cpu_start) / elapsed * 100, 1),
+            rss_mib=round(memory / 2**20, 1),
+        ) if pids else None,
+        errors=stats.errors,
+    )
+
+
+def summarize(values: list[float]) -> dict:
+    return dict(
+        count=len(values),
+        p50=ms(percentile(values, 0.5)),
+        p95=ms(percentile(values, 0.95)),
+        p99=ms(percentile(values, 0.99)),
+        max=ms(max(values, default=None)),
+        mean=ms(statistics.fmean(values) if values else None),
+    )
+
+
+def ms(value: float | None) -> float | None:
+    return None if value is None else round(value * 1000, 3)
+
+
+def start_server(args: argparse.Namespace) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        PORT=str(args.port),
+        WORKERS=str(args.workers),
+        LOGGING_LEVEL=os.environ.get("LOGGING_LEVEL", "WARNING"),
+        # Все клиенты нагрузки подключаются с одного адреса
+        IP_RATE_LIMIT=os.environ.get("IP_RATE_LIMIT", "0"),
+        # Нагрузка измеряется целиком, без отказов при перегрузке
+        ADMISSION_LOOP_LAG=os.environ.get("ADMISSION_LOOP_LAG", "0"),
+    )
+    process = subprocess.Popen([sys.executable, "main.py"], cwd=SERVER_DIR, env=env)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f"http://{args.host}:{args.port}/healthz")
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server did not start")
+
+
+def save(result: dict, label: str) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    name = datetime.now().strftime("%Y%m%d-%H%M%S") + (f"-{label}" if label else "")
+    path = os.path.join(RESULTS_DIR, f"{name}.json")
+    with open(path, "w") as file:
+        json.dump(result, file, indent=2)
+    return path
+
+
+def compare(paths: list[str]) -> None:
+    results = []
+    for path in paths:
+        with open(path) as file:
+            results.append(json.load(file))
+    rows = [
+        ("fan-out p50, ms", lambda r: r["fanout_latency_ms"]["all"]["p50"]),
+        ("fan-out p95, ms", lambda r: r["fanout_latency_ms"]["all"]["p95"]),
+        ("fan-out p99, ms", lambda r: r["fanout_latency_ms"]["all"]["p99"]),
+        ("received msg/s", lambda r: r["messages_per_second"]["received"]),
+        ("server CPU, %", lambda r: (r["server"] or {}).get("cpu_percent")),
+        ("server RSS, MiB", lambda r: (r["server"] or {}).get("rss_mib")),
+        ("errors", lambda r: r["errors"]),
+    ]
+    print(f"{'':<18}" + "".join(f"{os.path.basename(p)[:24]:>26}" for p in paths))
+    for title, getter in rows:
+        print(f"{title:<18}" + "".join(f"{str(getter(r)):>26}" for r in results))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=10,
+                        help="clients per room including the hoster")
+    parser.add_argument("--rate", type=float, default=2,
+                        help="hoster commands per second in each room")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--codec", choices=("json", "msgpack"), default="json")
+    parser.add_argument("--compression", action="store_true",
+                        help="negotiate permessage-deflate like browsers do")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8801)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--version", default="1.0.0-betta.4")
+    parser.add_argument("--no-spawn", action="store_true",
+                        help="use an already running server")
+    parser.add_argument("--label", default="")
+    parser.add_argument("--compare", nargs="+", metavar="RESULT")
+    args = parser.parse_args()
+
+    if args.compare:
+        return compare(args.compare)
+    if args.codec == "msgpack" and not msgpack:
+        parser.error("msgpack is not installed")
+
+    server = None if args.no_spawn else start_server(args)
+    try:
+        result = asyncio.run(run(args, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(json.dumps(result, indent=2))
+    print(f"Saved to {save(result, args.label)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+
+Локальная замена Redis для проверки RedisBus.
+Поддерживает только PUBLISH, SUBSCRIBE, UNSUBSCRIBE и PING.
+
+    python tools/resp_stub.py --port 6379
+    ROOM_BUS=redis://127.0.0.1:6379 PORT=8001 python AniTogetherServer/main.py
+
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+from collections import defaultdict
+
+
+SUBSCRIBERS: defaultdict[bytes, set[asyncio.StreamWriter]] = defaultdict(set)
+
+
+def bulk(value: bytes) -> bytes:
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+async def read_command(reader: asyncio.StreamReader) -> list[bytes]:
+    line = await reader.readuntil(b"\r\n")
+    if not line.startswith(b"*"):
+        return line.split()  # inline команда
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int((await reader.readuntil(b"\r\n"))[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    channels: set[bytes] = set()
+    try:
+        while True:
+            command, *args = await read_command(reader)
+            command = command.upper()
+            if command == b"PUBLISH":
+                channel, payload = args
+                message = b"*3\r\n" + bulk(b"message") + bulk(channel) + bulk(payload)
+                for subscriber in SUBSCRIBERS[channel]:
+                    subscriber.write(message)
+                writer.write(b":%d\r\n" % len(SUBSCRIBERS[channel]))
+            elif command in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                for channel in args:
+                    if command == b"SUBSCRIBE":
+                        channels.add(channel)
+                        SUBSCRIBERS[channel].add(writer)
+                    else:
+                        channels.discard(channel)
+                        SUBSCRIBERS[channel].discard(writer)
+                    writer.write(
+                        b"*3\r\n"
+                        + bulk(command.lower())
+                        + bulk(channel)
+                        + b":%d\r\n" % len(channels)
+                    )
+            elif command == b"PING":
+                writer.write(b"+PONG\r\n")
+            else:
+                writer.write(b"-ERR unknown command\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        for channel in channels:
+            SUBSCRIBERS[channel].discard(writer)
+        writer.close()
+
+
+async def main(port: int) -> None:
+    server = await asyncio.start_server(handle, "127.0.0.1", port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=6379)
+    try:
+        asyncio.run(main(parser.parse_args().port))
+    except KeyboardInterrupt:
+        pass